@@ -10,8 +10,13 @@ __copyright__ = "Copyright 2017, Frederic Laurent"
 __license__ = "MIT"
 
 import argparse
+import itertools
+import json
 import logging
 import os.path
+import tempfile
+
+import numpy
 
 import digester
 
@@ -21,38 +26,444 @@ except ImportError:
     print(f"Erreur import - Atom")
 
 class Diff:
-    def __init__(self, data_filename=None, storage_dir=""):
+    BATCH_SIZE = 65536
+    CHAR_FIELDS_SEP = "|"
+    # bytes used per line to sort a bucket : records, sort indexes and sorted copy
+    BUCKET_BYTES_PER_LINE = 32
+    # every bucket file is open while the new file is digested : 256 files at most,
+    # well below the usual limit of open files (1024)
+    MAX_BUCKET_BITS = 8
+
+    ADDED = "added"
+    REMOVED = "removed"
+    MODIFIED = "modified"
+
+    def __init__(
+        self,
+        data_filename=None,
+        storage_dir="",
+        streaming=False,
+        memory_limit=None,
+        algorithm=None,
+        digest_workers=1,
+    ):
+        """
+        :param data_filename: previous data filename
+        :param storage_dir: directory where diff files are saved
+        :param streaming: if True, lines of the new file are never loaded all at once
+        :param memory_limit: if set, memory (bytes) used to compare the digests :
+                             the new digest is partitioned into buckets on disk
+                             (see bucket_diff)
+        :param algorithm: hash algorithm of the lines (digester.Digester.ALGORITHMS)
+        :param digest_workers: number of processes hashing a data file read from
+                               disk (not in streaming or bucket mode)
+        """
         self.logger = logging.getLogger("differentia")
         self.data_filename = data_filename
         self.storage_dir = storage_dir
+        self.streaming = streaming
+        self.memory_limit = memory_limit
+        self.algorithm = algorithm
+        self.digest_workers = digest_workers
         self.data = []
+        # line numbers of the previous file not found in the new one
+        self.removed = numpy.array([], dtype="<u4")
+
+    def make_digester(self):
+        return digester.Digester(algorithm=self.algorithm, workers=self.digest_workers)
+
+    @staticmethod
+    def missing(hashes, sorted_hashes):
+        """
+            Vectorized membership test
+
+        :param hashes: array of hashes to look for
+        :param sorted_hashes: sorted array of hashes
+        :return: boolean mask, True where the hash is not in sorted_hashes
+        """
+        if len(sorted_hashes) == 0:
+            return numpy.ones(len(hashes), dtype=bool)
+        index = numpy.searchsorted(sorted_hashes, hashes)
+        index[index == len(sorted_hashes)] = 0
+        return sorted_hashes[index] != hashes
 
-    def find_diff(self, filename):
+    @staticmethod
+    def excess(records, other_hashes):
+        """
+            Vectorized multiset difference : a hash found n times in the other
+            digest has its first n records in common, the next ones are in excess
+
+        :param records: records sorted by hash, then by line
+        :param other_hashes: sorted array of hashes
+        :return: boolean mask, True where the record is not in the other digest
+        """
+        hashes = numpy.ascontiguousarray(records["hash"])
+        rank = numpy.arange(len(hashes)) - numpy.searchsorted(hashes, hashes, side="left")
+        count = numpy.searchsorted(other_hashes, hashes, side="right") - numpy.searchsorted(
+            other_hashes, hashes, side="left"
+        )
+        return rank >= count
+
+    @staticmethod
+    def hex_hashes(records):
+        """
+            Hex representation of the hashes of an array of records
+        :param records: numpy array of digest records
+        :return: list of hex strings
+        """
+        size = records.dtype["hash"].itemsize
+        raw = numpy.ascontiguousarray(records["hash"]).tobytes()
+        return [raw[i : i + size].hex() for i in range(0, len(raw), size)]
+
+    def compare(self, old_digest, new_digest):
+        """
+            Compare 2 digests, both held as arrays sorted by hash. A line found
+            more times in one file than in the other is added (or removed) as
+            many times as the difference (see excess)
+
+        :param old_digest: digest of the previous file
+        :param new_digest: digest of the new file
+        :return: records of the new file not in the previous one (ordered by line),
+                 line numbers of the previous file not in the new one
+        """
+        old = digester.Digester.to_records(old_digest)
+        new = digester.Digester.to_records(new_digest)
+        old_hashes = numpy.ascontiguousarray(old["hash"])
+        new_hashes = numpy.ascontiguousarray(new["hash"])
+
+        added = new[self.excess(new, old_hashes)]
+        added = added[numpy.argsort(added["line"], kind="stable")]
+        removed = numpy.sort(old["line"][self.excess(old, new_hashes)])
+        return added, removed
+
+    def find_diff(self, filename, lines=None):
         """
             Find delta between the new filename (arg) and the previous
 
         :param filename: new data filename
+        :param lines: raw lines of the new file, if not read from filename
         :return: list of differences
         """
+        if self.memory_limit:
+            return self.bucket_diff(filename, lines)
+        if self.streaming:
+            return list(self.iter_diff(filename, lines))
 
-        old_d = digester.Digester()
-        new_d = digester.Digester()
+        old_d = self.make_digester()
+        new_d = self.make_digester()
         old_data_fn = self.data_filename
 
         self.logger.info("Diff old = %s / new = %s" % (old_data_fn, filename))
 
-        old_sha_data = None
+        old_sha_data = {}
+        if old_data_fn:
+            old_sha_data = old_d.load_hashes(old_data_fn)
+
+        if lines is None:
+            blocks = None
+            if old_data_fn and not os.path.exists(new_d.sha_filename(filename)):
+                blocks = new_d.block_digest(filename, old_data_fn)
+            if blocks is not None and blocks[0]:
+                self.logger.info(f"{filename} : same content as {old_data_fn}")
+                self.removed = numpy.array([], dtype="<u4")
+                return []
+            new_sha_data = new_d.load_hashes(filename)
+        else:
+            new_d.stream_digest(filename, lines)
+            new_sha_data = new_d.load_digest(new_d.sha_filename(filename))
+
+        added, removed = self.compare(old_sha_data, new_sha_data)
+        self.removed = removed + 1
+
+        # only the added lines are read
+        return [
+            (sha, linenum + 1, line.decode("utf-8").strip())
+            for sha, (linenum, line) in zip(
+                self.hex_hashes(added), new_d.fetch_lines(filename, added["line"])
+            )
+        ]
+
+    def iter_diff(self, filename, lines=None):
+        """
+            Streaming version of find_diff : the new file is digested line by line
+            and looked up in the digest file of the previous data file.
+            No line of either file is kept in memory. The added copies of a line
+            already in the previous file are given at the end, once the count of
+            each line is known (see compare)
+
+        :param filename: new data filename
+        :param lines: raw lines of the new file, if not read from filename
+        :return: generator of differences (hash, line number, line)
+        """
+        old_data_fn = self.data_filename
+        self.logger.info("Stream diff old = %s / new = %s" % (old_data_fn, filename))
+
+        old_records = digester.Digester.to_records({})
+        if old_data_fn:
+            old_records = digester.Digester.to_records(
+                self.make_digester().load_hashes(old_data_fn)
+            )
+        old_hashes = numpy.ascontiguousarray(old_records["hash"])
+
+        new_d = self.make_digester()
+        batch = []
+        for item in new_d.iter_digest(filename, lines):
+            batch.append(item)
+            if len(batch) >= self.BATCH_SIZE:
+                yield from self.filter_batch(batch, old_hashes)
+                batch = []
+        yield from self.filter_batch(batch, old_hashes)
+
+        # the new digest file is now written
+        new_records = digester.Digester.to_records(
+            new_d.load_digest(new_d.sha_filename(filename))
+        )
+        new_hashes = numpy.ascontiguousarray(new_records["hash"])
+        copies = new_records[
+            self.excess(new_records, old_hashes) & ~self.missing(new_hashes, old_hashes)
+        ]
+        copies = copies[numpy.argsort(copies["line"], kind="stable")]
+        for sha, (linenum, line) in zip(
+            self.hex_hashes(copies), new_d.fetch_lines(filename, copies["line"])
+        ):
+            yield sha, linenum + 1, line.decode("utf-8").strip()
+        self.removed = numpy.sort(old_records["line"][self.excess(old_records, new_hashes)]) + 1
+
+    def bucket_bits(self, line_count):
+        """
+            Number of bits of the hash prefix, so that a bucket of the expected
+            number of lines is sorted within memory_limit
+        :param line_count: expected number of lines
+        :return: number of bits (0 : a single bucket)
+        """
+        needed = line_count * Diff.BUCKET_BYTES_PER_LINE
+        bits = 0
+        while bits < Diff.MAX_BUCKET_BITS and needed > self.memory_limit << bits:
+            bits += 1
+        return bits
+
+    def bucket_diff(self, filename, lines=None):
+        """
+            Bounded memory version of find_diff, for files larger than the memory.
+
+            The new file is digested into buckets on disk, by hash prefix. The
+            digest of the previous file is sorted by hash : the records of a
+            prefix are a slice of its mapped file. Buckets are compared one at a
+            time, then the added lines are read at their offsets in the new file.
+            The sorted buckets, in prefix order, make the new digest file.
+
+        :param filename: new data filename
+        :param lines: raw lines of the new file, if not read from filename
+        :return: list of differences
+        """
+        old_data_fn = self.data_filename
+        self.logger.info("Bucket diff old = %s / new = %s" % (old_data_fn, filename))
+
+        new_d = self.make_digester()
+        old_records = digester.Digester.to_records({})
         if old_data_fn:
-            old_sha_data = old_d.digest(old_data_fn)
+            old_records = digester.Digester.to_records(new_d.load_hashes(old_data_fn))
+        old_hashes = old_records["hash"]
+
+        line_count = len(old_records)
+        if not line_count and lines is None:
+            # no previous file : estimate from the size of the new one
+            line_count = os.path.getsize(filename) // 64
+        bits = self.bucket_bits(line_count)
 
-        new_sha_data = new_d.digest(filename)
+        added, removed = [], []
+        sha_filename = new_d.sha_filename(filename)
+        with tempfile.TemporaryDirectory(dir=self.storage_dir or None) as tmpdir:
+            bucket_filenames, count = new_d.bucket_digest(filename, tmpdir, bits, lines)
+
+            tmp_filename = f"{sha_filename}.tmp"
+            with open(tmp_filename, "wb", buffering=new_d.buffer_size) as fout:
+                new_d.write_digest_header(fout, count)
+                # first record of each prefix in the previous digest
+                prefixes = numpy.arange(1, len(bucket_filenames), dtype="u8")
+                bounds = numpy.concatenate(
+                    (
+                        [0],
+                        numpy.searchsorted(old_hashes, prefixes << numpy.uint64(64 - bits)),
+                        [len(old_records)],
+                    )
+                )
+                for b, bucket_filename in enumerate(bucket_filenames):
+                    new = numpy.fromfile(bucket_filename, dtype=digester.Digester.record_dtype())
+                    os.remove(bucket_filename)
+                    new = new[numpy.argsort(new["hash"], kind="stable")]
+                    bucket_added, bucket_removed = self.compare(
+                        old_records[bounds[b] : bounds[b + 1]], new
+                    )
+                    added.append(bucket_added)
+                    removed.append(bucket_removed)
+                    fout.write(new.tobytes())
+            os.replace(tmp_filename, sha_filename)
+
+        # concatenate may give the native byte order, hashes are kept big endian
+        added = numpy.concatenate(added).astype(digester.Digester.record_dtype())
+        added = added[numpy.argsort(added["line"], kind="stable")]
+        self.removed = numpy.sort(numpy.concatenate(removed)) + 1
+
+        return [
+            (sha, linenum + 1, line.decode("utf-8").strip())
+            for sha, (linenum, line) in zip(
+                self.hex_hashes(added), new_d.fetch_lines(filename, added["line"])
+            )
+        ]
+
+    def filter_batch(self, batch, old_hashes):
+        """
+            Keep the lines of a batch whose hash is unknown in the previous file
+        :param batch: list of (line number, hash, raw line)
+        :param old_hashes: sorted hashes of the previous file
+        :return: generator of differences (hash, line number, line)
+        """
+        if not batch:
+            return
+        hashes = numpy.frombuffer(
+            b"".join(sha for _, sha, _ in batch), dtype=old_hashes.dtype
+        )
+        for (linenum, sha, line), new in zip(batch, self.missing(hashes, old_hashes)):
+            if new:
+                yield sha.hex(), linenum + 1, line.decode("utf-8").strip()
+
+    def removed_lines(self):
+        """
+            Lines of the previous file not found in the new one, read at their offsets.
+            The first line (header) is ignored. Nothing is given if the previous
+            data file is missing (only its digest file is left)
+
+        :return: generator of (line number, line)
+        """
+        if self.data_filename and len(self.removed) and not os.path.exists(self.data_filename):
+            self.logger.warning(
+                f"Previous data file {self.data_filename} missing : removed lines unknown"
+            )
+        elif self.data_filename and len(self.removed):
+            for num, line in digester.Digester().fetch_lines(
+                self.data_filename, self.removed - 1
+            ):
+                if num > 0:
+                    yield num + 1, line.decode("utf-8").strip()
 
-        diff_data = []
+    @staticmethod
+    def split_line(line):
+        """
+            Split a data line into values
+        :param line: line (str)
+        :return: list of values
+        """
+        return [v.strip('"') for v in line.split(Diff.CHAR_FIELDS_SEP)]
+
+    def find_changes(self, difflist, fields, key):
+        """
+            Classify the differences by key : added, removed or modified records.
+
+            Only the changed lines are considered : lines of the new file found by
+            find_diff and lines of the previous file in self.removed.
+            Both sets are sorted by key and merged in a single pass.
+            The first line of each file (header) is ignored.
+
+        :param difflist: differences found by find_diff
+        :param fields: names of the columns (ex: RPPS.MAPPING[category])
+        :param key: name of the key column (ex: identifiant_pp)
+        :return: list of changes (dict), sorted by key
+        """
+        key_index = fields.index(key)
+
+        def keyed(rows):
+            rows = [(values[key_index], num, text, values) for num, text, values in rows]
+            rows.sort(key=lambda r: (r[0], r[1]))
+            return itertools.groupby(rows, key=lambda r: r[0])
+
+        new_rows = keyed(
+            (num, text, self.split_line(text)) for _, num, text in difflist if num > 1
+        )
+
+        old_rows = keyed(
+            (num, text, self.split_line(text)) for num, text in self.removed_lines()
+        )
+
+        changes = []
+        old_group = next(old_rows, None)
+        new_group = next(new_rows, None)
+        while old_group or new_group:
+            if new_group is None or (old_group and old_group[0] < new_group[0]):
+                key_value, old_list, new_list = old_group[0], list(old_group[1]), []
+                old_group = next(old_rows, None)
+            elif old_group is None or new_group[0] < old_group[0]:
+                key_value, old_list, new_list = new_group[0], [], list(new_group[1])
+                new_group = next(new_rows, None)
+            else:
+                key_value, old_list, new_list = (
+                    new_group[0],
+                    list(old_group[1]),
+                    list(new_group[1]),
+                )
+                old_group = next(old_rows, None)
+                new_group = next(new_rows, None)
+            changes.extend(self.record_changes(fields, key_value, old_list, new_list))
+
+        self.logger.info(
+            "Changes : %s"
+            % {
+                status: sum(1 for c in changes if c["status"] == status)
+                for status in (Diff.ADDED, Diff.REMOVED, Diff.MODIFIED)
+            }
+        )
+        return changes
+
+    @staticmethod
+    def record_changes(fields, key, old_rows, new_rows):
+        """
+            Changes of the records sharing the same key.
+            Rows are paired in file order : a pair is a modification,
+            the remaining rows are additions or removals
+
+        :param fields: names of the columns
+        :param key: key value
+        :param old_rows: rows of the previous file (line number, line, values)
+        :param new_rows: rows of the new file (line number, line, values)
+        :return: list of changes
+        """
+        changes = []
+        for old, new in itertools.zip_longest(old_rows, new_rows):
+            change = {
+                "status": None,
+                "key": key,
+                "line": new[1] if new else None,
+                "previous_line": old[1] if old else None,
+            }
+            if old and new:
+                change["status"] = Diff.MODIFIED
+                change["changes"] = {
+                    field: [old_val, new_val]
+                    for field, old_val, new_val in zip(fields, old[3], new[3])
+                    if old_val != new_val
+                }
+                change["data"] = new[2]
+            elif new:
+                change["status"] = Diff.ADDED
+                change["data"] = new[2]
+            else:
+                change["status"] = Diff.REMOVED
+                change["data"] = old[2]
+            changes.append(change)
+        return changes
+
+    def save_changes(self, changes, filename):
+        """
+            Save classified changes, one json object per line
+        :param changes: list of changes
+        :param filename: file name
+        :return: -
+        """
+        self.logger.info("Changes >>> %d" % len(changes))
 
-        for (sha, linenum) in new_sha_data.items():
-            if not old_sha_data or sha not in old_sha_data:
-                diff_data.append((sha, linenum + 1, new_d.data[linenum]))
-        return diff_data
+        with open(os.path.join(self.storage_dir, filename), "w", encoding="utf-8") as fout:
+            for change in changes:
+                fout.write("%s\n" % json.dumps(change, ensure_ascii=False))
 
     def save_diff(self, difflist, filename):
         """
@@ -74,8 +485,26 @@ if __name__ == "__main__":
     parser.add_argument("previous", help="previous data file")
     parser.add_argument("next", help="next data file")
     parser.add_argument("output", help="output file name")
+    parser.add_argument(
+        "--streaming", action="store_true", help="ne charge pas les fichiers en memoire"
+    )
+    parser.add_argument(
+        "--memory", type=int, help="mémoire (Mo) de comparaison des empreintes, par préfixe"
+    )
+    parser.add_argument(
+        "--algorithm",
+        choices=sorted(digester.Digester.ALGORITHMS),
+        help="algorithme de hachage des lignes",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="nombre de processus de hachage")
     args = parser.parse_args()
 
-    diff = Diff(data_filename=args.previous)
+    diff = Diff(
+        data_filename=args.previous,
+        streaming=args.streaming,
+        memory_limit=args.memory * 1024 * 1024 if args.memory else None,
+        algorithm=args.algorithm,
+        digest_workers=args.workers,
+    )
     data = diff.find_diff(args.next)
     diff.save_diff(data, args.output)
@@ -4,6 +4,31 @@
     Make a digest of each line of a data file
     The resulting digest filename has the Digester.FILE_SUFFIX by default
 
+    Digest file format (binary, little endian) :
+        header : magic "DGST", format version, hash size, hash algorithm,
+                 record count
+        records : truncated hash (hash size bytes) + line number (uint32),
+                  sorted by hash
+
+    Version 1 files have no algorithm (sha256). The legacy text format
+    ("line:hexdigest" per line, sha256) is still readable.
+    Digests made with different algorithms are never compared : a digest of
+    another algorithm is made again (see Digester.load_hashes).
+
+    Offsets file (Digester.OFFSETS_SUFFIX, next to the data file) : byte offset
+    of each line (uint64, little endian), followed by the size of the file.
+    Line n is file[offsets[n]:offsets[n + 1]].
+
+    Blocks file (Digester.BLOCKS_SUFFIX, next to the data file) : header (magic
+    "BLKS", version, hash size, block bits, size of the data file), hash of the
+    whole file (hash of the block hashes and of the size), then hash of the raw
+    bytes and number of lines of each block. Block boundaries depend on the
+    content only : a block ends after a line whose crc32 has its block bits
+    low bits at zero, so a line inserted or removed only changes its own block.
+    A block of the new file found in the previous one has the same line
+    digests : only the other blocks are hashed line by line (see
+    Digester.block_digest).
+
 """
 __author__ = "Frederic Laurent"
 __version__ = "1.0"
@@ -11,27 +36,189 @@ __copyright__ = "Copyright 2017, Frederic Laurent"
 __license__ = "MIT"
 
 import argparse
+import collections
+import concurrent.futures
 import hashlib
+import itertools
 import logging
+import mmap
 import os.path
-import codecs
+import shutil
+import struct
+import zlib
+from collections.abc import Mapping
+
+import numpy
 
 try:
     from easy_atom import helpers
 except ImportError:
     print(f"Erreur import - Atom")
 
+try:
+    # optional : fastest hash of the lines
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def sha256_hash(line):
+    return hashlib.sha256(line).digest()[:8]
+
+
+def blake2b_hash(line):
+    return hashlib.blake2b(line, digest_size=8).digest()
+
+
+def xxh128_hash(line):
+    return xxhash.xxh128_digest(line)[:8]
+
+
+class DigestFile(Mapping):
+    """
+        Read only view of a binary digest file (hash -> line number)
+
+        The file is memory mapped, nothing is parsed : lookups are
+        binary searches on the sorted records.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fin:
+            self._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.hash_size, algorithm_id, self.count = Digester.HEADER.unpack_from(
+            self._mm, 0
+        )
+        if magic != Digester.MAGIC or version not in Digester.FORMAT_VERSIONS:
+            raise ValueError(f"Bad digest file {filename} ({magic}, v{version})")
+        if version == 1:
+            algorithm_id = Digester.ALGORITHMS["sha256"]
+        # name of the hash algorithm, None if unknown
+        self.algorithm = next(
+            (name for name, value in Digester.ALGORITHMS.items() if value == algorithm_id),
+            None,
+        )
+        self.record_size = self.hash_size + Digester.LINE_NUMBER.size
+
+    def _hash_at(self, index):
+        offset = Digester.HEADER.size + index * self.record_size
+        return self._mm[offset : offset + self.hash_size]
+
+    def _line_at(self, index):
+        offset = Digester.HEADER.size + index * self.record_size + self.hash_size
+        return Digester.LINE_NUMBER.unpack_from(self._mm, offset)[0]
+
+    def _search(self, key):
+        """
+            Binary search of a hash
+        :param key: hash
+        :return: index of the record, -1 if not found
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._hash_at(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, key):
+        index = self._search(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._line_at(index)
+
+    def __contains__(self, key):
+        return self._search(key) >= 0
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self._hash_at(index)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        for index in range(self.count):
+            yield self._hash_at(index), self._line_at(index)
+
+    @property
+    def records(self):
+        """
+            Records as a numpy structured array (hash, line), sorted by hash.
+            The array is a view on the mapped file, no copy is made
+        """
+        return numpy.frombuffer(
+            self._mm,
+            dtype=Digester.record_dtype(self.hash_size),
+            count=self.count,
+            offset=Digester.HEADER.size,
+        )
+
+    def close(self):
+        self._mm.close()
+
+
 class Digester:
     """
         File Digester
 
+        Lines are read from a buffered binary stream and hashed one at a time :
+        memory is bounded by the read buffer, not by the size of the data file.
     """
 
     CHAR_FIELDS_SEP = ":"
     FILE_SUFFIX = ".sha"
+    BUFFER_SIZE = 4 * 1024 * 1024
 
-    def __init__(self):
+    BATCH_SIZE = 65536
+    BUCKET_SUFFIX = ".bucket"
+    OFFSETS_SUFFIX = ".offsets"
+    OFFSET = struct.Struct("<Q")
+    BLOCKS_SUFFIX = ".blocks"
+    BLOCKS_MAGIC = b"BLKS"
+    BLOCKS_VERSION = 2
+    BLOCKS_HEADER = struct.Struct("<4sBBHIQ")
+    BLOCK_HASH_SIZE = 16
+    # block hash + number of lines
+    BLOCK_RECORD = struct.Struct("<16sI")
+    # 2^BLOCK_BITS lines per block on average
+    BLOCK_BITS = 16
+
+    MAGIC = b"DGST"
+    FORMAT_VERSION = 2
+    FORMAT_VERSIONS = (1, 2)
+    HASH_SIZE = 8
+    # hash algorithm -> id written in the header
+    ALGORITHMS = {"sha256": 0, "blake2b": 1, "xxh128": 2}
+    HASH_FUNCTIONS = {"sha256": sha256_hash, "blake2b": blake2b_hash, "xxh128": xxh128_hash}
+    DEFAULT_ALGORITHM = "blake2b"
+    HEADER = struct.Struct("<4sBBHI")
+    LINE_NUMBER = struct.Struct("<I")
+
+    def __init__(self, buffer_size=BUFFER_SIZE, algorithm=None, workers=1):
+        """
+        :param buffer_size: size of the read buffer
+        :param algorithm: hash algorithm of the lines (Digester.ALGORITHMS),
+                          DEFAULT_ALGORITHM if not given. xxh128 needs the
+                          xxhash package, blake2b is used without it
+        :param workers: number of processes hashing a data file (see
+                        parallel_digest)
+        """
         self.logger = logging.getLogger("digester")
+        self.buffer_size = buffer_size
+        self.workers = workers or 1
+        self.algorithm = algorithm or Digester.DEFAULT_ALGORITHM
+        if self.algorithm not in Digester.ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {self.algorithm}")
+        if self.algorithm == "xxh128" and xxhash is None:
+            self.logger.warning("xxhash not installed, blake2b is used")
+            self.algorithm = "blake2b"
+        self.hash_line = Digester.HASH_FUNCTIONS[self.algorithm]
         self.data = []
 
     @staticmethod
@@ -46,6 +233,86 @@ class Digester:
         else:
             return filename
 
+    @staticmethod
+    def blocks_filename(filename):
+        """
+            Build blocks filename
+        :param filename: data filename
+        :return: built filename
+        """
+        return f"{filename}{Digester.BLOCKS_SUFFIX}"
+
+    @staticmethod
+    def block_hash(raw):
+        return hashlib.blake2b(raw, digest_size=Digester.BLOCK_HASH_SIZE).digest()
+
+    @staticmethod
+    def split_blocks(batch):
+        """
+            Block boundaries in a batch of lines : a block ends after a line
+            whose crc32 has its BLOCK_BITS low bits at zero
+        :param batch: raw lines
+        :return: generator of (start, end, closed) : batch[start:end] belongs
+                 to the current block, closed if the block ends there
+        """
+        mask = (1 << Digester.BLOCK_BITS) - 1
+        crcs = numpy.fromiter(map(zlib.crc32, batch), dtype="<u4", count=len(batch))
+        start = 0
+        for end in (numpy.flatnonzero((crcs & mask) == 0) + 1).tolist():
+            yield start, end, True
+            start = end
+        if start < len(batch):
+            yield start, len(batch), False
+
+    @staticmethod
+    def file_hash(blocks, size):
+        """
+            Hash of a whole data file
+        :param blocks: hashes of its blocks
+        :param size: size of the file
+        :return: hash (bytes)
+        """
+        return Digester.block_hash(b"".join(blocks) + Digester.OFFSET.pack(size))
+
+    @staticmethod
+    def offsets_filename(filename):
+        """
+            Build offsets filename
+        :param filename: data filename
+        :return: built filename
+        """
+        return f"{filename}{Digester.OFFSETS_SUFFIX}"
+
+    @staticmethod
+    def record_dtype(hash_size=HASH_SIZE):
+        """
+            numpy type of a digest record. Hashes are compared as unsigned big
+            endian integers when possible, which keeps the order of the file
+        :param hash_size: size of the hash in bytes
+        :return: numpy dtype
+        """
+        hash_type = ">u8" if hash_size == 8 else f"S{hash_size}"
+        return numpy.dtype([("hash", hash_type), ("line", "<u4")])
+
+    @staticmethod
+    def to_records(digest):
+        """
+            Digest map as a numpy structured array sorted by hash
+        :param digest: digest map (DigestFile or dict hash -> line), or records
+        :return: numpy array
+        """
+        if isinstance(digest, numpy.ndarray):
+            return digest
+        if isinstance(digest, DigestFile):
+            return digest.records
+
+        hash_size = len(next(iter(digest))) if digest else Digester.HASH_SIZE
+        records = numpy.frombuffer(
+            b"".join(h + Digester.LINE_NUMBER.pack(n) for h, n in digest.items()),
+            dtype=Digester.record_dtype(hash_size),
+        )
+        return records[numpy.argsort(records["hash"], kind="stable")]
+
     def digest(self, filename):
         """
             Make a digest file according to the data filename
@@ -55,50 +322,619 @@ class Digester:
         shfn = self.sha_filename(filename)
 
         if os.path.exists(os.path.abspath(shfn)):
-            self.load_data(filename)
-            return self.load_digest(shfn)
+            try:
+                digest = self.load_digest(shfn)
+                self.load_data(filename)
+                return digest
+            except ValueError as err:
+                self.logger.info(f"Digest made again : {err}")
+        return self.make_digest(filename)
+
+    def read_lines(self, filename):
+        """
+            Read raw lines of a data file, through a buffer of buffer_size bytes
+        :param filename: data filename
+        :return: generator of raw lines (bytes)
+        """
+        with open(filename, "rb", buffering=self.buffer_size) as fin:
+            yield from fin
+
+    def read_blocks(self, filename):
+        """
+            Read the blocks of a data file (see split_blocks)
+        :param filename: data filename
+        :return: generator of blocks (lists of raw lines)
+        """
+        lines = self.read_lines(filename)
+        block = []
+        while True:
+            batch = list(itertools.islice(lines, Digester.BATCH_SIZE))
+            if not batch:
+                break
+            for start, end, closed in Digester.split_blocks(batch):
+                block.extend(batch[start:end])
+                if closed:
+                    yield block
+                    block = []
+        if block:
+            yield block
+
+    def hash_batches(self, lines):
+        """
+            Hash lines by batches of BATCH_SIZE lines : the hash function is
+            mapped over a batch, records and offsets are made by numpy
+        :param lines: raw lines
+        :return: generator of (raw lines, records, offsets). The offsets of a
+                 batch are the start of each line followed by the end of the last one
+        """
+        lines = iter(lines)
+        line_number = 0
+        offset = 0
+        while True:
+            batch = list(itertools.islice(lines, Digester.BATCH_SIZE))
+            if not batch:
+                return
+            records = numpy.empty(len(batch), dtype=Digester.record_dtype())
+            records["hash"] = numpy.frombuffer(
+                b"".join(map(self.hash_line, batch)), dtype=records.dtype["hash"]
+            )
+            records["line"] = numpy.arange(line_number, line_number + len(batch))
+            offsets = numpy.empty(len(batch) + 1, dtype="<u8")
+            offsets[0] = offset
+            numpy.cumsum(
+                numpy.fromiter(map(len, batch), dtype="<u8", count=len(batch)),
+                out=offsets[1:],
+            )
+            offsets[1:] += offset
+            yield batch, records, offsets
+            line_number += len(batch)
+            offset = int(offsets[-1])
+
+    def iter_digest_batches(self, filename, lines=None):
+        """
+            Digest the lines of the data file by batches (see hash_batches).
+            The digest and offsets files are written once all the lines are read
+
+        :param filename: data filename
+        :param lines: raw lines of the data file, if they come from another
+                      source than the file itself (ex: zip member)
+        :return: generator of (raw lines, records, offsets)
+        """
+        self.logger.info("Stream digest :> %s" % filename)
+
+        if lines is None:
+            lines = self.read_lines(filename)
+
+        records = [numpy.empty(0, dtype=Digester.record_dtype())]
+        starts = []
+        end = numpy.zeros(1, dtype="<u8")
+        blocks = BlockHasher()
+        try:
+            for batch, batch_records, batch_offsets in self.hash_batches(lines):
+                records.append(batch_records)
+                starts.append(batch_offsets[:-1].tobytes())
+                end = batch_offsets[-1:]
+                blocks.update(batch)
+                yield batch, batch_records, batch_offsets
+        except OSError as oserr:
+            self.logger.error(f"Error while loading {filename} : {str(oserr)}")
+            blocks = None
+
+        self.write_digest(self.sha_filename(filename), numpy.concatenate(records))
+        self.write_offsets(self.offsets_filename(filename), starts + [end.tobytes()])
+        if blocks is not None:
+            self.write_blocks(filename, blocks.finish())
+
+    def iter_digest(self, filename, lines=None):
+        """
+            Digest each line of the data file.
+            The digest file is written once all the lines are read
+
+        :param filename: data filename
+        :param lines: raw lines of the data file, if they come from another
+                      source than the file itself (ex: zip member)
+        :return: generator of (line number, digest, raw line)
+        """
+        size = Digester.HASH_SIZE
+        for batch, records, _offsets in self.iter_digest_batches(filename, lines):
+            hashes = records["hash"].tobytes()
+            first = int(records["line"][0])
+            for index, line in enumerate(batch):
+                yield first + index, hashes[index * size : (index + 1) * size], line
+
+    def bucket_digest(self, filename, directory, bits, lines=None):
+        """
+            Digest each line of the data file into 2^bits bucket files, by hash
+            prefix. Records are written by batches : memory is bounded by the
+            batch size, not by the number of lines. The offsets file is written
+            at the same time
+
+        :param filename: data filename
+        :param directory: directory of the bucket files
+        :param bits: number of bits of the hash prefix
+        :param lines: raw lines, read from filename if not given
+        :return: list of bucket filenames (in hash order), number of lines
+        """
+        self.logger.info(f"Bucket digest :> {filename} ({1 << bits} buckets)")
+
+        if lines is None:
+            lines = self.read_lines(filename)
+
+        bucket_filenames = [
+            os.path.join(directory, f"{b:04x}{Digester.BUCKET_SUFFIX}") for b in range(1 << bits)
+        ]
+        count = 0
+        end = numpy.zeros(1, dtype="<u8")
+        blocks = BlockHasher()
+        buckets = [open(fn, "wb") for fn in bucket_filenames]
+        offsets_filename = self.offsets_filename(filename)
+        offsets_file = open(f"{offsets_filename}.tmp", "wb")
+        try:
+            for batch, records, offsets in self.hash_batches(lines):
+                self.write_buckets(buckets, records, bits)
+                blocks.update(batch)
+                offsets_file.write(offsets[:-1].tobytes())
+                end = offsets[-1:]
+                count += len(batch)
+            offsets_file.write(end.tobytes())
+        finally:
+            for fout in buckets:
+                fout.close()
+            offsets_file.close()
+        os.replace(offsets_file.name, offsets_filename)
+        self.write_blocks(filename, blocks.finish())
+        return bucket_filenames, count
+
+    @staticmethod
+    def write_buckets(buckets, records, bits):
+        """
+            Append records to the bucket files of their hash prefix
+        :param buckets: open bucket files
+        :param records: numpy array of records
+        :param bits: number of bits of the hash prefix
+        :return: -
+        """
+        if len(records) == 0:
+            return
+        prefixes = records["hash"] >> numpy.uint64(64 - bits) if bits else numpy.zeros(
+            len(records), dtype="u8"
+        )
+        order = numpy.argsort(prefixes, kind="stable")
+        bounds = numpy.searchsorted(prefixes[order], numpy.arange(len(buckets) + 1))
+        records = records[order]
+        for b, fout in enumerate(buckets):
+            if bounds[b] < bounds[b + 1]:
+                fout.write(records[bounds[b] : bounds[b + 1]].tobytes())
+
+    def write_digest_header(self, fout, count):
+        """
+            Write the header of a binary digest file
+        :param fout: binary file
+        :param count: number of records
+        :return: -
+        """
+        fout.write(
+            Digester.HEADER.pack(
+                Digester.MAGIC,
+                Digester.FORMAT_VERSION,
+                Digester.HASH_SIZE,
+                Digester.ALGORITHMS[self.algorithm],
+                count,
+            )
+        )
+
+    def write_digest(self, filename, records):
+        """
+            Write a binary digest file
+        :param filename: digest filename
+        :param records: numpy array of records (hash, line)
+        :return: -
+        """
+        # hashes are written big endian, whatever the order of the given array
+        records = records.astype(Digester.record_dtype(), copy=False)
+        records = records[numpy.argsort(records["hash"], kind="stable")]
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wb", buffering=self.buffer_size) as fout:
+            self.write_digest_header(fout, len(records))
+            fout.write(records.tobytes())
+        os.replace(tmp_filename, filename)
+
+    def write_offsets(self, filename, chunks):
+        """
+            Write an offsets file
+        :param filename: offsets filename
+        :param chunks: packed offsets (bytes)
+        :return: -
+        """
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wb", buffering=self.buffer_size) as fout:
+            for chunk in chunks:
+                fout.write(chunk)
+        os.replace(tmp_filename, filename)
+
+    def load_offsets(self, filename):
+        """
+            Byte offsets of the lines of a data file
+        :param filename: data filename
+        :return: numpy array (memory mapped), None if there is no offsets file
+                 or if it does not match the data file (or the data file is missing)
+        """
+        offsets_filename = self.offsets_filename(filename)
+        if (
+            not os.path.exists(filename)
+            or not os.path.exists(offsets_filename)
+            or not os.path.getsize(offsets_filename)
+        ):
+            return None
+        offsets = numpy.memmap(offsets_filename, dtype="<u8", mode="r")
+        if int(offsets[-1]) != os.path.getsize(filename):
+            self.logger.info(f"Offsets of {filename} out of date")
+            return None
+        return offsets
+
+    def write_blocks(self, filename, blocks=None):
+        """
+            Write the blocks file of a data file. The blocks are made while the
+            lines are digested (see BlockHasher), without them they are read
+            from the data file
+        :param filename: data filename
+        :param blocks: list of (block hash, number of lines)
+        :return: -
+        """
+        if not os.path.exists(filename):
+            return
+        if blocks is None:
+            blocks = [
+                (Digester.block_hash(b"".join(block)), len(block))
+                for block in self.read_blocks(filename)
+            ]
+
+        blocks_filename = self.blocks_filename(filename)
+        tmp_filename = f"{blocks_filename}.tmp"
+        with open(tmp_filename, "wb") as fout:
+            fout.write(
+                Digester.BLOCKS_HEADER.pack(
+                    Digester.BLOCKS_MAGIC,
+                    Digester.BLOCKS_VERSION,
+                    Digester.BLOCK_HASH_SIZE,
+                    0,
+                    Digester.BLOCK_BITS,
+                    os.path.getsize(filename),
+                )
+            )
+            fout.write(Digester.file_hash([h for h, _ in blocks], os.path.getsize(filename)))
+            fout.writelines(Digester.BLOCK_RECORD.pack(h, n) for h, n in blocks)
+        os.replace(tmp_filename, blocks_filename)
+
+    def load_blocks(self, filename):
+        """
+            Hashes of the blocks of a data file
+        :param filename: data filename
+        :return: (hash of the whole file, list of (block hash, number of lines)),
+                 None if there is
+                 no blocks file or if it does not match the data file (or the data
+                 file is missing)
+        """
+        blocks_filename = self.blocks_filename(filename)
+        if not os.path.exists(filename) or not os.path.exists(blocks_filename):
+            return None
+        with open(blocks_filename, "rb") as fin:
+            content = fin.read()
+        if len(content) < Digester.BLOCKS_HEADER.size + Digester.BLOCK_HASH_SIZE:
+            return None
+        magic, version, hash_size, _, block_bits, size = Digester.BLOCKS_HEADER.unpack_from(
+            content
+        )
+        records = content[Digester.BLOCKS_HEADER.size + Digester.BLOCK_HASH_SIZE :]
+        if (
+            magic != Digester.BLOCKS_MAGIC
+            or version != Digester.BLOCKS_VERSION
+            or hash_size != Digester.BLOCK_HASH_SIZE
+            or block_bits != Digester.BLOCK_BITS
+            or size != os.path.getsize(filename)
+            or len(records) % Digester.BLOCK_RECORD.size
+        ):
+            self.logger.info(f"Blocks of {filename} not usable")
+            return None
+        return (
+            content[Digester.BLOCKS_HEADER.size : Digester.BLOCKS_HEADER.size + hash_size],
+            list(Digester.BLOCK_RECORD.iter_unpack(records)),
+        )
+
+    def block_digest(self, filename, previous_filename):
+        """
+            Make the digest file of a data file from the digest of the previous
+            one : the blocks of lines found in the previous file take its line
+            digests, only the other blocks are hashed line by line (by the
+            worker processes, with several workers). An identical file is only
+            read once.
+
+        :param filename: data filename
+        :param previous_filename: previous data filename
+        :return: (True if the files are identical, number of blocks hashed),
+                 None if the blocks of the previous file are not known
+        """
+        previous = self.load_blocks(previous_filename)
+        if previous is None and self.load_offsets(previous_filename) is not None:
+            # digest made before the blocks files
+            self.write_blocks(previous_filename)
+            previous = self.load_blocks(previous_filename)
+        if previous is None:
+            return None
+        previous_hash, previous_blocks = previous
+        self.logger.info(f"Block digest :> {filename} (previous {previous_filename})")
+
+        previous_records = Digester.to_records(self.load_hashes(previous_filename))
+        previous_hashes = numpy.empty(len(previous_records), dtype=">u8")
+        previous_hashes[previous_records["line"]] = previous_records["hash"]
+        # block hash -> first line of the block in the previous file
+        previous_lines = {}
+        line_number = 0
+        for block, count in previous_blocks:
+            previous_lines.setdefault(block, line_number)
+            line_number += count
+
+        hashes, starts, blocks = [numpy.empty(0, dtype=">u8")], [], []
+        offset = 0
+        hashed = 0
+        pool = None
+        if self.workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        # blocks being hashed by the workers, the lines of a few blocks only are kept
+        running = collections.deque()
+        try:
+            for batch in self.read_blocks(filename):
+                raw = b"".join(batch)
+                block = Digester.block_hash(raw)
+                blocks.append((block, len(batch)))
+                if block in previous_lines:
+                    first = previous_lines[block]
+                    hashes.append(previous_hashes[first : first + len(batch)])
+                elif pool is None:
+                    hashes.append(hash_lines(batch, self.algorithm))
+                    hashed += 1
+                else:
+                    running.append(pool.submit(hash_lines, batch, self.algorithm))
+                    hashes.append(running[-1])
+                    hashed += 1
+                    if len(running) > 2 * self.workers:
+                        running.popleft().result()
+                lengths = numpy.fromiter(map(len, batch), dtype="<u8", count=len(batch))
+                starts.append((numpy.cumsum(lengths) - lengths + offset).tobytes())
+                offset += len(raw)
+            hashes = [
+                h.result() if isinstance(h, concurrent.futures.Future) else h for h in hashes
+            ]
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        identical = Digester.file_hash([h for h, _ in blocks], offset) == previous_hash
+        if identical:
+            # same lines : same digest
+            tmp_filename = f"{self.sha_filename(filename)}.tmp"
+            shutil.copyfile(self.sha_filename(previous_filename), tmp_filename)
+            os.replace(tmp_filename, self.sha_filename(filename))
         else:
-            return self.make_digest(filename)
+            hashes = numpy.concatenate(hashes)
+            records = numpy.empty(len(hashes), dtype=Digester.record_dtype())
+            records["hash"] = hashes
+            records["line"] = numpy.arange(len(hashes))
+            self.write_digest(self.sha_filename(filename), records)
+        self.write_offsets(self.offsets_filename(filename), starts + [Digester.OFFSET.pack(offset)])
+        self.write_blocks(filename, blocks)
+
+        self.logger.info(f"{hashed}/{len(blocks)} blocks hashed")
+        return identical, hashed
+
+    def split_ranges(self, filename, parts):
+        """
+            Split a data file into byte ranges, each one starting at a line
+        :param filename: data filename
+        :param parts: number of ranges
+        :return: list of (start, end), empty ranges are removed
+        """
+        size = os.path.getsize(filename)
+        bounds = [0]
+        with open(filename, "rb") as fin:
+            for part in range(1, parts):
+                position = size * part // parts
+                if position <= bounds[-1]:
+                    continue
+                # the range ends after the line containing position - 1
+                fin.seek(position - 1)
+                fin.readline()
+                bounds.append(min(fin.tell(), size))
+        bounds.append(size)
+        return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
 
-    def make_digest(self, filename):
+    def parallel_digest(self, filename):
+        """
+            Make the digest file with several processes : the file is split into
+            line aligned byte ranges, hashed by hash_range. Line numbers and
+            offsets of each range are shifted by the lines and bytes of the
+            previous ones. The blocks are hashed by the workers too, except the
+            blocks across two ranges, read again from the file
+        :param filename: data filename
+        :return: number of lines
+        """
+        ranges = self.split_ranges(filename, self.workers)
+        self.logger.info(f"Parallel digest :> {filename} ({len(ranges)} ranges)")
+
+        parts = []
+        if ranges:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [
+                    pool.submit(hash_range, filename, start, end, self.algorithm, self.buffer_size)
+                    for start, end in ranges
+                ]
+                parts = [future.result() for future in futures]
+
+        hashes = numpy.concatenate([part[0] for part in parts] + [numpy.empty(0, dtype=">u8")])
+        records = numpy.empty(len(hashes), dtype=Digester.record_dtype())
+        records["hash"] = hashes
+        records["line"] = numpy.arange(len(hashes))
+        self.write_digest(self.sha_filename(filename), records)
+
+        offsets = numpy.concatenate(
+            [part[1] + numpy.uint64(start) for part, (start, _end) in zip(parts, ranges)]
+            + [numpy.array([os.path.getsize(filename)], dtype="<u8")]
+        )
+        self.write_offsets(self.offsets_filename(filename), [offsets.tobytes()])
+
+        # a block started in a previous range ends with the first block of the range
+        blocks = []
+        pending = 0
+        for _hashes, _starts, part_blocks, tail in parts:
+            for block, count in part_blocks:
+                if pending:
+                    block, count = None, pending + count
+                    pending = 0
+                blocks.append((block, count))
+            pending += tail
+        line_number = 0
+        with open(filename, "rb", buffering=0) as fin:
+            for index, (block, count) in enumerate(blocks):
+                if block is None:
+                    start = int(offsets[line_number])
+                    end = int(offsets[line_number + count])
+                    blocks[index] = (
+                        Digester.block_hash(os.pread(fin.fileno(), end - start, start)),
+                        count,
+                    )
+                line_number += count
+        self.write_blocks(filename, blocks)
+        return len(records)
+
+    def stream_digest(self, filename, lines=None):
+        """
+            Make the digest file without keeping the lines in memory.
+            With several workers, lines read from filename are hashed in parallel
+        :param filename: data filename
+        :param lines: raw lines, read from filename if not given
+        :return: number of lines
+        """
+        if lines is None and self.workers > 1:
+            return self.parallel_digest(filename)
+
+        count = 0
+        for batch, _records, _offsets in self.iter_digest_batches(filename, lines):
+            count += len(batch)
+        return count
+
+    def make_digest(self, filename, lines=None):
         """
             Build digest map
         :param filename: data filename
+        :param lines: raw lines, read from filename if not given
         :return: digest map
         """
         self.logger.info("Make digest :> %s" % filename)
-        data_sha = {}
         del self.data[:]
 
-        with open(self.sha_filename(filename), "w") as fout:
-            line_number = 0
+        for line_number, digest, line in self.iter_digest(filename, lines):
+            self.data.append(line.decode("utf-8").strip())
+        return self.load_digest(self.sha_filename(filename))
+
+    def load_hashes(self, filename):
+        """
+            Digests of a data file, the raw lines are not loaded.
+            The digest file is made (streaming) if it does not exist, or again
+            if it was made with another hash algorithm
+
+        :param filename: data filename
+        :return: digest map
+        """
+        shfn = self.sha_filename(filename)
+        if os.path.exists(os.path.abspath(shfn)):
             try:
-                with codecs.open(filename, "r", "utf-8") as fin:
-                    for line in fin.readlines():
-                        digest = hashlib.sha256(line.encode("utf8")).hexdigest()
-                        data_sha[digest] = line_number
-                        self.data.append(line.strip())
-                        fout.write("%d:%s\n" % (line_number, digest))
-                        line_number += 1
-            except OSError as oserr:
-                self.logger.error(f"Error while loading {filename} : {str(oserr)}")
-        return data_sha
+                return self.load_digest(shfn)
+            except ValueError as err:
+                self.logger.info(f"Digest made again : {err}")
+        self.stream_digest(filename)
+        return self.load_digest(shfn)
 
     def load_digest(self, filename):
         """
-            Load digest file
+            Load digest file. The format (binary or legacy text) is detected.
+            ValueError is raised if the hash algorithm of the file is not the one
+            of the digester
+
         :param filename:
         :return: digest data
         """
         self.logger.info("Load digest <: %s" % filename)
 
+        with open(filename, "rb") as fin:
+            magic = fin.read(len(Digester.MAGIC))
+
+        if magic == Digester.MAGIC:
+            digest = DigestFile(filename)
+            algorithm = digest.algorithm
+            if algorithm != self.algorithm:
+                digest.close()
+        else:
+            # legacy text format : sha256 only
+            algorithm = "sha256"
+            if algorithm == self.algorithm:
+                digest = self.load_text_digest(filename)
+
+        if algorithm != self.algorithm:
+            raise ValueError(f"{filename} : {algorithm} digest, {self.algorithm} expected")
+        return digest
+
+    def load_text_digest(self, filename):
+        """
+            Load legacy digest file (line:hexdigest)
+        :param filename:
+        :return: digest data, keys truncated like the binary format
+        """
+        self.logger.info("Load legacy digest <: %s" % filename)
+
         data_sha = {}
-        with open(filename, "r") as fin:
-            for line in fin.readlines():
+        with open(filename, "r", buffering=self.buffer_size) as fin:
+            for line in fin:
                 vals = line.strip().split(Digester.CHAR_FIELDS_SEP)
-                data_sha[vals[-1]] = int(vals[0])
+                data_sha[bytes.fromhex(vals[-1])[: Digester.HASH_SIZE]] = int(vals[0])
         return data_sha
 
+    def select_lines(self, filename, line_numbers):
+        """
+            Read some lines of a data file, in one pass
+        :param filename: data filename
+        :param line_numbers: sorted line numbers (0 based)
+        :return: generator of (line number, raw line)
+        """
+        wanted = iter(line_numbers)
+        target = next(wanted, None)
+        for line_number, line in enumerate(self.read_lines(filename)):
+            if target is None:
+                break
+            if line_number == target:
+                yield line_number, line
+                target = next(wanted, None)
+
+    def fetch_lines(self, filename, line_numbers):
+        """
+            Read some lines of a data file. With the offsets file, only these
+            lines are read (positioned reads), otherwise the file is read in one pass
+        :param filename: data filename
+        :param line_numbers: sorted line numbers (0 based)
+        :return: generator of (line number, raw line)
+        """
+        if not len(line_numbers):
+            return
+        offsets = self.load_offsets(filename)
+        if offsets is None:
+            yield from self.select_lines(filename, line_numbers)
+            return
+
+        with open(filename, "rb", buffering=0) as fin:
+            for line_number in line_numbers:
+                line_number = int(line_number)
+                start, end = offsets[line_number], offsets[line_number + 1]
+                yield line_number, os.pread(fin.fileno(), int(end - start), int(start))
+
     def load_data(self, filename):
         """
             Load data file
@@ -109,18 +945,117 @@ class Digester:
         del self.data[:]
 
         try:
-            with codecs.open(filename, "r", "utf-8") as fin:
-                for line in fin.readlines():
-                    self.data.append(line.strip())
+            for line in self.read_lines(filename):
+                self.data.append(line.decode("utf-8").strip())
         except OSError as oserr:
             self.logger.error(f"Error while loading data {str(oserr)}")
 
 
+class BlockHasher:
+    """
+        Blocks of a data file made batch after batch, while its lines are
+        digested : the data file is not read again (see Digester.split_blocks)
+    """
+
+    def __init__(self):
+        self.blocks = []
+        # lines of the block not ended yet
+        self.lines = 0
+        self._hash = hashlib.blake2b(digest_size=Digester.BLOCK_HASH_SIZE)
+
+    def update(self, batch):
+        """
+            Add lines to the blocks
+        :param batch: raw lines
+        :return: -
+        """
+        for start, end, closed in Digester.split_blocks(batch):
+            self._hash.update(b"".join(batch[start:end]))
+            self.lines += end - start
+            if closed:
+                self.close()
+
+    def close(self):
+        self.blocks.append((self._hash.digest(), self.lines))
+        self._hash = hashlib.blake2b(digest_size=Digester.BLOCK_HASH_SIZE)
+        self.lines = 0
+
+    def finish(self):
+        """
+            End the last block
+        :return: list of (block hash, number of lines)
+        """
+        if self.lines:
+            self.close()
+        return self.blocks
+
+
+def hash_lines(lines, algorithm):
+    """
+        Hash lines, in a worker process
+    :param lines: raw lines
+    :param algorithm: hash algorithm
+    :return: hashes (numpy array)
+    """
+    return numpy.frombuffer(
+        b"".join(map(Digester.HASH_FUNCTIONS[algorithm], lines)), dtype=">u8"
+    )
+
+
+def hash_range(filename, start, end, algorithm, buffer_size=Digester.BUFFER_SIZE):
+    """
+        Hash the lines of a byte range of a data file, in a worker process
+    :param filename: data filename
+    :param start: offset of the first line
+    :param end: offset of the end of the last line
+    :param algorithm: hash algorithm
+    :param buffer_size: size of the read buffer
+    :return: hashes, offsets of the lines from start (numpy arrays), blocks
+             ended in the range (the first one may have started in the previous
+             range), number of lines of the block not ended
+    """
+    dig = Digester(buffer_size=buffer_size, algorithm=algorithm)
+    blocks = BlockHasher()
+
+    def range_lines(fin):
+        remaining = end - start
+        for line in fin:
+            yield line
+            remaining -= len(line)
+            if remaining <= 0:
+                break
+
+    hashes = [numpy.empty(0, dtype=">u8")]
+    starts = [numpy.empty(0, dtype="<u8")]
+    with open(filename, "rb", buffering=buffer_size) as fin:
+        fin.seek(start)
+        for batch, records, offsets in dig.hash_batches(range_lines(fin)):
+            hashes.append(records["hash"])
+            starts.append(offsets[:-1])
+            blocks.update(batch)
+        if end >= os.fstat(fin.fileno()).st_size:
+            # the last block ends with the file
+            blocks.finish()
+    return (
+        numpy.concatenate(hashes).astype(">u8"),
+        numpy.concatenate(starts).astype("<u8"),
+        blocks.blocks,
+        blocks.lines,
+    )
+
+
 if __name__ == "__main__":
     loggers = helpers.stdout_logger(["digester"], logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument("file", help="data file")
+    parser.add_argument(
+        "--buffer", type=int, default=Digester.BUFFER_SIZE, help="taille du buffer de lecture"
+    )
+    parser.add_argument(
+        "--algorithm", choices=sorted(Digester.ALGORITHMS), help="algorithme de hachage des lignes"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="nombre de processus de hachage")
     args = parser.parse_args()
 
-    dig = Digester()
-    dig.make_digest(args.file)
+    dig = Digester(buffer_size=args.buffer, algorithm=args.algorithm, workers=args.workers)
+    dig.stream_digest(args.file)
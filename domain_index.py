@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Index of the mail addresses of a data file by domain
+
+    The index is a SQLite database next to the data file (DomainIndex.SUFFIX) :
+     - domains : distinct domains
+     - addresses : distinct addresses of each domain
+     - trigrams : trigrams of the domains, to find the domains containing a
+       string without reading them all
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import logging
+import os.path
+import sqlite3
+
+import digester
+
+
+class DomainIndex:
+    """
+        Addresses of a data file, by domain
+    """
+
+    SUFFIX = ".domains"
+    CHAR_FIELDS_SEP = "|"
+
+    SCHEMA = [
+        "CREATE TABLE domains (id INTEGER PRIMARY KEY, domain TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE addresses (domain_id INTEGER NOT NULL, address TEXT NOT NULL)",
+        "CREATE TABLE trigrams (trigram TEXT NOT NULL, domain_id INTEGER NOT NULL,"
+        " PRIMARY KEY (trigram, domain_id)) WITHOUT ROWID",
+    ]
+    INDEXES = ["CREATE INDEX addresses_domain ON addresses (domain_id, address)"]
+
+    def __init__(self, index_filename):
+        """
+        :param index_filename: index file, made by build
+        """
+        self.logger = logging.getLogger("domain_index")
+        self.index_filename = index_filename
+        # read only : the connection can be used by another thread (server)
+        self.db = sqlite3.connect(
+            f"file:{index_filename}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    @staticmethod
+    def index_filename(data_filename):
+        return f"{data_filename}{DomainIndex.SUFFIX}"
+
+    @staticmethod
+    def trigrams(value):
+        return {value[i : i + 3] for i in range(len(value) - 2)}
+
+    @staticmethod
+    def build(data_filename, names, column):
+        """
+            Make the index of a data file
+        :param data_filename: data file
+        :param names: names of the columns of the file
+        :param column: column of the mail addresses
+        :return: index filename
+        """
+        logger = logging.getLogger("domain_index")
+        index_filename = DomainIndex.index_filename(data_filename)
+        logger.info(f"Index domains of {data_filename} > {index_filename}")
+
+        position = names.index(column)
+        domains = {}
+        lines = digester.Digester().read_lines(data_filename)
+        next(lines, None)
+        for line in lines:
+            values = line.decode("utf-8").split(DomainIndex.CHAR_FIELDS_SEP)
+            if position < len(values):
+                address = values[position].strip().strip('"')
+                if "@" in address:
+                    domains.setdefault(address.split("@")[1], set()).add(address)
+
+        tmp_filename = f"{index_filename}.tmp"
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        db = sqlite3.connect(tmp_filename)
+        with db:
+            for statement in DomainIndex.SCHEMA:
+                db.execute(statement)
+            for domain_id, domain in enumerate(sorted(domains)):
+                db.execute("INSERT INTO domains VALUES (?, ?)", (domain_id, domain))
+                db.executemany(
+                    "INSERT INTO addresses VALUES (?, ?)",
+                    ((domain_id, address) for address in sorted(domains[domain])),
+                )
+                db.executemany(
+                    "INSERT INTO trigrams VALUES (?, ?)",
+                    ((trigram, domain_id) for trigram in DomainIndex.trigrams(domain)),
+                )
+            for statement in DomainIndex.INDEXES:
+                db.execute(statement)
+        db.close()
+        os.replace(tmp_filename, index_filename)
+        return index_filename
+
+    @staticmethod
+    def open(data_filename, names, column):
+        """
+            Index of a data file, made if it does not exist or is older than the file
+        :param data_filename: data file
+        :param names: names of the columns of the file
+        :param column: column of the mail addresses
+        :return: DomainIndex
+        """
+        index_filename = DomainIndex.index_filename(data_filename)
+        if not os.path.exists(index_filename) or os.path.getmtime(
+            index_filename
+        ) < os.path.getmtime(data_filename):
+            DomainIndex.build(data_filename, names, column)
+        return DomainIndex(index_filename)
+
+    def domains(self, pattern):
+        """
+            Domains containing a string
+        :param pattern: string
+        :return: dict domain id -> domain
+        """
+        if len(pattern) < 3:
+            cursor = self.db.execute(
+                "SELECT id, domain FROM domains WHERE instr(domain, ?) > 0", (pattern,)
+            )
+            return dict(cursor.fetchall())
+
+        candidates = None
+        for trigram in self.trigrams(pattern):
+            ids = {
+                row[0]
+                for row in self.db.execute(
+                    "SELECT domain_id FROM trigrams WHERE trigram = ?", (trigram,)
+                )
+            }
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return {}
+
+        found = {}
+        for domain_id in sorted(candidates):
+            domain = self.db.execute(
+                "SELECT domain FROM domains WHERE id = ?", (domain_id,)
+            ).fetchone()[0]
+            if pattern in domain:
+                found[domain_id] = domain
+        return found
+
+    def addresses(self, pattern):
+        """
+            Addresses whose domain contains a string
+        :param pattern: string (ex: chu-rennes)
+        :return: sorted list of addresses
+        """
+        self.logger.debug(f"Search {pattern} in {self.index_filename}")
+        addresses = []
+        for domain_id in self.domains(pattern):
+            addresses.extend(
+                row[0]
+                for row in self.db.execute(
+                    "SELECT address FROM addresses WHERE domain_id = ? ORDER BY address",
+                    (domain_id,),
+                )
+            )
+        return sorted(addresses)
+
+    def close(self):
+        self.db.close()
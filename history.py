@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Storage of the data tracks and of their history
+
+    A track file is published as json :
+        { type : { key : {"date": ..., "value": ...} } }                   (no history)
+        { type : { key : [{"date": ..., "value": ...}, ...] } }            (history)
+
+    Backends :
+     - JsonHistory : the json file is the storage, read and written at each save
+     - SQLiteHistory : values are stored in a SQLite database, indexed on
+       (file, type, key, date). A save only writes the values of the run, the
+       json file is exported from the database for publication
+
+    In memory, a history is a series : dict date -> value. It is published
+    sorted by date, and can be compacted : only the last point of each month
+    is kept for the dates older than a number of months.
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import json
+import logging
+import os.path
+import sqlite3
+from collections import OrderedDict
+
+try:
+    from easy_atom import helpers
+except ImportError:
+    print(f"Erreur import - Atom")
+
+
+def to_series(points):
+    """
+        History as a series
+    :param points: list of {"date": ..., "value": ...}
+    :return: dict date -> value
+    """
+    return {point["date"]: point["value"] for point in points}
+
+
+def to_points(series):
+    """
+        Published form of a series
+    :param series: dict date -> value
+    :return: list of {"date": ..., "value": ...}, sorted by date
+    """
+    return [dict(date=date, value=series[date]) for date in sorted(series)]
+
+
+def compact_before(date, months):
+    """
+        First month whose points are all kept
+    :param date: date of the data (YYYY-MM-DD)
+    :param months: number of months fully kept
+    :return: month (YYYY-MM)
+    """
+    index = int(date[:4]) * 12 + int(date[5:7]) - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def compact(series, before):
+    """
+        Keep only the last point of each month, for the months before a given one
+    :param series: dict date -> value, modified
+    :param before: month (YYYY-MM)
+    :return: -
+    """
+    last = {}
+    for date in series:
+        month = date[:7]
+        if month < before and date > last.get(month, ""):
+            last[month] = date
+    for date in [d for d in series if d[:7] < before and last[d[:7]] != d]:
+        del series[date]
+
+
+class JsonHistory:
+    """
+        Tracks saved directly in their json file
+    """
+
+    def __init__(self, compact_months=None):
+        """
+        :param compact_months: number of months with all their points, one point a
+                               month is kept before. No compaction if None
+        """
+        self.logger = logging.getLogger("history")
+        self.compact_months = compact_months
+
+    def save(self, filename, data, date):
+        """
+            Save data set in filename
+
+        :param filename: filename of the data
+        :param data: data to save (type, values, history_flag)
+        :param date: date of the data
+        :return: -
+        """
+        tracks = helpers.load_json(filename)
+
+        # dtype = data type, e.g. stats, mssante, etc.
+        dtype = data["type"]
+
+        if dtype not in tracks:
+            # create new set
+            tracks[dtype] = {}
+
+        for val in data["values"]:
+            current = tracks[dtype].get(val["key"])
+
+            if data["history_flag"]:
+                # Manage a list of values : value = {'date': '2018-03-23', 'value': 999}
+                # the value of the date is set or replaced (a single structure is
+                # replaced by a new list)
+                series = to_series(current) if isinstance(current, list) else {}
+                series[date] = val["val"]
+                if self.compact_months:
+                    compact(series, compact_before(date, self.compact_months))
+                tracks[dtype][val["key"]] = to_points(series)
+            else:
+                # replace values
+                tracks[dtype][val["key"]] = dict(date=date, value=val["val"])
+
+        helpers.save_json(filename, tracks)
+
+    def export(self, filename):
+        """
+            Nothing to do, the json file is up to date
+        :param filename: filename of the data
+        :return: -
+        """
+        pass
+
+    def names(self):
+        """
+            Names of the track files to export : none, they are up to date
+        :return: list of names
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class SQLiteHistory:
+    """
+        Tracks saved in a SQLite database, exported as json on demand
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            file TEXT NOT NULL,
+            type TEXT NOT NULL,
+            key TEXT NOT NULL,
+            date TEXT NOT NULL,
+            value TEXT,
+            history INTEGER NOT NULL
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS tracks_key_date ON tracks (file, type, key, date)",
+    ]
+
+    def __init__(self, db_filename, compact_months=None):
+        """
+        :param db_filename: SQLite database filename
+        :param compact_months: number of months with all their points in the
+                               exported files, one point a month is exported
+                               before. The database keeps all the points
+        """
+        self.logger = logging.getLogger("history")
+        self.db_filename = db_filename
+        self.compact_months = compact_months
+        self.db = sqlite3.connect(db_filename)
+        with self.db:
+            for statement in SQLiteHistory.SCHEMA:
+                self.db.execute(statement)
+
+    @staticmethod
+    def track_name(filename):
+        """
+            Name of a track file in the database
+        :param filename: filename of the data
+        :return: name
+        """
+        return os.path.basename(filename)
+
+    def known(self, name):
+        return (
+            self.db.execute("SELECT 1 FROM tracks WHERE file = ? LIMIT 1", (name,)).fetchone()
+            is not None
+        )
+
+    def import_json(self, filename):
+        """
+            Import an existing track file (made by JsonHistory) in the database
+        :param filename: filename of the data
+        :return: -
+        """
+        self.logger.info(f"Import tracks {filename}")
+        name = self.track_name(filename)
+        tracks = helpers.load_json(filename)
+        with self.db:
+            for dtype, keys in tracks.items():
+                for key, values in keys.items():
+                    history = isinstance(values, list)
+                    for v in values if history else [values]:
+                        if v is not None:
+                            self.upsert(name, dtype, key, v["date"], v["value"], history)
+
+    def upsert(self, name, dtype, key, date, value, history):
+        """
+            Insert or replace one value. Without history, the value replaces the
+            previous one whatever its date
+        :return: -
+        """
+        value = json.dumps(value)
+        if history:
+            self.db.execute(
+                "DELETE FROM tracks WHERE file = ? AND type = ? AND key = ? AND history = 0",
+                (name, dtype, key),
+            )
+            self.db.execute(
+                "INSERT INTO tracks (file, type, key, date, value, history) VALUES (?, ?, ?, ?, ?, 1)"
+                " ON CONFLICT (file, type, key, date) DO UPDATE SET value = excluded.value",
+                (name, dtype, key, date, value),
+            )
+        else:
+            cursor = self.db.execute(
+                "UPDATE tracks SET date = ?, value = ? WHERE file = ? AND type = ? AND key = ?"
+                " AND history = 0",
+                (date, value, name, dtype, key),
+            )
+            if cursor.rowcount == 0:
+                self.db.execute(
+                    "DELETE FROM tracks WHERE file = ? AND type = ? AND key = ?",
+                    (name, dtype, key),
+                )
+                self.db.execute(
+                    "INSERT INTO tracks (file, type, key, date, value, history) VALUES (?, ?, ?, ?, ?, 0)",
+                    (name, dtype, key, date, value),
+                )
+
+    def save(self, filename, data, date):
+        """
+            Save data set, in one transaction.
+            The existing json file is imported the first time
+
+        :param filename: filename of the data
+        :param data: data to save (type, values, history_flag)
+        :param date: date of the data
+        :return: -
+        """
+        name = self.track_name(filename)
+        if not self.known(name) and os.path.exists(filename):
+            self.import_json(filename)
+
+        with self.db:
+            for val in data["values"]:
+                self.upsert(
+                    name, data["type"], val["key"], date, val["val"], data["history_flag"]
+                )
+
+    def tracks(self, filename):
+        """
+            Content of a track file, in the published json shape.
+            Keys are in the order they were first saved, history in date order
+
+        :param filename: filename of the data
+        :return: dict
+        """
+        tracks = OrderedDict()
+        histories = []
+        last_date = ""
+        cursor = self.db.execute(
+            "SELECT type, key, date, value, history FROM tracks WHERE file = ? ORDER BY id",
+            (self.track_name(filename),),
+        )
+        for dtype, key, date, value, history in cursor:
+            keys = tracks.setdefault(dtype, OrderedDict())
+            if history:
+                if key not in keys:
+                    keys[key] = {}
+                    histories.append((keys, key))
+                keys[key][date] = json.loads(value)
+                last_date = max(last_date, date)
+            else:
+                keys[key] = dict(date=date, value=json.loads(value))
+
+        for keys, key in histories:
+            if self.compact_months:
+                compact(keys[key], compact_before(last_date, self.compact_months))
+            keys[key] = to_points(keys[key])
+        return tracks
+
+    def export(self, filename):
+        """
+            Write the json file of a track file, for publication
+        :param filename: filename of the data
+        :return: -
+        """
+        self.logger.info(f"Export tracks {filename}")
+        helpers.save_json(filename, self.tracks(filename))
+
+    def names(self):
+        """
+            Names of the track files in the database
+        :return: list of names
+        """
+        return [row[0] for row in self.db.execute("SELECT DISTINCT file FROM tracks")]
+
+    def close(self):
+        self.db.close()
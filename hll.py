@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    HyperLogLog : approximate count of distinct values in bounded memory
+
+    2^precision registers of one byte, relative error about 1.04 / sqrt(2^precision)
+    (precision 12 : 4 KB, ~1.6%, precision 14 : 16 KB, ~0.8%)
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import hashlib
+import math
+
+
+class HyperLogLog:
+    """
+        Distinct values counter (estimation)
+    """
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+    HASH_BITS = 64
+
+    def __init__(self, precision=12):
+        """
+        :param precision: number of bits of the register index
+        """
+        if not HyperLogLog.MIN_PRECISION <= precision <= HyperLogLog.MAX_PRECISION:
+            raise ValueError(f"HyperLogLog precision out of range : {precision}")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+        if self.size == 16:
+            self.alpha = 0.673
+        elif self.size == 32:
+            self.alpha = 0.697
+        elif self.size == 64:
+            self.alpha = 0.709
+        else:
+            self.alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    def add(self, value):
+        """
+            Add a value
+        :param value: value (str)
+        :return: -
+        """
+        x = int.from_bytes(
+            hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        bits = HyperLogLog.HASH_BITS - self.precision
+        index = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+            Merge another counter of the same precision (union of the values)
+        :param other: HyperLogLog
+        :return: -
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLog of different precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """
+            Estimation of the number of distinct values
+        :return: estimation
+        """
+        estimate = self.alpha * self.size * self.size / sum(
+            2.0 ** -r for r in self.registers
+        )
+        if estimate <= 2.5 * self.size:
+            # small range : linear counting
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
@@ -11,11 +11,15 @@ __copyright__ = "Copyright 2018, Frederic Laurent"
 __license__ = "MIT"
 
 import argparse
+import json
 import logging
+import os.path
 import sys
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
 
-import pandas
-
+import domain_index
 import practitioner
 from easy_atom import helpers
 
@@ -25,29 +29,151 @@ class App:
         Main App
     """
 
-    def __init__(self, filename):
+    CATEGORY = "Extraction_Correspondance_MSSante"
+
+    def __init__(self, filename=None, config=None):
+        """
+        :param filename: MSSante extract
+        :param config: configuration file of lookout : the extract is the last
+                       one processed (local.data), followed across runs
+        """
         self.logger = logging.getLogger("app")
         self.filename = filename
-
-    def process(self, domain=None):
-        self.logger.debug(f"Search {domain}... (file={self.filename}")
-        # Read data
-        df = pandas.read_csv(
-            self.filename,
-            delimiter="|",
-            names=practitioner.RPPS.KEYS_MSSANTE,
-            header=0,
-            index_col=False,
+        self.config = config
+        self._config_mtime = None
+        self._index = None
+        self._index_key = None
+
+    def current_filename(self):
+        """
+            Extract to search. With a configuration file, it is read again when
+            it changes (new run of lookout)
+        :return: filename
+        """
+        if self.config:
+            mtime = os.path.getmtime(self.config)
+            if mtime != self._config_mtime:
+                properties = helpers.json_to_object(self.config)
+                self.filename = getattr(properties.local.data, App.CATEGORY)
+                self._config_mtime = mtime
+                self.logger.info(f"Extract : {self.filename}")
+        return self.filename
+
+    def index(self):
+        """
+            Domain index of the current extract, kept open between searches and
+            opened again if the extract or its index changed. Exits if no extract
+            was processed yet (null in the configuration)
+        :return: domain_index.DomainIndex
+        """
+        filename = self.current_filename()
+        if not filename:
+            self.logger.error(f"No {App.CATEGORY} extract processed yet ({self.config})")
+            sys.exit(1)
+        index_filename = domain_index.DomainIndex.index_filename(filename)
+        key = (
+            filename,
+            os.path.getmtime(filename),
+            os.path.getmtime(index_filename) if os.path.exists(index_filename) else None,
         )
+        if key != self._index_key:
+            if self._index is not None:
+                self._index.close()
+            self._index = domain_index.DomainIndex.open(
+                filename,
+                practitioner.RPPS.KEYS_MSSANTE,
+                practitioner.RPPS.DOMAIN_COLUMNS[App.CATEGORY],
+            )
+            self._index_key = (filename, key[1], os.path.getmtime(index_filename))
+        return self._index
 
-        df_domain = df[df.adresse_bal.str.match(f".*{domain}.*")]
-        return df_domain.adresse_bal.drop_duplicates().values.tolist()
+    def process(self, domain=None):
+        """
+            Addresses whose domain contains a string. The domain index of the
+            file is made if needed (see lookout, local.domain_index)
+        :param domain: string to search (ex: chu-rennes)
+        :return: sorted list of addresses
+        """
+        self.logger.debug(f"Search {domain}... (file={self.current_filename()}")
+        return self.index().addresses(domain)
+
+    def process_batch(self, domains):
+        """
+            Search several strings
+        :param domains: strings to search, empty ones are ignored
+        :return: ordered dict string -> sorted list of addresses
+        """
+        results = OrderedDict()
+        for domain in domains:
+            domain = domain.strip()
+            if domain and domain not in results:
+                results[domain] = self.process(domain)
+        return results
 
     def display(self, result):
         print(f"{len(result)} valueurs")
         for r in result:
             print(r)
 
+    def display_batch(self, results):
+        for domain, result in results.items():
+            print(f"# {domain}")
+            self.display(result)
+
+    def make_server(self, port, host="127.0.0.1"):
+        """
+            HTTP server answering searches, the index stays open :
+             - GET /?domain=chu-rennes : json list of addresses
+             - POST / (one string per line) : json object string -> addresses
+
+        :param port: port (0 : any free port)
+        :param host: address, local only by default
+        :return: HTTPServer
+        """
+        app = self
+
+        class SearchHandler(BaseHTTPRequestHandler):
+            def send_json(self, data, status=200):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                domain = parse_qs(urlparse(self.path).query).get("domain", [""])[0]
+                if not domain:
+                    self.send_json({"error": "domain ?"}, status=400)
+                    return
+                self.send_json(app.process(domain))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                domains = self.rfile.read(length).decode("utf-8").splitlines()
+                self.send_json(app.process_batch(domains))
+
+            def log_message(self, fmt, *args):
+                app.logger.debug(fmt % args)
+
+        return HTTPServer((host, port), SearchHandler)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+            Answer searches over HTTP until interrupted (see make_server)
+        :param port: port
+        :param host: address
+        :return: -
+        """
+        server = self.make_server(port, host)
+        self.logger.info(f"Serving on {host}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
 
 def main():
     """
@@ -57,10 +183,30 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--domain", help="domaine a chercher")
     parser.add_argument("--txt", help="Fichier texte contenant l'extraction MSSante")
+    parser.add_argument(
+        "--config",
+        help="configuration de lookout : recherche dans la dernière extraction traitée",
+    )
+    parser.add_argument(
+        "--batch", help="fichier des domaines à chercher, un par ligne (- : entrée standard)"
+    )
+    parser.add_argument("--serve", type=int, help="port du serveur HTTP de recherche")
 
     args = parser.parse_args()
-    if args.txt and args.domain:
-        app = App(args.txt)
+    if args.txt or args.config:
+        app = App(args.txt, config=args.config)
+    else:
+        app = None
+
+    if app and args.serve:
+        app.serve(args.serve)
+    elif app and args.batch:
+        if args.batch == "-":
+            app.display_batch(app.process_batch(sys.stdin))
+        else:
+            with open(args.batch, "r") as fin:
+                app.display_batch(app.process_batch(fin))
+    elif app and args.domain:
         result = app.process(args.domain)
         app.display(result)
     else:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+    Rows of a practitioner (identifiant_pp) in the extracted data files
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import argparse
+import logging
+import os.path
+import sys
+from collections import OrderedDict
+
+import key_index
+import practitioner
+from easy_atom import helpers
+
+
+class App:
+    """
+        Main App
+    """
+
+    def __init__(self, filenames=None, config=None):
+        """
+        :param filenames: data files
+        :param config: configuration file of lookout : the data files are the
+                       last ones processed (local.data, categories not processed
+                       yet are null)
+        """
+        self.logger = logging.getLogger("app")
+        self.filenames = filenames or []
+        if config:
+            properties = helpers.json_to_object(config)
+            self.filenames = [fn for fn in properties.local.data if fn]
+            if not self.filenames:
+                self.logger.warning(f"No data file processed yet in {config}")
+        self.indexes = {}
+
+    def index(self, filename):
+        """
+            Key index of a data file, made if needed (see lookout, local.key_index)
+        :param filename: data file
+        :return: (key_index.KeyIndex, names of the columns), None if the file has
+                 no practitioner key
+        """
+        if filename not in self.indexes:
+            names = None
+            for cat, cat_names in practitioner.RPPS.MAPPING.items():
+                if os.path.basename(filename).startswith(f"{cat}_"):
+                    names = cat_names
+            self.indexes[filename] = None
+            if names and practitioner.RPPS.PRACTITIONER_KEY in names:
+                self.indexes[filename] = (
+                    key_index.KeyIndex.open(filename, names, practitioner.RPPS.PRACTITIONER_KEY),
+                    names,
+                )
+        return self.indexes[filename]
+
+    def process(self, identifiant):
+        """
+            Rows of a practitioner
+        :param identifiant: identifiant_pp
+        :return: ordered dict filename -> list of rows (dict column -> value)
+        """
+        self.logger.debug(f"Search {identifiant}...")
+        result = OrderedDict()
+        for filename in self.filenames:
+            index = self.index(filename)
+            if index is None:
+                continue
+            key_idx, names = index
+            result[filename] = [
+                OrderedDict(
+                    zip(names, [v.strip('"') for v in line.split(key_idx.CHAR_FIELDS_SEP)])
+                )
+                for line in key_idx.lookup(identifiant)
+            ]
+        return result
+
+    def display(self, result):
+        for filename, rows in result.items():
+            print(f"# {os.path.basename(filename)} : {len(rows)} ligne(s)")
+            for row in rows:
+                for k, v in row.items():
+                    if v:
+                        print(f"  {k} = {v}")
+                print()
+
+
+def main():
+    """
+        Main : process arguments and start App
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("identifiant", nargs="*", help="identifiant_pp à chercher")
+    parser.add_argument("--txt", nargs="*", help="fichiers texte de l'extraction")
+    parser.add_argument(
+        "--config",
+        help="configuration de lookout : recherche dans les dernières extractions traitées",
+    )
+
+    args = parser.parse_args()
+    if (args.txt or args.config) and args.identifiant:
+        app = App(args.txt, config=args.config)
+        for identifiant in args.identifiant:
+            app.display(app.process(identifiant))
+    else:
+        sys.stdout.write("/!\\ Aucune action définie !\n\n")
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["app", "key_index"], logging.INFO)
+    main()
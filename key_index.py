@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Index of the lines of a data file by key (ex: identifiant_pp)
+
+    The index is a numpy array (KeyIndex.SUFFIX next to the data file) of
+    (key, byte offset of the line), sorted by key. It is memory mapped : a
+    lookup is a binary search and a seek in the data file.
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import logging
+import os.path
+
+import numpy
+
+import digester
+
+
+class KeyIndex:
+    """
+        Byte offsets of the lines of a data file, by key
+    """
+
+    SUFFIX = ".keys"
+    CHAR_FIELDS_SEP = "|"
+
+    def __init__(self, data_filename):
+        """
+        :param data_filename: data file, indexed by build
+        """
+        self.logger = logging.getLogger("key_index")
+        self.data_filename = data_filename
+        self.records = numpy.load(self.index_filename(data_filename), mmap_mode="r")
+        self.keys = self.records["key"]
+
+    @staticmethod
+    def index_filename(data_filename):
+        return f"{data_filename}{KeyIndex.SUFFIX}"
+
+    @staticmethod
+    def build(data_filename, names, key):
+        """
+            Make the index of a data file. The first line (header) is not indexed
+        :param data_filename: data file
+        :param names: names of the columns of the file
+        :param key: name of the key column
+        :return: index filename
+        """
+        logger = logging.getLogger("key_index")
+        index_filename = KeyIndex.index_filename(data_filename)
+        logger.info(f"Index {key} of {data_filename} > {index_filename}")
+
+        position = names.index(key)
+        keys, offsets = [], []
+        offset = 0
+        for line_number, line in enumerate(digester.Digester().read_lines(data_filename)):
+            if line_number > 0:
+                values = line.split(KeyIndex.CHAR_FIELDS_SEP.encode("utf-8"))
+                if position < len(values):
+                    keys.append(values[position].strip().strip(b'"'))
+                    offsets.append(offset)
+            offset += len(line)
+
+        records = numpy.empty(
+            len(keys),
+            dtype=[("key", f"S{max(map(len, keys), default=1)}"), ("offset", "<u8")],
+        )
+        records["key"] = keys
+        records["offset"] = offsets
+        records = records[numpy.argsort(records["key"], kind="stable")]
+
+        tmp_filename = f"{index_filename}.tmp"
+        with open(tmp_filename, "wb") as fout:
+            numpy.save(fout, records)
+        os.replace(tmp_filename, index_filename)
+        return index_filename
+
+    @staticmethod
+    def open(data_filename, names, key):
+        """
+            Index of a data file, made if it does not exist or is older than the file
+        :param data_filename: data file
+        :param names: names of the columns of the file
+        :param key: name of the key column
+        :return: KeyIndex
+        """
+        index_filename = KeyIndex.index_filename(data_filename)
+        if not os.path.exists(index_filename) or os.path.getmtime(
+            index_filename
+        ) < os.path.getmtime(data_filename):
+            KeyIndex.build(data_filename, names, key)
+        return KeyIndex(data_filename)
+
+    def offsets(self, key):
+        """
+            Byte offsets of the lines of a key
+        :param key: key value (str)
+        :return: sorted offsets
+        """
+        value = key.encode("utf-8")
+        if len(value) > self.keys.dtype.itemsize:
+            return []
+        start = numpy.searchsorted(self.keys, value, side="left")
+        end = numpy.searchsorted(self.keys, value, side="right")
+        return sorted(int(o) for o in self.records["offset"][start:end])
+
+    def lookup(self, key):
+        """
+            Lines of a key, read directly at their offset
+        :param key: key value (str)
+        :return: list of lines (str)
+        """
+        lines = []
+        offsets = self.offsets(key)
+        if offsets:
+            with open(self.data_filename, "rb") as fin:
+                for offset in offsets:
+                    fin.seek(offset)
+                    lines.append(fin.readline().decode("utf-8").rstrip("\r\n"))
+        return lines
@@ -12,13 +12,21 @@ __copyright__ = "Copyright 2018, Frederic Laurent"
 __license__ = "MIT"
 
 import argparse
+import concurrent.futures
 import logging
 import os.path
 import sys
+import tempfile
+import zipfile
+import zlib
 
 import differentia
+import digester
+import domain_index
+import key_index
 import info
 import practitioner
+import stats
 
 
 from easy_atom import action
@@ -32,6 +40,10 @@ class App:
     """
 
     DEFAULT_DIR = "default"
+    HTTP_CACHE_SUFFIX = ".http"
+    STATS_STATE_SUFFIX = ".stats.state"
+    # incremental updates of the statistics between two full counts
+    STATS_FULL_EVERY = 12
 
     def __init__(self, config):
         """
@@ -54,13 +66,27 @@ class App:
         self.rss_history = None
         self.stats_filename = None
         self.feed = None
+        self.streaming = False
+        self.diff_memory = None
+        self.digest_algorithm = None
+        self.digest_workers = 1
+        self.workers = 1
+        self.stream_unzip = False
+        self.single_pass = False
+        self.incremental_stats = False
+        self.stats_full_every = App.STATS_FULL_EVERY
+        self.domain_index = False
+        self.key_index = False
 
         self.init_properties()
         self.logger.info(self.properties)
 
         self.init_feed()
 
-        self.rpps_data = practitioner.RPPS(properties=self.properties)
+        self.rpps_data = practitioner.RPPS(
+            properties=self.properties,
+            http_cache_filename=self.http_cache_filename(),
+        )
 
     def config_filename(self, config):
         """
@@ -76,6 +102,16 @@ class App:
             self.logger.info(f"No config file {config}. Using default {cfg_filename}")
         return cfg_filename
 
+    def http_cache_filename(self):
+        """
+            Name of the HTTP cache file, next to the config file
+            ex: conf/config-rpps.json -> conf/config-rpps.http.json
+
+        :return: cache filename
+        """
+        root, ext = os.path.splitext(self.cfg_filename)
+        return f"{root}{App.HTTP_CACHE_SUFFIX}{ext}"
+
     def init_properties(self):
         """
             Loads properties
@@ -124,6 +160,63 @@ class App:
         except AttributeError as attr_err:
             self.logger.info("[config] No RSS history limit (%s)" % attr_err)
 
+        try:
+            self.streaming = self.properties.local.streaming
+        except AttributeError as attr_err:
+            self.logger.info("[config] No streaming diff (%s)" % attr_err)
+
+        try:
+            self.diff_memory = self.properties.local.diff_memory
+        except AttributeError as attr_err:
+            self.logger.info("[config] Diff memory not bounded (%s)" % attr_err)
+
+        try:
+            self.digest_algorithm = self.properties.local.digest_algorithm
+        except AttributeError as attr_err:
+            self.logger.info("[config] Default digest algorithm (%s)" % attr_err)
+
+        try:
+            self.digest_workers = self.properties.local.digest_workers
+        except AttributeError as attr_err:
+            self.logger.info("[config] Lines hashed by a single process (%s)" % attr_err)
+
+        try:
+            self.workers = self.properties.local.workers
+        except AttributeError as attr_err:
+            self.logger.info("[config] Sequential processing (%s)" % attr_err)
+
+        try:
+            self.stream_unzip = self.properties.local.stream_unzip
+        except AttributeError as attr_err:
+            self.logger.info("[config] Unzip before processing (%s)" % attr_err)
+
+        try:
+            self.single_pass = self.properties.local.single_pass
+        except AttributeError as attr_err:
+            self.logger.info("[config] Stats read the data file again (%s)" % attr_err)
+
+        try:
+            self.incremental_stats = self.properties.local.incremental_stats
+        except AttributeError as attr_err:
+            self.logger.info("[config] Stats computed from the whole file (%s)" % attr_err)
+
+        try:
+            self.stats_full_every = self.properties.local.stats_full_every
+        except AttributeError as attr_err:
+            self.logger.info(
+                f"[config] Full stats every {self.stats_full_every} runs ({attr_err})"
+            )
+
+        try:
+            self.domain_index = self.properties.local.domain_index
+        except AttributeError as attr_err:
+            self.logger.info("[config] No domain index (%s)" % attr_err)
+
+        try:
+            self.key_index = self.properties.local.key_index
+        except AttributeError as attr_err:
+            self.logger.info("[config] No practitioner index (%s)" % attr_err)
+
     def init_feed(self):
         """
             Init feed.
@@ -176,7 +269,64 @@ class App:
         self.logger.debug(f"make_diff_index_filename -> {data_filename}")
         return data_filename
 
-    def process(self, zipfile=None):
+    def make_diff_changes_filename(self, fn):
+        """
+            Builds the name of the file of changes classified by key
+        :param fn: original file name
+        :return: changes file name
+        """
+        data_filename = None
+        try:
+            if self.properties.local.save_diff_changes:
+                data_filename = os.path.join(
+                    self.properties.local.storage,
+                    f"changes_{os.path.basename(fn)}.jsonl",
+                )
+                self.data_files.append(data_filename)
+        except AttributeError as attr_err:
+            self.logger.debug(f"[config] Don't save changes ({attr_err}) for {fn} ")
+        self.logger.debug(f"make_diff_changes_filename -> {data_filename}")
+        return data_filename
+
+    def make_stats_state_filename(self, root_fn):
+        """
+            Builds the name of the file keeping the statistics between runs
+        :param root_fn: root name of the data file (category)
+        :return: state file name
+        """
+        return os.path.join(
+            self.properties.local.storage, f"{root_fn}{App.STATS_STATE_SUFFIX}"
+        )
+
+    def load_stats_state(self, root_fn, previous_filename):
+        """
+            Statistics of the previous data file, saved by the last run
+        :param root_fn: root name of the data file (category)
+        :param previous_filename: previous data file
+        :return: stats.LineStats, None if there is no usable state (or if the
+                 removed lines can't be read from the previous data file)
+        """
+        state_fn = self.make_stats_state_filename(root_fn)
+        if not previous_filename or not os.path.exists(state_fn):
+            return None
+        if not os.path.exists(previous_filename):
+            self.logger.info(f"Previous data file {previous_filename} missing : full stats count")
+            return None
+        try:
+            state = stats.LineStats.load(
+                state_fn,
+                practitioner.RPPS.MAPPING[root_fn],
+                practitioner.RPPS.EXTRACT_STATS[root_fn],
+            )
+        except (OSError, ValueError, KeyError) as err:
+            self.logger.warning(f"Stats state {state_fn} not loaded : {err}")
+            return None
+        if state.source != os.path.basename(previous_filename):
+            self.logger.info(f"Stats state {state_fn} is not the one of {previous_filename}")
+            return None
+        return state
+
+    def process(self, zip_filename=None):
         """
             Download newer file (zip) if available
             Process data
@@ -188,15 +338,15 @@ class App:
              - produce RSS feed if configured
         """
 
-        self.logger.debug(f"Start... (zipfile={zipfile})")
+        self.logger.debug(f"Start... (zip_filename={zip_filename})")
         try:
             _zip = None
-            if zipfile:
+            if zip_filename:
                 # use arg filename, local file
-                if not os.path.exists(zipfile):
-                    self.logger.error(f"File {zipfile} not found !")
+                if not os.path.exists(zip_filename):
+                    self.logger.error(f"File {zip_filename} not found !")
                     sys.exit(1)
-                _zip = zipfile
+                _zip = zip_filename
             else:
                 # download new file if available
                 _zip = self.rpps_data.retrieve_current()
@@ -206,61 +356,31 @@ class App:
             if _zip and self.rpps_data.is_newer(_zip):
                 self.logger.debug(f"Unzip data file : {_zip}")
 
-                info_blocks = []
-                for _new_data_file in self.rpps_data.unzip(
-                    _zip, self.properties.local.storage
-                ):
-                    # compute file
-                    self.logger.info(f"Compute file {_new_data_file} ")
-                    # get root name
-                    _root_fn = self.rpps_data.root_data_filename(
-                        os.path.basename(_new_data_file)
+                if self.stream_unzip:
+                    # files are extracted while they are processed
+                    _data_files = self.rpps_data.zip_members(
+                        _zip, self.properties.local.storage
                     )
-                    # get previous filename
-                    _previous = self.previous_filename[_root_fn]
-
-                    self.logger.debug(f"File type : {_root_fn} - previous {_previous}")
-                    # compute diff
-                    diff = differentia.Diff(
-                        _previous, storage_dir=self.properties.local.storage
+                else:
+                    _data_files = self.rpps_data.unzip(
+                        _zip, self.properties.local.storage
                     )
-                    diff_list = diff.find_diff(os.path.abspath(_new_data_file))
-                    self.logger.info(f"Diff count : {len(diff_list)}")
+                # get the date included in the filename
+                _remote_fn, _date = self.rpps_data.extract_data_filename(_zip)
+                self.rpps_data.set_data_date(self.rpps_data.parse_date(_date))
 
+                info_blocks = []
+                for _root_fn, data_tracks in self.process_files(_zip, _data_files):
                     # update last computed file
-                    self.previous_filename[_root_fn] = _new_data_file
-
-                    # get the date included in the filename
-                    _remote_fn, _date = self.rpps_data.extract_data_filename(_zip)
-                    self.rpps_data.set_data_date(self.rpps_data.parse_date(_date))
-                    # extract informations
-                    data_tracks = {
-                        "filename": _new_data_file,
-                        "diff_data_filename": self.make_diff_data_filename(
-                            _new_data_file
-                        ),
-                        "diff_index_filename": self.make_diff_index_filename(
-                            _new_data_file
-                        ),
-                        "date": self.rpps_data.data_date,
-                        "tracks": self.rpps_data.extract_data(
-                            _new_data_file, diff_list
-                        ),
-                    }
-                    self.logger.debug(f"data_tracks {data_tracks}")
-
-                    self.rpps_data.save_diff_files(
-                        data_tracks["diff_data_filename"],
-                        data_tracks["diff_index_filename"],
-                        diff_list,
-                    )
+                    self.previous_filename[_root_fn] = data_tracks["filename"]
                     info_blocks.append(data_tracks)
 
                     # add tracks file names in produced data files
                     self.logger.debug(f"Data files : {self.rpps_data.data_files}")
                     self.logger.debug(f"Data tracks : {data_tracks}")
 
-                    lst = self.rpps_data.save_tracks(data_tracks)
+                    # the saved files are published with the run (RSS, upload)
+                    lst = self.rpps_data.save_tracks(data_tracks, export=True)
                     self.data_files.extend(lst)
 
                 # update RSS
@@ -277,6 +397,175 @@ class App:
 
         except AttributeError as attr_err:
             self.logger.info(f"[config] Wrong/No data file name : {attr_err}")
+        except (zipfile.BadZipFile, zlib.error) as zip_err:
+            self.logger.error(f"Zip ERROR : {zip_err}")
+
+    def process_files(self, zip_filename, data_filenames):
+        """
+            Process the extracted files, one after another or in a pool of
+            processes (local.workers > 1). Results are given in the order of
+            the files.
+
+        :param zip_filename: zip file containing the data files
+        :param data_filenames: extracted data files
+        :return: generator of (root name, data tracks)
+        """
+        if self.workers > 1 and len(data_filenames) > 1:
+            self.logger.info(f"Process {len(data_filenames)} files, {self.workers} workers")
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(self.workers, len(data_filenames))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        process_file_worker,
+                        self.cfg_filename,
+                        zip_filename,
+                        _new_data_file,
+                        self.previous_filename,
+                    )
+                    for _new_data_file in data_filenames
+                ]
+                for future in futures:
+                    _root_fn, data_tracks, data_files, rpps_files = future.result()
+                    self.data_files.extend(data_files)
+                    self.rpps_data.data_files.extend(rpps_files)
+                    yield _root_fn, data_tracks
+        else:
+            for _new_data_file in data_filenames:
+                yield self.process_file(zip_filename, _new_data_file)
+
+    def process_file(self, zip_filename, data_filename):
+        """
+            Process one extracted data file
+             - extract it from the zip file if local.stream_unzip is set
+             - compute diff (and changes if configured), and the statistics
+               in the same pass if local.single_pass is set
+             - if local.incremental_stats is set, update the statistics of the
+               previous file with the diff, with a full count every
+               local.stats_full_every runs to check them
+             - extract data
+             - save diff files
+             - index the mail addresses by domain if local.domain_index is set
+             - index the lines by identifiant_pp if local.key_index is set
+
+        :param zip_filename: zip file containing the data file
+        :param data_filename: extracted data file
+        :return: root name of the file, data tracks
+        """
+        # compute file
+        self.logger.info(f"Compute file {data_filename} ")
+        # get root name
+        _root_fn = self.rpps_data.root_data_filename(os.path.basename(data_filename))
+        # get previous filename
+        _previous = self.previous_filename[_root_fn]
+
+        self.logger.debug(f"File type : {_root_fn} - previous {_previous}")
+        # compute diff
+        diff = differentia.Diff(
+            _previous,
+            storage_dir=self.properties.local.storage,
+            streaming=self.streaming,
+            memory_limit=self.diff_memory * 1024 * 1024 if self.diff_memory else None,
+            algorithm=self.digest_algorithm,
+            digest_workers=self.digest_workers,
+        )
+        _lines = None
+        if self.stream_unzip:
+            # decompress, check, digest and write the file in one pass
+            _lines = self.rpps_data.stream_member(zip_filename, data_filename)
+
+        _stats = None
+        _state = None
+        _precision = self.rpps_data.distinct_precision(_root_fn)
+        _incremental = (
+            self.incremental_stats
+            and _root_fn in practitioner.RPPS.EXTRACT_STATS
+            and _precision is None
+        )
+        if _incremental:
+            _state = self.load_stats_state(_root_fn, _previous)
+            if _state is not None and _state.runs >= self.stats_full_every:
+                self.logger.info(f"Full stats count, after {_state.runs} updates")
+            elif _state is not None:
+                _stats = _state
+
+        if (
+            (self.single_pass or _incremental)
+            and _stats is None
+            and _root_fn in practitioner.RPPS.EXTRACT_STATS
+        ):
+            # statistics are aggregated while the lines are digested
+            _stats = stats.LineStats(
+                practitioner.RPPS.MAPPING[_root_fn],
+                practitioner.RPPS.EXTRACT_STATS[_root_fn],
+                precision=_precision,
+            )
+            if _lines is None:
+                _lines = digester.Digester().read_lines(data_filename)
+            _lines = _stats.scan(_lines)
+
+        diff_list = diff.find_diff(os.path.abspath(data_filename), _lines)
+        self.logger.info(f"Diff count : {len(diff_list)}")
+
+        if _state is not None:
+            _state.apply_diff(
+                (text for _, num, text in diff_list if num > 1),
+                (text for _, text in diff.removed_lines()),
+            )
+            if _stats is not _state and _stats.snapshot() != _state.snapshot():
+                self.logger.warning(
+                    f"Incremental stats of {_root_fn} differ from the full count, replaced"
+                )
+        if _incremental:
+            _stats.source = os.path.basename(data_filename)
+            _stats.save(self.make_stats_state_filename(_root_fn))
+
+        _changes_fn = self.make_diff_changes_filename(data_filename)
+        if _changes_fn:
+            diff.save_changes(
+                diff.find_changes(
+                    diff_list,
+                    practitioner.RPPS.MAPPING[_root_fn],
+                    practitioner.RPPS.RECORD_KEY[_root_fn],
+                ),
+                _changes_fn,
+            )
+
+        # get the date included in the filename
+        _remote_fn, _date = self.rpps_data.extract_data_filename(zip_filename)
+        self.rpps_data.set_data_date(self.rpps_data.parse_date(_date))
+        # extract informations
+        data_tracks = {
+            "filename": data_filename,
+            "diff_data_filename": self.make_diff_data_filename(data_filename),
+            "diff_index_filename": self.make_diff_index_filename(data_filename),
+            "date": self.rpps_data.data_date,
+            "tracks": self.rpps_data.extract_data(data_filename, diff_list, _stats),
+        }
+        self.logger.debug(f"data_tracks {data_tracks}")
+
+        self.rpps_data.save_diff_files(
+            data_tracks["diff_data_filename"],
+            data_tracks["diff_index_filename"],
+            diff_list,
+        )
+
+        if self.domain_index and _root_fn in practitioner.RPPS.DOMAIN_COLUMNS:
+            domain_index.DomainIndex.build(
+                data_filename,
+                practitioner.RPPS.MAPPING[_root_fn],
+                practitioner.RPPS.DOMAIN_COLUMNS[_root_fn],
+            )
+        if (
+            self.key_index
+            and practitioner.RPPS.PRACTITIONER_KEY in practitioner.RPPS.MAPPING[_root_fn]
+        ):
+            key_index.KeyIndex.build(
+                data_filename,
+                practitioner.RPPS.MAPPING[_root_fn],
+                practitioner.RPPS.PRACTITIONER_KEY,
+            )
+        return _root_fn, data_tracks
 
     def make_rss(self, info_blocks):
         """
@@ -310,6 +599,128 @@ class App:
             self.feed.save(result)
             self.feed.rss2()
 
+    def is_tracked(self, data_filename):
+        """
+            Test if tracks are configured for the category of a data file
+        :param data_filename: data file name
+        :return: True if the file has tracks
+        """
+        _root_fn = self.rpps_data.root_data_filename(os.path.basename(data_filename))
+        return _root_fn in getattr(self.rpps_data.tracks, "_fields", ())
+
+    def backfill_sources(self, directory):
+        """
+            Archived data files of a directory : zip files, and text files that
+            don't come from one of these zip files (same date). The files next to
+            a text file (digest, cache) are ignored
+        :param directory: directory of archives
+        :return: list of file names, by date
+        """
+        zips, txts = [], []
+        for fn in sorted(os.listdir(directory)):
+            _remote_fn, _date = self.rpps_data.extract_data_filename(fn)
+            if _date is None:
+                continue
+            if fn.endswith(".zip"):
+                zips.append((_date, os.path.join(directory, fn)))
+            elif fn.endswith(".txt") and self.is_tracked(fn):
+                txts.append((_date, os.path.join(directory, fn)))
+
+        zip_dates = {_date for _date, _fn in zips}
+        sources = zips + [(_date, fn) for _date, fn in txts if _date not in zip_dates]
+        return [fn for _date, fn in sorted(sources)]
+
+    def backfill_file(self, filename):
+        """
+            Data tracks of an archived data file (zip or txt), with the extractors
+            of RPPS.extract_data. Files are not compared : there is no diff, and the
+            statistics are aggregated while the file is read (decompressed) once.
+            A text file with a columnar cache (RPPS.read_data) is not read : its
+            statistics are computed from the cache
+
+        :param filename: zip or text file
+        :return: list of data tracks
+        """
+        self.logger.info(f"Backfill {filename}")
+        _remote_fn, _date = self.rpps_data.extract_data_filename(os.path.basename(filename))
+        self.rpps_data.set_data_date(self.rpps_data.parse_date(_date))
+
+        backfilled = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if filename.endswith(".zip"):
+                data_filenames = self.rpps_data.zip_members(filename, tmpdir)
+            else:
+                data_filenames = [filename]
+
+            for data_filename in filter(self.is_tracked, data_filenames):
+                _root_fn = self.rpps_data.root_data_filename(os.path.basename(data_filename))
+                if filename.endswith(".zip"):
+                    _lines = self.rpps_data.stream_member(filename, data_filename)
+                else:
+                    _lines = digester.Digester().read_lines(data_filename)
+
+                _stats = None
+                if not filename.endswith(".zip") and os.path.exists(
+                    practitioner.RPPS.cache_filename(data_filename)
+                ):
+                    self.logger.info(f"Backfill from the cache of {data_filename}")
+                elif _root_fn in practitioner.RPPS.EXTRACT_STATS:
+                    _stats = stats.LineStats(
+                        practitioner.RPPS.MAPPING[_root_fn],
+                        practitioner.RPPS.EXTRACT_STATS[_root_fn],
+                        precision=self.rpps_data.distinct_precision(_root_fn),
+                    )
+                    _lines = _stats.scan(_lines)
+                if filename.endswith(".zip") or _stats is not None:
+                    # extract the file and/or aggregate the statistics
+                    for _line in _lines:
+                        pass
+
+                backfilled.append(
+                    {
+                        "filename": data_filename,
+                        "date": self.rpps_data.data_date,
+                        "tracks": self.rpps_data.extract_data(data_filename, None, _stats),
+                    }
+                )
+        return backfilled
+
+    def backfill(self, directory):
+        """
+            Rebuild the history of the tracks from a directory of archived data
+            files (zip or txt, dated by their name). Files are processed in a pool
+            of processes (local.workers > 1), results are saved in date order
+
+        :param directory: directory of archives
+        :return: -
+        """
+        sources = self.backfill_sources(directory)
+        self.logger.info(f"Backfill {len(sources)} files, {self.workers} workers")
+
+        backfilled = []
+        if self.workers > 1 and len(sources) > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(self.workers, len(sources))
+            ) as executor:
+                futures = [
+                    executor.submit(backfill_worker, self.cfg_filename, filename)
+                    for filename in sources
+                ]
+                for future in futures:
+                    backfilled.extend(future.result())
+        else:
+            for filename in sources:
+                backfilled.extend(self.backfill_file(filename))
+
+        saved = []
+        for data_tracks in sorted(backfilled, key=lambda d: d["date"]):
+            for filename in self.rpps_data.save_tracks(data_tracks):
+                if filename not in saved:
+                    saved.append(filename)
+        for filename in saved:
+            self.rpps_data.history.export(filename)
+        self.data_files.extend(saved)
+
     def statistics(self, txtfile):
         """
             Give some statistics (via log)
@@ -354,6 +765,15 @@ class App:
         new_props = self.properties._replace(local=new_local_section)
         helpers.object_to_json(new_props, self.cfg_filename)
 
+    def export_tracks(self):
+        """
+            Export the track files (json) from the history storage
+        :return: -
+        """
+        lst = self.rpps_data.export_tracks()
+        self.logger.info(f"Exported tracks : {lst}")
+        self.data_files.extend(lst)
+
     def upload_data(self, config):
         """
             Upload data files, according to parameters in config
@@ -379,6 +799,35 @@ class App:
         act.process([self.feed.feed_filename, self.feed.rss2_filename])
 
 
+def process_file_worker(config, zip_filename, data_filename, previous_filename):
+    """
+        Process one data file in a worker process.
+        Configuration objects can't be pickled : the App is built again from
+        the configuration file
+
+    :param config: configuration file name
+    :param zip_filename: zip file containing the data file
+    :param data_filename: extracted data file
+    :param previous_filename: previous data file names, by root name
+    :return: root name, data tracks, produced files (app and RPPS)
+    """
+    app = App(config)
+    app.previous_filename.update(previous_filename)
+    _root_fn, data_tracks = app.process_file(zip_filename, data_filename)
+    return _root_fn, data_tracks, app.data_files, app.rpps_data.data_files
+
+
+def backfill_worker(config, filename):
+    """
+        Data tracks of an archived data file, in a worker process
+    :param config: configuration file name
+    :param filename: zip or text file
+    :return: list of data tracks
+    """
+    app = App(config)
+    return app.backfill_file(filename)
+
+
 def main():
     """
         Main : process arguments and start App
@@ -401,6 +850,15 @@ def main():
     )
 
     parser.add_argument("--stat", help="Affiche les stats")
+    parser.add_argument(
+        "--backfill",
+        help="Répertoire de fichiers d'extraction archivés (zip ou txt) : reconstruit l'historique des suivis",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Exporte les fichiers de suivi depuis l'historique",
+    )
 
     args = parser.parse_args()
     if args.config:
@@ -409,6 +867,15 @@ def main():
         if args.stat and args.txt and os.path.exists(args.txt):
             app.statistics(args.txt)
 
+        elif args.backfill and os.path.isdir(args.backfill):
+            app.backfill(args.backfill)
+
+        elif args.export:
+            app.export_tracks()
+
+            if args.dataftp and os.path.exists(args.dataftp):
+                app.upload_data(args.dataftp)
+
         else:
             app.process(args.zip)
 
@@ -10,30 +10,51 @@ __copyright__ = "Copyright 2017, Frederic Laurent"
 __license__ = "MIT"
 
 
+import io
 import logging
 import os.path
 import pprint
 import re
+import shutil
 import tempfile
 import zipfile
-from collections import OrderedDict
+import zlib
 from datetime import datetime as dt
 import codecs
 
 import pandas
 import requests
 
+import history
+import stats
+
 try:
     from easy_atom import helpers
 except ImportError:
     print(f"Erreur import - Atom")
 
+try:
+    # optional : parquet engine of pandas, used to cache parsed data files,
+    # and fast csv reader
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 class RPPS:
     """
         Handle RPPS Data
     """
 
     PEM = "cert/asiproot.pem"
+    BUFFER_SIZE = 4 * 1024 * 1024
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    DOWNLOAD_RETRIES = 5
+    HTTP_TIMEOUT = 60
+    PART_SUFFIX = ".part"
+    CACHE_SUFFIX = ".parquet"
+    HISTORY_DB = "history.db"
     KEYS_PERS_ACT = [
         "type_identifiant_pp",
         "identifiant_pp",
@@ -155,7 +176,65 @@ class RPPS:
         "Extraction_Correspondance_MSSante": KEYS_MSSANTE,
     }
 
-    def __init__(self, properties):
+    # key of the records, used to classify changes (added/removed/modified)
+    RECORD_KEY = {
+        "PS_LibreAcces_Dipl_AutExerc": "identifiant_pp",
+        "PS_LibreAcces_Personne_activite": "identifiant_pp",
+        "PS_LibreAcces_SavoirFaire": "identifiant_pp",
+        "Extraction_Correspondance_MSSante": "adresse_bal",
+    }
+
+    # columns read by the extractors, and their types (str if not given)
+    EXTRACT_COLUMNS = {
+        "PS_LibreAcces_Dipl_AutExerc": {
+            "identifiant_pp": "str",
+            "code_diplome": "category",
+        },
+        "PS_LibreAcces_Personne_activite": {
+            "type_identifiant_pp": "category",
+            "identifiant_technique_structure": "str",
+        },
+        "PS_LibreAcces_SavoirFaire": {
+            "code_profession": "category",
+        },
+        "Extraction_Correspondance_MSSante": {
+            "type_bal": "category",
+            "adresse_bal": "str",
+            "libelle_profession": "category",
+        },
+    }
+
+    # aggregations needed by the extractors, when statistics are computed
+    # line by line (stats.LineStats)
+    EXTRACT_STATS = {
+        "PS_LibreAcces_Dipl_AutExerc": {
+            "distinct": ["identifiant_pp", "code_diplome"],
+        },
+        "PS_LibreAcces_Personne_activite": {
+            "value_counts": ["type_identifiant_pp"],
+            "distinct": ["identifiant_technique_structure"],
+        },
+        "PS_LibreAcces_SavoirFaire": {
+            "distinct": ["code_profession"],
+        },
+        "Extraction_Correspondance_MSSante": {
+            "value_counts": ["type_bal", "libelle_profession"],
+            "domains": ["adresse_bal"],
+        },
+    }
+
+    # practitioner key, indexed in the files having it (key_index.KeyIndex)
+    PRACTITIONER_KEY = "identifiant_pp"
+
+    # columns of mail addresses, indexed by domain (domain_index.DomainIndex)
+    DOMAIN_COLUMNS = {"Extraction_Correspondance_MSSante": "adresse_bal"}
+
+    def __init__(self, properties, http_cache_filename=None):
+        """
+        :param properties: properties object
+        :param http_cache_filename: file keeping the HTTP metadata of the remote
+                                    file between runs (no persistence if None)
+        """
         self.logger = logging.getLogger("downloader")
         self.local_storage = tempfile.gettempdir()
         self.tracks = {}
@@ -165,7 +244,19 @@ class RPPS:
         self.re_rpps_fn = re.compile(".*?(PS_LibreAcces_Personne_activite_(\d+).(txt))")
         self.re_enddate = re.compile("(.*?)_(\d{12})\.(txt|zip)")
         self.data_date = dt.now().strftime("%Y-%m-%d")
+        self.download_chunk_size = RPPS.DOWNLOAD_CHUNK_SIZE
+        self.download_retries = RPPS.DOWNLOAD_RETRIES
+        self.csv_engine = None
+        self.session = requests.Session()
+        self.session.verify = os.path.abspath(RPPS.PEM)
+        self.http_cache_filename = http_cache_filename
+        self.http_cache = {}
+        self.history_backend = "json"
+        self.history_db = None
+        self.history_compact_months = None
         self.init_properties(properties)
+        self.load_http_cache()
+        self.history = self.make_history()
 
     def init_properties(self, properties):
         """
@@ -195,29 +286,128 @@ class RPPS:
         except AttributeError as ae:
             self.logger.warning(f"[config] No/Wrong tracks properties : {ae}")
 
+        try:
+            self.download_chunk_size = properties.local.download_chunk_size
+        except AttributeError as ae:
+            self.logger.debug(f"[config] Default download chunk size : {ae}")
+
+        try:
+            self.download_retries = properties.local.download_retries
+        except AttributeError as ae:
+            self.logger.debug(f"[config] Default download retries : {ae}")
+
+        try:
+            self.csv_engine = properties.local.csv_engine
+        except AttributeError as ae:
+            self.logger.debug(f"[config] Default csv engine : {ae}")
+
+        try:
+            self.history_backend = properties.local.history_backend
+        except AttributeError as ae:
+            self.logger.debug(f"[config] Tracks history saved in json files : {ae}")
+
+        try:
+            self.history_db = properties.local.history_db
+        except AttributeError as ae:
+            self.logger.debug(f"[config] Default history database : {ae}")
+
+        try:
+            self.history_compact_months = properties.local.history_compact_months
+        except AttributeError as ae:
+            self.logger.debug(f"[config] History not compacted : {ae}")
+
+    def make_history(self):
+        """
+            Storage of the tracks, according to local.history_backend
+             - json (default) : json files
+             - sqlite : SQLite database (local.history_db, in the storage
+               directory by default), json files are exported by export_tracks
+            local.history_compact_months keeps one point a month in the history
+            older than this number of months
+        :return: history backend
+        """
+        if self.history_backend == "sqlite":
+            db_filename = self.history_db or os.path.join(
+                self.local_storage, RPPS.HISTORY_DB
+            )
+            self.logger.info(f"Tracks history in {db_filename}")
+            return history.SQLiteHistory(
+                db_filename, compact_months=self.history_compact_months
+            )
+        return history.JsonHistory(compact_months=self.history_compact_months)
+
+    def load_http_cache(self):
+        """
+            Load HTTP metadata (ETag, Last-Modified, filename, size) of the last
+            response. The cache is ignored if it was made for another URL
+        :return: -
+        """
+        if self.http_cache_filename and os.path.exists(self.http_cache_filename):
+            cache = helpers.load_json(self.http_cache_filename)
+            if cache.get("url") == self.data_url:
+                self.http_cache = cache
+
+    def save_http_cache(self, headers, filename):
+        """
+            Save HTTP metadata of a response
+        :param headers: response headers
+        :param filename: remote filename
+        :return: -
+        """
+        self.http_cache = {
+            "url": self.data_url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "filename": filename,
+            "size": int(headers["Content-Length"])
+            if headers.get("Content-Length", "").isdigit()
+            else None,
+        }
+        if self.http_cache_filename:
+            helpers.save_json(self.http_cache_filename, self.http_cache)
+
+    def conditional_headers(self):
+        """
+            Headers of a conditional request, built from the HTTP cache
+        :return: dict of headers
+        """
+        headers = {}
+        if self.http_cache.get("etag"):
+            headers["If-None-Match"] = self.http_cache["etag"]
+        if self.http_cache.get("last_modified"):
+            headers["If-Modified-Since"] = self.http_cache["last_modified"]
+        return headers
+
     def find_current_data(self):
         """
             Find the current remote filename
 
-            Make an HEAD request to grab information
+            Make an HEAD request to grab information. The request is conditional
+            if the remote file is known (HTTP cache) : a 304 response gives the
+            cached filename.
 
             HTTPS web site. cert are stored in RPPS.PEM
 
         :return:
             remote_fn : remote zip filename
         """
-        pem_filename = os.path.abspath(RPPS.PEM)
-        req = requests.head(self.data_url, verify=pem_filename)
+        req = self.session.head(
+            self.data_url, headers=self.conditional_headers(), timeout=RPPS.HTTP_TIMEOUT
+        )
 
         _filename = None
 
-        if req.status_code == 200:
+        if req.status_code == 304:
+            _filename = self.http_cache.get("filename")
+            self.logger.info(f"Remote file not modified : {_filename}")
+        elif req.status_code == 200:
             # Content-Disposition': 'attachment; filename=PS_LibreAcces_201808011050.zip'
             regex_filename = re.match(
                 ".*?filename=(.*)", req.headers["Content-Disposition"]
             )
             if regex_filename:
                 _filename = regex_filename.group(1)
+                self.save_http_cache(req.headers, _filename)
         else:
             self.logger.warning(f"Error accessing URL [{req.status_code}] {self.data_url}")
 
@@ -283,6 +473,13 @@ class RPPS:
         self.logger.debug(f"prev date = {self.last_check_date}")
 
         if self.is_newer(_remote_fn):
+            _filename = os.path.join(self.local_storage, _remote_fn)
+            if (
+                os.path.exists(_filename)
+                and os.path.getsize(_filename) == self.http_cache.get("size")
+            ):
+                self.logger.info(f"Newer file already downloaded : {_filename}")
+                return _filename
             self.logger.info("Newer file available -> download")
             # download zip
             return self.download_zip(self.local_storage, _remote_fn)
@@ -291,25 +488,89 @@ class RPPS:
     def unzip(self, zfile, dest_dir):
         """
             Unzip file into destination directory
+            Each member is decompressed once : the CRC is checked by zipfile
+            while the data is written (no separate testzip pass)
         """
-        zipf = zipfile.ZipFile(zfile)
-        testzip = zipf.testzip()
-        if testzip:
-            self.logger.error(f"Zip ERROR : {testzip}")
-            return []
-        else:
-            zipf.extractall(dest_dir)
+        extracted = []
+        with zipfile.ZipFile(zfile) as zipf:
+            for member in self.data_members(zipf):
+                _filename = os.path.join(dest_dir, member)
+                try:
+                    with zipf.open(member) as fin, open(_filename, "wb") as fout:
+                        shutil.copyfileobj(fin, fout, RPPS.BUFFER_SIZE)
+                except (zipfile.BadZipFile, zlib.error) as zip_err:
+                    self.logger.error(f"Zip ERROR : {member} {zip_err}")
+                    for _fn in extracted + [_filename]:
+                        if os.path.exists(_fn):
+                            os.remove(_fn)
+                    return []
+                extracted.append(_filename)
+
+        return extracted
 
-        return list(map(lambda x: os.path.join(dest_dir, x), zipf.namelist()))
+    def data_members(self, zipf):
+        """
+            Names of the data files of a zip file. The RPPS zip files are flat :
+            directories are ignored, names with a path (absolute, "..", sub
+            directory) are rejected, they would be extracted out of the storage
+        :param zipf: open zip file
+        :return: list of member names
+        """
+        members = []
+        for member in zipf.namelist():
+            if member.endswith("/"):
+                continue
+            if os.path.isabs(member) or "/" in member or "\\" in member or member in (".", ".."):
+                self.logger.error(f"Zip ERROR : member {member} rejected (path)")
+                continue
+            members.append(member)
+        return members
+
+    def zip_members(self, zfile, dest_dir):
+        """
+            Names of the files of the zip file, once extracted in dest_dir
+            (nothing is extracted)
+        """
+        with zipfile.ZipFile(zfile) as zipf:
+            return [os.path.join(dest_dir, member) for member in self.data_members(zipf)]
+
+    def stream_member(self, zfile, data_filename):
+        """
+            Decompress one member of the zip file, lines are given to the caller
+            and written into data_filename at the same time.
+            zipfile checks the CRC when the end of the member is reached and raises
+            BadZipFile on error (zlib.error for corrupted data). The partial file is removed if the reading does not
+            complete.
+
+        :param zfile: zip file name
+        :param data_filename: extracted file name (the member is its basename)
+        :return: generator of raw lines
+        """
+        self.logger.info(f"Stream {os.path.basename(data_filename)} from {zfile}")
+        try:
+            with zipfile.ZipFile(zfile) as zipf, zipf.open(
+                os.path.basename(data_filename)
+            ) as member, open(data_filename, "wb", buffering=RPPS.BUFFER_SIZE) as fout:
+                for line in io.BufferedReader(member, RPPS.BUFFER_SIZE):
+                    fout.write(line)
+                    yield line
+        except BaseException:
+            if os.path.exists(data_filename):
+                os.remove(data_filename)
+            raise
 
     def download_zip(self, download_dir, remote_zip):
         """
             Download data file (zip format)
             Extract data into storage directory
 
+            Data is written into a .part file, renamed once complete.
+            After an interruption, the download is resumed with a Range request,
+            from the size of the .part file (even in a later run).
+
         :param download_dir: storage directory
         :param remote_zip: remote zip filename
-        :return: absolute name of CSV file
+        :return: absolute name of CSV file, None if the download failed
         """
         self.logger.info(f"Download zip: {remote_zip}")
         self.logger.info(f"Extract to : {download_dir}")
@@ -318,17 +579,66 @@ class RPPS:
             os.makedirs(download_dir)
 
         _filename = os.path.join(download_dir, remote_zip)
+        _part_filename = f"{_filename}{RPPS.PART_SUFFIX}"
 
-        response = requests.get(
-            self.data_url, stream=True, verify=os.path.abspath(RPPS.PEM)
-        )
-        handle = open(_filename, "wb")
-        for chunk in response.iter_content(chunk_size=512):
-            if chunk:  # filter out keep-alive new chunks
-                handle.write(chunk)
-        handle.close()
+        for attempt in range(1, self.download_retries + 1):
+            try:
+                if self.download_part(_part_filename):
+                    os.replace(_part_filename, _filename)
+                    return _filename
+            except requests.RequestException as req_err:
+                self.logger.warning(f"Download interrupted ({attempt}) : {req_err}")
 
-        return _filename
+        self.logger.error(f"Download failed : {remote_zip}")
+        return None
+
+    def download_part(self, part_filename):
+        """
+            Download (the rest of) the data file into part_filename
+
+        :param part_filename: partial file name
+        :return: True if the file is complete
+        """
+        offset = 0
+        headers = {}
+        if os.path.exists(part_filename):
+            offset = os.path.getsize(part_filename)
+            headers["Range"] = f"bytes={offset}-"
+            if self.http_cache.get("etag"):
+                # the whole file is sent if it has changed since
+                headers["If-Range"] = self.http_cache["etag"]
+            self.logger.info(f"Resume download at {offset} bytes")
+
+        with self.session.get(
+            self.data_url, stream=True, headers=headers, timeout=RPPS.HTTP_TIMEOUT
+        ) as response:
+            if response.status_code == 416:
+                # nothing more to get, or a different file : restart
+                os.remove(part_filename)
+                return False
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                # Content-Range: bytes 1000-9999/10000
+                _total = response.headers.get("Content-Range", "").split("/")[-1]
+            else:
+                # range not supported : full download
+                offset = 0
+                _total = response.headers.get("Content-Length")
+            total_size = int(_total) if _total and _total.isdigit() else None
+
+            with open(part_filename, "ab" if offset else "wb") as handle:
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                    if chunk:  # filter out keep-alive new chunks
+                        handle.write(chunk)
+
+        size = os.path.getsize(part_filename)
+        if total_size is not None and size != total_size:
+            self.logger.warning(f"Incomplete download : {size}/{total_size} bytes")
+            if size > total_size:
+                os.remove(part_filename)
+            return False
+        return True
 
     def save_diff_files(self, data_filename, diff_filename, difflist):
         """
@@ -356,7 +666,133 @@ class RPPS:
 
             self.data_files.append(diff_filename)
 
-    def extract_data(self, data_filename, difflist):
+    @staticmethod
+    def cache_filename(data_filename):
+        """
+            Name of the columnar cache of a data file
+        :param data_filename: data filename (contains its date)
+        :return: cache filename
+        """
+        return f"{data_filename}{RPPS.CACHE_SUFFIX}"
+
+    @staticmethod
+    def read_data(data_filename, names, columns=None, dtypes=None, engine=None):
+        """
+            Read a data file, only the requested columns.
+
+            The parsed columns are saved in a columnar cache (parquet, if pyarrow
+            is available) next to the data file. Later reads load the cache when
+            it holds the requested columns, otherwise the file is parsed again
+            for the missing columns plus the cached ones.
+
+        :param data_filename: data filename
+        :param names: names of the columns of the file
+        :param columns: columns to load (all if None)
+        :param dtypes: types of the columns (str if not given), ex: category
+        :param engine: "pyarrow" to parse with the pyarrow csv reader
+        :return: dataframe
+        """
+        logger = logging.getLogger("downloader")
+        cache_fn = RPPS.cache_filename(data_filename)
+        requested = list(columns or names)
+        dtypes = dtypes or {}
+
+        parsed = requested
+        if pyarrow and os.path.exists(cache_fn):
+            cached = pyarrow.parquet.read_schema(cache_fn).names
+            if set(requested) <= set(cached):
+                logger.info(f"Read cache <: {cache_fn}")
+                df = pandas.read_parquet(cache_fn, columns=requested)
+                return RPPS.cast_columns(df, {c: dtypes.get(c, "str") for c in requested})
+            parsed = [c for c in names if c in set(requested) | set(cached)]
+
+        logger.info(f"Read data <: {data_filename} ({len(parsed)} columns)")
+        types = {c: dtypes.get(c, "str") for c in parsed}
+        if engine == "pyarrow" and pyarrow:
+            df = RPPS.cast_columns(RPPS.read_csv_arrow(data_filename, names, parsed), types)
+        else:
+            df = pandas.read_csv(
+                data_filename,
+                delimiter="|",
+                names=names,
+                header=0,
+                index_col=False,
+                usecols=parsed,
+                dtype=types,
+            )[parsed]
+
+        if pyarrow:
+            try:
+                df.to_parquet(f"{cache_fn}.tmp", index=False)
+                os.replace(f"{cache_fn}.tmp", cache_fn)
+                logger.info(f"Cache saved :> {cache_fn}")
+            except (OSError, ValueError, pyarrow.ArrowException) as cache_err:
+                logger.warning(f"Cache not saved {cache_fn} : {cache_err}")
+
+        return df[requested]
+
+    @staticmethod
+    def cast_columns(df, types):
+        """
+            Cast the columns of a dataframe, missing values are kept : astype(str)
+            would turn them into "None" or "nan" strings
+        :param df: dataframe
+        :param types: types of the columns
+        :return: dataframe
+        """
+        for column, dtype in types.items():
+            if dtype == "str":
+                if not pandas.api.types.is_string_dtype(df[column]):
+                    df[column] = df[column].astype(str).where(df[column].notna())
+            elif df[column].dtype != dtype:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    @staticmethod
+    def read_csv_arrow(data_filename, names, columns):
+        """
+            Read some columns of a data file with the pyarrow csv reader
+            Lines may end with a separator : extra columns are named and ignored
+
+        :param data_filename: data filename
+        :param names: names of the columns of the file
+        :param columns: columns to load
+        :return: dataframe, values as strings
+        """
+        with open(data_filename, "r", encoding="utf-8") as fin:
+            nb_fields = len(fin.readline().rstrip("\r\n").split("|"))
+        all_names = list(names) + [f"_{i}" for i in range(nb_fields - len(names))]
+
+        table = pyarrow.csv.read_csv(
+            data_filename,
+            read_options=pyarrow.csv.ReadOptions(column_names=all_names, skip_rows=1),
+            parse_options=pyarrow.csv.ParseOptions(delimiter="|"),
+            convert_options=pyarrow.csv.ConvertOptions(
+                include_columns=columns,
+                column_types={c: pyarrow.string() for c in all_names},
+                strings_can_be_null=True,
+            ),
+        )
+        return table.to_pandas()
+
+    def distinct_precision(self, cat):
+        """
+            Precision of the approximate distinct counts of a category, set with
+            approx_distinct in one of its tracks. Counts are exact if not set.
+            Only used when the statistics are aggregated line by line
+
+        :param cat: category (root name of the data file)
+        :return: HyperLogLog precision or None
+        """
+        blocks = getattr(self.tracks, cat, [])
+        if not isinstance(blocks, list):
+            blocks = [blocks]
+        for block in blocks:
+            if "approx_distinct" in block._fields:
+                return block.approx_distinct
+        return None
+
+    def extract_data(self, data_filename, difflist, data_stats=None):
         """
             Read raws data file
             Produce data according to config in tracks section
@@ -367,8 +803,10 @@ class RPPS:
                 - produce json raw data if filename is provided
 
         :param data_filename:
-        :param difflist: list of difference
-
+        :param difflist: list of difference, None if the file was not compared
+                         with a previous one
+        :param data_stats: statistics already aggregated while reading the file
+                           (stats.LineStats). If None, the file is read
         :return:
         """
 
@@ -376,59 +814,73 @@ class RPPS:
         cat = self.root_data_filename(os.path.basename(data_filename))
         self.logger.info(f"RPPS Cat={cat}")
 
-        # Read data
-        df = pandas.read_csv(
-            data_filename,
-            delimiter="|",
-            names=RPPS.MAPPING[cat],
-            header=0,
-            index_col=False,
-        )
+        if data_stats is None and cat in RPPS.EXTRACT_COLUMNS:
+            # Read data : only the columns used by the extractor
+            df = RPPS.read_data(
+                data_filename,
+                RPPS.MAPPING[cat],
+                columns=list(RPPS.EXTRACT_COLUMNS[cat]),
+                dtypes=RPPS.EXTRACT_COLUMNS[cat],
+                engine=self.csv_engine,
+            )
+            data_stats = stats.FrameStats(df)
 
         infos = None
         if cat == "PS_LibreAcces_Dipl_AutExerc":
-            infos = [self.PS_LibreAcces_Dipl_AutExerc_Extract(df, difflist)]
+            infos = [self.PS_LibreAcces_Dipl_AutExerc_Extract(data_stats, difflist)]
         elif cat == "PS_LibreAcces_Personne_activite":
-            infos = [self.PS_LibreAcces_Personne_activite_Extract(df, difflist)]
+            infos = [self.PS_LibreAcces_Personne_activite_Extract(data_stats, difflist)]
         elif cat == "PS_LibreAcces_SavoirFaire":
-            infos = [self.PS_LibreAcces_SavoirFaire_Extract(df, difflist)]
+            infos = [self.PS_LibreAcces_SavoirFaire_Extract(data_stats, difflist)]
         elif cat == "Extraction_Correspondance_MSSante":
-            infos = self.Extraction_Correspondance_MSSante_Extract(df, difflist)
+            infos = self.Extraction_Correspondance_MSSante_Extract(data_stats, difflist)
         else:
             pass
 
         return infos
 
-    def PS_LibreAcces_Dipl_AutExerc_Extract(self, df, difflist):
+    @staticmethod
+    def diff_count(difflist):
+        """
+            Number of modified lines. No value if the file was not compared
+            (ex: backfill of the history)
+        :param difflist: list of difference or None
+        :return: list of values
+        """
+        if difflist is None:
+            return []
+        return [{"key": "Nombre de lignes modifiées", "val": len(difflist)}]
+
+    def PS_LibreAcces_Dipl_AutExerc_Extract(self, data, difflist):
         return {
             "title": "Informations fichier des Diplômes",
             "type": "stats",
             "values": [
-                {"key": "Nombre de lignes", "val": len(df)},
-                {"key": "Nombre de lignes modifiées", "val": len(difflist)},
-                {"key": "Nombre de RPPS", "val": df.identifiant_pp.nunique()},
+                {"key": "Nombre de lignes", "val": data.count()},
+                *self.diff_count(difflist),
+                {"key": "Nombre de RPPS", "val": data.nunique("identifiant_pp")},
                 {
                     "key": "Nombre de diplomes differents",
-                    "val": df.code_diplome.nunique(),
+                    "val": data.nunique("code_diplome"),
                 },
             ],
             "rss": True,
         }
 
-    def PS_LibreAcces_Personne_activite_Extract(self, df, difflist):
-        id_types = df.type_identifiant_pp.value_counts().to_dict()
+    def PS_LibreAcces_Personne_activite_Extract(self, data, difflist):
+        id_types = data.value_counts("type_identifiant_pp")
 
         infos = {
             "title": "Informations fichier des personnes",
             "type": "stats",
             "values": [
-                {"key": "Nombre de lignes", "val": len(df)},
-                {"key": "Nombre de lignes modifiées", "val": len(difflist)},
-                {"key": "Nombre de RPPS", "val": id_types[8]},
-                {"key": "Nombre de ADELI", "val": id_types[0]},
+                {"key": "Nombre de lignes", "val": data.count()},
+                *self.diff_count(difflist),
+                {"key": "Nombre de RPPS", "val": id_types["8"]},
+                {"key": "Nombre de ADELI", "val": id_types["0"]},
                 {
                     "key": "Nombre de Structures référencées",
-                    "val": df.identifiant_technique_structure.nunique(),
+                    "val": data.nunique("identifiant_technique_structure"),
                 },
             ],
             "rss": True,
@@ -443,44 +895,40 @@ class RPPS:
             ] = self.tracks.PS_LibreAcces_Personne_activite.save_history
         return infos
 
-    def PS_LibreAcces_SavoirFaire_Extract(self, df, difflist):
+    def PS_LibreAcces_SavoirFaire_Extract(self, data, difflist):
         return {
             "title": "Informations fichier des savoir-faire",
             "type": "stats",
             "values": [
-                {"key": "Nombre de lignes", "val": len(df)},
-                {"key": "Nombre de lignes modifiées", "val": len(difflist)},
-                {"key": "Nombre de profession", "val": df.code_profession.nunique()},
+                {"key": "Nombre de lignes", "val": data.count()},
+                *self.diff_count(difflist),
+                {"key": "Nombre de profession", "val": data.nunique("code_profession")},
             ],
             "rss": True,
         }
 
-    def Extraction_Correspondance_MSSante_Extract(self, df, difflist):
+    def Extraction_Correspondance_MSSante_Extract(self, data, difflist):
 
-        df.libelle_profession.nunique()
         # top 5 profession
-        od = df.libelle_profession.value_counts().head().to_dict(OrderedDict)
+        od = data.value_counts("libelle_profession", top=5)
         top5_profession = ", ".join([f"{k} ({v})" for k, v in od.items()])
 
         # bal type
-        dd = df.type_bal.value_counts().to_dict(OrderedDict)
+        dd = data.value_counts("type_bal")
         bal_type = ", ".join([f"{k} ({v})" for k, v in od.items()])
 
-        df2 = df.loc[df.drop_duplicates("adresse_bal").adresse_bal.dropna().index]
-        mss_providers = df2.adresse_bal.str.split("@", expand=True).get(1)
-
         general = {
             "title": "Informations MSSanté",
             "type": "stats",
             "values": [
-                {"key": "Nombre de lignes", "val": len(df)},
-                {"key": "Nombre de lignes modifiées", "val": len(difflist)},
+                {"key": "Nombre de lignes", "val": data.count()},
+                *self.diff_count(difflist),
                 {
                     "key": "Nombre de profession",
-                    "val": f"{df.libelle_profession.nunique()} - top 5 : {top5_profession}",
+                    "val": f"{data.nunique('libelle_profession')} - top 5 : {top5_profession}",
                 },
-                {"key": "Mails MSsante", "val": df.adresse_bal.nunique()},
-                {"key": "Domaines MSsante", "val": mss_providers.nunique()},
+                {"key": "Mails MSsante", "val": data.nunique("adresse_bal")},
+                {"key": "Domaines MSsante", "val": data.domain_nunique("adresse_bal")},
                 {"key": "Types de boites aux lettre", "val": bal_type},
             ],
             "rss": True,
@@ -511,9 +959,7 @@ class RPPS:
 
             if "top" in block._fields:
                 # generate TOP x
-                mss_top = (
-                    mss_providers.value_counts().head(block.top).to_dict(OrderedDict)
-                )
+                mss_top = data.domain_top("adresse_bal", block.top)
                 for (k, v) in mss_top.items():
                     result["values"].append(dict(key=k, val=v))
 
@@ -523,9 +969,7 @@ class RPPS:
                     result["title"] = block.domains.title
 
                 for domain in block.domains.value:
-                    _count = (
-                        mss_providers.where(mss_providers == domain).dropna().count()
-                    )
+                    _count = data.domain_count("adresse_bal", domain)
                     result["values"].append(dict(key=domain, val=int(_count)))
 
             if "filename" in block._fields:
@@ -533,10 +977,12 @@ class RPPS:
             extracted.append(result)
         return extracted
 
-    def save_tracks(self, data_tracks):
+    def save_tracks(self, data_tracks, export=False):
         """
             Save data in filename, if a filename is configured
         :param data_tracks: data to save
+        :param export: export the saved files from the history storage (see
+                       export_tracks, the publication step)
         :return saved : name list of data files 
         """
         self.logger.info(f"Save {len(data_tracks)} data tracks")
@@ -550,10 +996,26 @@ class RPPS:
             if "output" in data and data["output"]:
                 filename = os.path.join(self.local_storage, data["output"])
                 self.save_tracks_set(filename, data, data_tracks["date"])
-                saved.append(filename)
+                if filename not in saved:
+                    saved.append(filename)
 
+        if export:
+            for filename in saved:
+                self.history.export(filename)
         return saved
 
+    def export_tracks(self):
+        """
+            Export all the track files of the history storage
+        :return: name list of data files
+        """
+        exported = []
+        for name in self.history.names():
+            filename = os.path.join(self.local_storage, name)
+            self.history.export(filename)
+            exported.append(filename)
+        return exported
+
     def save_tracks_set(self, filename, data, date):
         """
             Save data set in filename
@@ -568,46 +1030,8 @@ class RPPS:
         pp = pprint.PrettyPrinter(indent=2)
         self.logger.debug(pprint.pformat(data))
 
-        tracks = helpers.load_json(filename)
-
         if "type" not in data:
             self.logger.warning("No data TYPE, nothing saved...")
             return
 
-        # dtype = data type, e.g. stats, mssante, etc.
-        dtype = data["type"]
-
-        if dtype not in tracks:
-            # create new set
-            tracks[dtype] = {}
-
-        for val in data["values"]:
-            if val["key"] not in tracks[dtype]:
-                tracks[dtype][val["key"]] = None
-
-            # value to add or remplace (v)
-            v = dict(date=date, value=val["val"])
-
-            if data["history_flag"]:
-                # Manage a list of values : value = {'date': '2018-03-23', 'value': 999}
-                # insert/set/remplace the new value v
-                if isinstance(tracks[dtype][val["key"]], list):
-                    # already a list
-                    # search if these date already exists. If so remplace, else add
-                    existing_index = -1
-                    for index, elem in enumerate(tracks[dtype][val["key"]]):
-                        if elem["date"] == v["date"]:
-                            existing_index = index
-
-                    if existing_index > -1:
-                        tracks[dtype][val["key"]][existing_index]["value"] = v["value"]
-                    else:
-                        tracks[dtype][val["key"]].append(v)
-                else:
-                    # new list (replace single structure)
-                    tracks[dtype][val["key"]] = [v]
-            else:
-                # replace values
-                tracks[dtype][val["key"]] = v
-
-        helpers.save_json(filename, tracks)
+        self.history.save(filename, data, date)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Statistics used by the extractors of practitioner.RPPS
+
+    Two sources give the same statistics :
+     - FrameStats : data file loaded in a dataframe
+     - LineStats : raw lines, aggregated one by one while they are read
+       (ex: while the digest is computed), the file is read only once
+
+"""
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import json
+import logging
+import os
+from collections import Counter, OrderedDict, defaultdict
+
+from hll import HyperLogLog
+
+
+def ranked(counts, top=None):
+    """
+        Values by decreasing count, equal counts by value : the order does not
+        depend on the source of the statistics (FrameStats or LineStats)
+    :param counts: iterable of (value, count)
+    :param top: number of values to keep (all if None)
+    :return: ordered dict value -> count
+    """
+    items = sorted(
+        ((value, int(count)) for value, count in counts if count > 0),
+        key=lambda item: (-item[1], item[0]),
+    )
+    return OrderedDict(items[:top])
+
+
+class FrameStats:
+    """
+        Statistics of a data file loaded in a dataframe
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._domains = {}
+        self._domain_counts = {}
+
+    def count(self):
+        return len(self.df)
+
+    def nunique(self, column):
+        return self.df[column].nunique()
+
+    def value_counts(self, column, top=None):
+        """
+            Values of a column and their count, most frequent first (see ranked)
+        :param column: column name
+        :param top: number of values to keep (all if None)
+        :return: ordered dict value -> count
+        """
+        return ranked(self.df[column].value_counts().items(), top)
+
+    def domains(self, column):
+        """
+            Domains of the distinct mail addresses of a column
+        :param column: column name (ex: adresse_bal)
+        :return: series of domains
+        """
+        if column not in self._domains:
+            df2 = self.df.loc[self.df.drop_duplicates(column)[column].dropna().index]
+            self._domains[column] = df2[column].str.split("@", expand=True).get(1)
+        return self._domains[column]
+
+    def domain_counts(self, column):
+        """
+            Number of distinct mail addresses by domain, most frequent first.
+            Computed once and shared by the top ranking and all the domain lookups
+        :param column: column name (ex: adresse_bal)
+        :return: series domain -> count
+        """
+        if column not in self._domain_counts:
+            self._domain_counts[column] = self.domains(column).value_counts()
+        return self._domain_counts[column]
+
+    def domain_nunique(self, column):
+        return len(self.domain_counts(column))
+
+    def domain_top(self, column, top):
+        return ranked(self.domain_counts(column).items(), top)
+
+    def domain_count(self, column, domain):
+        return int(self.domain_counts(column).get(domain, 0))
+
+
+class LineStats:
+    """
+        Statistics aggregated line by line
+
+        spec gives the aggregations to maintain :
+            - value_counts : columns whose values are counted
+            - distinct : columns whose distinct values are counted
+            - domains : columns of mail addresses, distinct addresses are counted
+              by domain
+
+        With a precision, distinct values are estimated (HyperLogLog sketches)
+        instead of being counted : memory no longer grows with the number of
+        distinct values
+
+        Exact statistics can be saved, reloaded and updated from the lines
+        removed from / added to the data file (see apply_diff)
+    """
+
+    CHAR_FIELDS_SEP = "|"
+
+    def __init__(self, names, spec, precision=None):
+        """
+        :param names: names of the columns of the file
+        :param spec: aggregations (dict)
+        :param precision: HyperLogLog precision, exact counts if None
+        """
+        self.logger = logging.getLogger("stats")
+        self.names = names
+        self.precision = precision
+        self.rows = 0
+        # data file the statistics were computed on, number of updates from a diff
+        # since the last full count
+        self.source = None
+        self.runs = 0
+        self.counters = {c: Counter() for c in spec.get("value_counts", [])}
+        self.distincts = {
+            c: self.distinct_counter()
+            for c in set(spec.get("distinct", [])) | set(spec.get("domains", []))
+        }
+        if precision is None:
+            self.domain_counters = {c: Counter() for c in spec.get("domains", [])}
+        else:
+            self.domain_counters = {
+                c: defaultdict(self.distinct_counter) for c in spec.get("domains", [])
+            }
+
+        self._counted = [(names.index(c), counter) for c, counter in self.counters.items()]
+        self._distinct = [
+            (names.index(c), values, self.domain_counters.get(c))
+            for c, values in self.distincts.items()
+        ]
+
+    def distinct_counter(self):
+        """
+            Container of the distinct values of a column
+        :return: Counter (value -> number of rows), or HyperLogLog sketch if a
+                 precision is given
+        """
+        if self.precision is None:
+            return Counter()
+        return HyperLogLog(self.precision)
+
+    def scan(self, lines):
+        """
+            Aggregate the lines while giving them back.
+            The first line (header) is not aggregated
+
+        :param lines: raw lines (bytes)
+        :return: generator of the same lines
+        """
+        lines = iter(lines)
+        header = next(lines, None)
+        if header is None:
+            return
+        yield header
+        for line in lines:
+            self.update(line.decode("utf-8").rstrip("\r\n").split(self.CHAR_FIELDS_SEP))
+            yield line
+
+    def update(self, values, step=1):
+        """
+            Aggregate one row. Empty values are ignored, like NaN with pandas
+        :param values: list of values (str)
+        :param step: 1 to add the row, -1 to remove it (exact counts only)
+        :return: -
+        """
+        if step < 0 and self.precision is not None:
+            raise ValueError("Estimated distinct counts can't be decreased")
+        self.rows += step
+        nb_values = len(values)
+        for index, counter in self._counted:
+            if index < nb_values:
+                value = values[index].strip('"')
+                if value:
+                    self.increment(counter, value, step)
+        for index, distinct, domains in self._distinct:
+            if index < nb_values:
+                value = values[index].strip('"')
+                if not value:
+                    continue
+                if self.precision is not None:
+                    distinct.add(value)
+                    if domains is not None and "@" in value:
+                        domains[value.split("@")[1]].add(value)
+                elif self.increment(distinct, value, step):
+                    # first row with this address, or last one removed
+                    if domains is not None and "@" in value:
+                        self.increment(domains, value.split("@")[1], step)
+
+    @staticmethod
+    def increment(counter, value, step):
+        """
+            Change the count of a value. A value whose count falls to 0 is removed
+        :param counter: Counter
+        :param value: value
+        :param step: 1 or -1
+        :return: True if the value appeared or disappeared
+        """
+        count = counter[value] + step
+        if count > 0:
+            counter[value] = count
+            return count == step
+        counter.pop(value, None)
+        return count == 0
+
+    def apply_diff(self, added, removed):
+        """
+            Update the statistics of the previous data file with the differences
+            found with the new one. A modified row is removed then added
+        :param added: lines (str) of the new file not in the previous one
+        :param removed: lines (str) of the previous file not in the new one
+        :return: -
+        """
+        for line in removed:
+            self.update(line.split(self.CHAR_FIELDS_SEP), -1)
+        for line in added:
+            self.update(line.split(self.CHAR_FIELDS_SEP))
+        self.runs += 1
+
+    def snapshot(self):
+        """
+            Content of the exact statistics
+        :return: dict
+        """
+        return {
+            "rows": self.rows,
+            "counters": {c: dict(counter) for c, counter in self.counters.items()},
+            "distincts": {c: dict(values) for c, values in self.distincts.items()},
+        }
+
+    def save(self, filename):
+        """
+            Save the exact statistics (json), to update them at the next run
+        :param filename: state filename
+        :return: -
+        """
+        if self.precision is not None:
+            raise ValueError("Estimated distinct counts can't be saved")
+        state = self.snapshot()
+        state.update(source=self.source, runs=self.runs)
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as fout:
+            json.dump(state, fout)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def load(filename, names, spec):
+        """
+            Load statistics saved by save
+        :param filename: state filename
+        :param names: names of the columns of the file
+        :param spec: aggregations (dict), the same as the saved statistics
+        :return: LineStats
+        """
+        with open(filename, "r", encoding="utf-8") as fin:
+            state = json.load(fin)
+
+        line_stats = LineStats(names, spec)
+        line_stats.rows = state["rows"]
+        line_stats.source = state["source"]
+        line_stats.runs = state["runs"]
+        for column, counter in line_stats.counters.items():
+            counter.update(state["counters"][column])
+        for column, values in line_stats.distincts.items():
+            values.update(state["distincts"][column])
+        for column, domains in line_stats.domain_counters.items():
+            domains.update(
+                value.split("@")[1] for value in line_stats.distincts[column] if "@" in value
+            )
+        return line_stats
+
+    def count(self):
+        return self.rows
+
+    def nunique(self, column):
+        if column in self.distincts:
+            return len(self.distincts[column])
+        return len(self.counters[column])
+
+    def value_counts(self, column, top=None):
+        return ranked(self.counters[column].items(), top)
+
+    def domain_sizes(self, column):
+        """
+            Number of distinct addresses by domain
+        :param column: column name
+        :return: Counter domain -> count (estimated with a precision)
+        """
+        if self.precision is None:
+            return self.domain_counters[column]
+        return Counter(
+            {domain: len(sketch) for domain, sketch in self.domain_counters[column].items()}
+        )
+
+    def domain_nunique(self, column):
+        return len(self.domain_counters[column])
+
+    def domain_top(self, column, top):
+        return ranked(self.domain_sizes(column).items(), top)
+
+    def domain_count(self, column, domain):
+        if domain not in self.domain_counters[column]:
+            return 0
+        return self.domain_sizes(column)[domain]
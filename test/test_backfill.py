@@ -0,0 +1,130 @@
+import json
+import logging
+import os.path
+import tempfile
+import unittest
+import zipfile
+
+import lookout
+import practitioner
+from easy_atom import helpers
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.archives = os.path.join(self.tmpdir.name, "archives")
+        self.storage = os.path.join(self.tmpdir.name, "files")
+        os.makedirs(self.archives)
+        os.makedirs(self.storage)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_config(self, workers):
+        config_fn = os.path.join(self.tmpdir.name, "config-mssante.json")
+        with open(config_fn, "w") as fout:
+            json.dump(
+                {
+                    "URL": "https://service.annuaire.sante.fr/annuaire-sante-webservices/V300/services/extraction/Extraction_Correspondance_MSSante",
+                    "local": {"storage": self.storage, "workers": workers},
+                    "pub": {
+                        "feed_base": "http://www.opikanoba.org/feeds/rpps",
+                        "url_base": "https://www.opikanoba.org/data/rpps",
+                    },
+                    "tracks": {
+                        "Extraction_Correspondance_MSSante": [
+                            {
+                                "domains": {
+                                    "title": "Domaines des CHU",
+                                    "value": ["chu-1.mssante.fr", "chu-2.mssante.fr"],
+                                },
+                                "filename": "chu-mssante.json",
+                                "name": "chu-mssante",
+                                "save_history": True,
+                            }
+                        ]
+                    },
+                },
+                fout,
+            )
+        return config_fn
+
+    @staticmethod
+    def content(users):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        lines = ["|".join(names) + "|"]
+        for i in range(users):
+            values = [f"v{i}"] * len(names)
+            values[1] = f"user{i}@chu-{i % 2 + 1}.mssante.fr"
+            lines.append("|".join(values) + "|")
+        return "\n".join(lines) + "\n"
+
+    def make_archives(self):
+        # 3 zip files and a text file, not in date order of creation
+        for date, users in (("201903010800", 6), ("201801010800", 2), ("201806010800", 4)):
+            with zipfile.ZipFile(
+                os.path.join(self.archives, f"Extraction_Correspondance_MSSante_{date}.zip"),
+                "w",
+                zipfile.ZIP_DEFLATED,
+            ) as zipf:
+                zipf.writestr(f"Extraction_Correspondance_MSSante_{date}.txt", self.content(users))
+        with open(
+            os.path.join(self.archives, "Extraction_Correspondance_MSSante_201812010800.txt"), "w"
+        ) as fout:
+            fout.write(self.content(5))
+        # already in a zip file
+        with open(
+            os.path.join(self.archives, "Extraction_Correspondance_MSSante_201806010800.txt"), "w"
+        ) as fout:
+            fout.write(self.content(40))
+
+    def check_history(self):
+        with open(os.path.join(self.storage, "chu-mssante.json")) as fin:
+            tracks = json.load(fin)
+        self.assertEqual(
+            tracks["mssante"]["chu-1.mssante.fr"],
+            [
+                {"date": "2018-01-01", "value": 1},
+                {"date": "2018-06-01", "value": 2},
+                {"date": "2018-12-01", "value": 3},
+                {"date": "2019-03-01", "value": 3},
+            ],
+        )
+        self.assertEqual(tracks["mssante"]["chu-2.mssante.fr"][-1], {"date": "2019-03-01", "value": 3})
+
+    def test_backfill(self):
+        self.make_archives()
+        app = lookout.App(self.make_config(workers=1))
+        self.assertEqual(len(app.backfill_sources(self.archives)), 4)
+        app.backfill(self.archives)
+        self.check_history()
+        # nothing extracted in the archives directory
+        self.assertEqual(len(os.listdir(self.archives)), 5)
+
+    def test_parallel_backfill(self):
+        self.make_archives()
+        app = lookout.App(self.make_config(workers=2))
+        app.backfill(self.archives)
+        self.check_history()
+
+    @unittest.skipUnless(practitioner.pyarrow, "pyarrow not installed")
+    def test_backfill_cache(self):
+        self.make_archives()
+        txt_fn = os.path.join(self.archives, "Extraction_Correspondance_MSSante_201812010800.txt")
+        app = lookout.App(self.make_config(workers=1))
+        # cache made by a previous run
+        app.rpps_data.extract_data(txt_fn, None)
+        self.assertTrue(os.path.exists(practitioner.RPPS.cache_filename(txt_fn)))
+
+        with self.assertLogs("downloader", level="INFO") as logs:
+            app.backfill(self.archives)
+        self.assertTrue(any("Read cache" in line and txt_fn in line for line in logs.output))
+        self.check_history()
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "app"], logging.INFO)
+
+    unittest.main()
@@ -1,8 +1,11 @@
 import logging
 import os.path
+import shutil
+import tempfile
 import unittest
 
 import differentia
+import digester
 from easy_atom import helpers
 
 
@@ -39,6 +42,201 @@ class TestDiff(unittest.TestCase):
 
         self.assertEqual(len(result), 1)
 
+    def test_streaming_diff(self):
+        self.logger.info("  TEST test_streaming_diff")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write("h|a\n1|x\n2|y\n3|z\n")
+            with open(new_fn, "w") as fout:
+                fout.write("h|a\n1|x\n2|Y\n3|z\n4|w\n")
+
+            expected = differentia.Diff(old_fn, storage_dir=tmpdir).find_diff(new_fn)
+            result = differentia.Diff(
+                old_fn, storage_dir=tmpdir, streaming=True
+            ).find_diff(new_fn)
+
+            self.assertEqual(result, expected)
+            self.assertEqual([(l, t) for s, l, t in result], [(3, "2|Y"), (5, "4|w")])
+
+    def test_removed_lines(self):
+        self.logger.info("  TEST test_removed_lines")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write("h|a\n1|x\n2|y\n3|z\n")
+            with open(new_fn, "w") as fout:
+                fout.write("h|a\n3|z\n1|x\n")
+
+            for streaming in (False, True):
+                d = differentia.Diff(old_fn, storage_dir=tmpdir, streaming=streaming)
+                self.assertEqual(d.find_diff(new_fn), [])
+                self.assertEqual(d.removed.tolist(), [3])
+
+    def test_duplicate_lines(self):
+        self.logger.info("  TEST test_duplicate_lines")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write("h|a\n1|x\n1|x\n2|y\n1|x\n")
+            with open(new_fn, "w") as fout:
+                fout.write("h|a\n1|x\n2|y\n2|y\n3|z\n")
+
+            # one more "2|y", two "1|x" less
+            for streaming, memory_limit in ((False, None), (True, None), (False, 4096)):
+                d = differentia.Diff(
+                    old_fn, storage_dir=tmpdir, streaming=streaming, memory_limit=memory_limit
+                )
+                result = d.find_diff(new_fn)
+                self.assertEqual(sorted((l, t) for s, l, t in result), [(4, "2|y"), (5, "3|z")])
+                self.assertEqual(d.removed.tolist(), [3, 5])
+                os.remove(f"{new_fn}.sha")
+
+    def test_bucket_diff(self):
+        self.logger.info("  TEST test_bucket_diff")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write("h|a\n")
+                fout.writelines(f"{i}|x{i}\n" for i in range(5000))
+            with open(new_fn, "w") as fout:
+                fout.write("h|a\n")
+                fout.writelines(f"{i}|{'y' if i % 7 == 0 else 'x'}{i}\n" for i in range(300, 5200))
+
+            expected_diff = differentia.Diff(old_fn, storage_dir=tmpdir)
+            expected = expected_diff.find_diff(new_fn)
+            with open(f"{new_fn}.sha", "rb") as fin:
+                expected_sha = fin.read()
+            os.remove(f"{new_fn}.sha")
+
+            # 5000 lines in a few kilobytes : 64 buckets
+            d = differentia.Diff(old_fn, storage_dir=tmpdir, memory_limit=4096)
+            self.assertEqual(d.bucket_bits(5000), 6)
+            # the number of open bucket files is bounded
+            self.assertEqual(
+                differentia.Diff(old_fn, memory_limit=1).bucket_bits(10 ** 7),
+                differentia.Diff.MAX_BUCKET_BITS,
+            )
+            result = d.find_diff(new_fn)
+
+            self.assertEqual(result, expected)
+            self.assertEqual(d.removed.tolist(), expected_diff.removed.tolist())
+            with open(f"{new_fn}.sha", "rb") as fin:
+                self.assertEqual(fin.read(), expected_sha)
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)),
+                [
+                    f"{name}{suffix}"
+                    for name in ("new.txt", "old.txt")
+                    for suffix in ("", ".blocks", ".offsets", ".sha")
+                ],
+            )
+
+    def test_block_diff(self):
+        self.logger.info("  TEST test_block_diff")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            with open(old_fn, "w") as fout:
+                fout.write("h|a\n")
+                fout.writelines(f"{i}|x{i}\n" for i in range(3 << digester.Digester.BLOCK_BITS))
+
+            # same content, new name : no line is hashed
+            same_fn = os.path.join(tmpdir, "same.txt")
+            shutil.copyfile(old_fn, same_fn)
+            d = differentia.Diff(old_fn, storage_dir=tmpdir)
+            self.assertEqual(d.find_diff(same_fn), [])
+            self.assertEqual(len(d.removed), 0)
+            self.assertEqual(
+                digester.Digester().block_digest(same_fn, old_fn), (True, 0)
+            )
+
+            # one line inserted : the next blocks are the same
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn) as fin, open(new_fn, "w") as fout:
+                for num, line in enumerate(fin):
+                    if num == 70000:
+                        fout.write("inserted|y\n")
+                    fout.write(line)
+            old_blocks = digester.Digester().load_blocks(old_fn)[1]
+            d = differentia.Diff(old_fn, storage_dir=tmpdir)
+            result = d.find_diff(new_fn)
+            self.assertEqual([(l, t) for s, l, t in result], [(70001, "inserted|y")])
+            self.assertEqual(len(d.removed), 0)
+            new_blocks = digester.Digester().load_blocks(new_fn)[1]
+            self.assertGreater(len(old_blocks), 1)
+            self.assertLessEqual(len(set(new_blocks) - set(old_blocks)), 2)
+
+            # the digest made from the blocks is the one of a full digest
+            with open(f"{new_fn}.sha", "rb") as fin:
+                block_sha = fin.read()
+            dig = digester.Digester()
+            dig.stream_digest(new_fn)
+            with open(f"{new_fn}.sha", "rb") as fin:
+                self.assertEqual(fin.read(), block_sha)
+
+            # the blocks to hash are given to the digest workers
+            os.remove(f"{new_fn}.sha")
+            d = differentia.Diff(old_fn, storage_dir=tmpdir, digest_workers=2)
+            self.assertEqual(d.find_diff(new_fn), result)
+            with open(f"{new_fn}.sha", "rb") as fin:
+                self.assertEqual(fin.read(), block_sha)
+
+    def test_keyed_changes(self):
+        self.logger.info("  TEST test_keyed_changes")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write('id|name|city|\n"1"|a|X|\n"2"|b|Y|\n"3"|d|Z|\n')
+            with open(new_fn, "w") as fout:
+                fout.write('id|name|city|\n"1"|a|X|\n"2"|b|W|\n"4"|e|Z|\n')
+
+            d = differentia.Diff(old_fn, storage_dir=tmpdir)
+            changes = d.find_changes(d.find_diff(new_fn), ["id", "name", "city"], "id")
+
+            self.assertEqual(
+                [(c["status"], c["key"]) for c in changes],
+                [
+                    (differentia.Diff.MODIFIED, "2"),
+                    (differentia.Diff.REMOVED, "3"),
+                    (differentia.Diff.ADDED, "4"),
+                ],
+            )
+            self.assertEqual(changes[0]["changes"], {"city": ["Y", "W"]})
+            self.assertEqual(changes[1]["previous_line"], 4)
+
+    def test_missing_previous_file(self):
+        self.logger.info("  TEST test_missing_previous_file")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "old.txt")
+            new_fn = os.path.join(tmpdir, "new.txt")
+            with open(old_fn, "w") as fout:
+                fout.write('id|name|\n"1"|a|\n"2"|b|\n')
+            with open(new_fn, "w") as fout:
+                fout.write('id|name|\n"1"|a|\n"3"|c|\n')
+            digester.Digester().stream_digest(old_fn)
+            # only the digest of the previous file is left
+            os.remove(old_fn)
+
+            d = differentia.Diff(old_fn, storage_dir=tmpdir)
+            difflist = d.find_diff(new_fn)
+            self.assertEqual([(l, t) for s, l, t in difflist], [(3, '"3"|c|')])
+            self.assertEqual(d.removed.tolist(), [3])
+            self.assertEqual(list(d.removed_lines()), [])
+            changes = d.find_changes(difflist, ["id", "name"], "id")
+            self.assertEqual([(c["status"], c["key"]) for c in changes], [(differentia.Diff.ADDED, "3")])
+
 
 if __name__ == "__main__":
     loggers = helpers.stdout_logger(["utest", "digester", "differentia"], logging.INFO)
@@ -1,4 +1,7 @@
+import hashlib
 import logging
+import os.path
+import tempfile
 import unittest
 
 import digester
@@ -23,6 +26,170 @@ class TestDigester(unittest.TestCase):
 
         self.assertEqual(len(dig1), len(dig2))
 
+    def test_stream_digest(self):
+        self.logger.info("  TEST test_stream_digest")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            with open(filename, "wb") as fout:
+                fout.write(b"h|a\n1|x\r\n2|y\n3|z")
+
+            d = digester.Digester(buffer_size=4)
+            dig1 = d.make_digest(filename)
+            self.assertEqual(d.data, ["h|a", "1|x", "2|y", "3|z"])
+
+            d2 = digester.Digester(buffer_size=4)
+            self.assertEqual(d2.stream_digest(filename), 4)
+            self.assertEqual(d2.data, [])
+            self.assertEqual(d2.load_digest(d2.sha_filename(filename)), dig1)
+
+    def test_offsets(self):
+        self.logger.info("  TEST test_offsets")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            lines = [b"h|a\n", b"1|\xc3\xa9\r\n", b"2|y\n", b"3|z"]
+            with open(filename, "wb") as fout:
+                fout.writelines(lines)
+
+            d = digester.Digester()
+            d.stream_digest(filename)
+            self.assertEqual(d.load_offsets(filename).tolist(), [0, 4, 10, 14, 17])
+            self.assertEqual(list(d.fetch_lines(filename, [1, 3])), [(1, lines[1]), (3, lines[3])])
+            self.assertEqual(list(d.fetch_lines(filename, [])), [])
+
+            # the data file changed : lines are read from the file
+            with open(filename, "ab") as fout:
+                fout.write(b"\n")
+            self.assertIsNone(d.load_offsets(filename))
+            self.assertEqual(list(d.fetch_lines(filename, [3])), [(3, b"3|z\n")])
+
+    def test_missing_file(self):
+        self.logger.info("  TEST test_missing_file")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            with open(filename, "wb") as fout:
+                fout.write(b"h|a\n1|x\n")
+
+            d = digester.Digester()
+            d.stream_digest(filename)
+            self.assertIsNotNone(d.load_blocks(filename))
+
+            # the data file is removed, its sidecar files remain
+            os.remove(filename)
+            self.assertIsNone(d.load_offsets(filename))
+            self.assertIsNone(d.load_blocks(filename))
+
+            # a missing file has no lines
+            self.assertEqual(len(d.make_digest(os.path.join(tmpdir, "missing.txt"))), 0)
+
+    def test_parallel_digest(self):
+        self.logger.info("  TEST test_parallel_digest")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            with open(filename, "wb") as fout:
+                fout.write(b"h|a\n")
+                fout.writelines(b"%d|%s\r\n" % (i, b"x" * (i % 13)) for i in range(1000))
+                fout.write(b"last|z")
+
+            d = digester.Digester()
+            self.assertEqual(d.stream_digest(filename), 1002)
+            sidecars = (
+                d.sha_filename(filename),
+                d.offsets_filename(filename),
+                d.blocks_filename(filename),
+            )
+            expected = []
+            for fn in sidecars:
+                with open(fn, "rb") as fin:
+                    expected.append(fin.read())
+                os.remove(fn)
+
+            # blocks made while digesting are the blocks read from the file
+            d.write_blocks(filename)
+            with open(d.blocks_filename(filename), "rb") as fin:
+                self.assertEqual(fin.read(), expected[-1])
+
+            for workers in (3, 8):
+                dp = digester.Digester(workers=workers)
+                ranges = dp.split_ranges(filename, workers)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], os.path.getsize(filename))
+                self.assertEqual(dp.stream_digest(filename), 1002)
+                for fn, content in zip(sidecars, expected):
+                    with open(fn, "rb") as fin:
+                        self.assertEqual(fin.read(), content)
+
+            # blocks ended inside the ranges and blocks across two ranges
+            large = os.path.join(tmpdir, "large.txt")
+            with open(large, "wb") as fout:
+                fout.writelines(b"%d|x\n" % i for i in range(3 << digester.Digester.BLOCK_BITS))
+            d.stream_digest(large)
+            expected = d.load_blocks(large)
+            self.assertGreater(len(expected[1]), 2)
+            digester.Digester(workers=4).stream_digest(large)
+            self.assertEqual(d.load_blocks(large), expected)
+
+            # more ranges than lines : one range per line
+            small = os.path.join(tmpdir, "small.txt")
+            with open(small, "wb") as fout:
+                fout.write(b"h|a\n1|x\n")
+            self.assertEqual(d.split_ranges(small, 10), [(0, 4), (4, 8)])
+
+    def test_binary_and_legacy_digest(self):
+        self.logger.info("  TEST test_binary_and_legacy_digest")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            lines = [b"h|a\n", b"1|x\n", b"2|y\n"]
+            with open(filename, "wb") as fout:
+                fout.writelines(lines)
+
+            d = digester.Digester()
+            dig = d.make_digest(filename)
+            self.assertIsInstance(dig, digester.DigestFile)
+            self.assertEqual(
+                os.path.getsize(d.sha_filename(filename)),
+                digester.Digester.HEADER.size + 3 * dig.record_size,
+            )
+            self.assertEqual(dig[d.hash_line(b"1|x\n")], 1)
+            self.assertNotIn(d.hash_line(b"1|y\n"), dig)
+            dig.close()
+
+            # legacy text format (sha256) is still understood
+            with open(d.sha_filename(filename), "w") as fout:
+                for num, line in enumerate(lines):
+                    fout.write("%d:%s\n" % (num, hashlib.sha256(line).hexdigest()))
+            d256 = digester.Digester(algorithm="sha256")
+            self.assertEqual(d256.digest(filename), d256.make_digest(filename))
+
+    def test_algorithm(self):
+        self.logger.info("  TEST test_algorithm")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "data.txt")
+            with open(filename, "wb") as fout:
+                fout.write(b"h|a\n1|x\n2|y\n")
+
+            d256 = digester.Digester(algorithm="sha256")
+            dig = d256.make_digest(filename)
+            self.assertEqual(dig.algorithm, "sha256")
+            self.assertEqual(dig[hashlib.sha256(b"1|x\n").digest()[:8]], 1)
+            dig.close()
+
+            # a digest is never read with another algorithm : it is made again
+            d = digester.Digester(algorithm="blake2b")
+            with self.assertRaises(ValueError):
+                d.load_digest(d.sha_filename(filename))
+            dig = d.load_hashes(filename)
+            self.assertEqual(dig.algorithm, "blake2b")
+            self.assertEqual(dig[hashlib.blake2b(b"2|y\n", digest_size=8).digest()], 2)
+
+            with self.assertRaises(ValueError):
+                digester.Digester(algorithm="crc32")
+
 
 if __name__ == "__main__":
     loggers = helpers.stdout_logger(["utest", "digester"], logging.INFO)
@@ -0,0 +1,111 @@
+import json
+import logging
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+import domain_index
+import info_mssante
+import practitioner
+from easy_atom import helpers
+
+
+class TestDomainIndex(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(
+            self.tmpdir.name, "Extraction_Correspondance_MSSante_201807310813.txt"
+        )
+        self.write_data(["chu-rennes", "chu-rennes", "chu-reims", "aphp", "ch-aix"])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_data(self, domains):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        with open(self.filename, "w") as fout:
+            fout.write("|".join(names) + "|\n")
+            for i, domain in enumerate(domains):
+                values = [f"v{i}"] * len(names)
+                values[1] = f'"user{len(domains) - i}@{domain}.mssante.fr"'
+                fout.write("|".join(values) + "|\n")
+            # no address
+            fout.write("|".join([""] * len(names)) + "|\n")
+
+    def test_index(self):
+        index = domain_index.DomainIndex.open(
+            self.filename, practitioner.RPPS.KEYS_MSSANTE, "adresse_bal"
+        )
+        self.assertEqual(
+            index.addresses("chu-re"),
+            ["user3@chu-reims.mssante.fr", "user4@chu-rennes.mssante.fr", "user5@chu-rennes.mssante.fr"],
+        )
+        self.assertEqual(index.addresses("aphp.mssante.fr"), ["user2@aphp.mssante.fr"])
+        self.assertEqual(len(index.addresses("ch")), 4)
+        self.assertEqual(index.addresses("chu-lille"), [])
+        index.close()
+
+    def test_index_updated(self):
+        app = info_mssante.App(self.filename)
+        self.assertEqual(len(app.process("aix")), 1)
+
+        # new data file : the index is made again
+        self.write_data(["ch-aix", "ch-aix"])
+        os.utime(self.filename, (time.time() + 1, time.time() + 1))
+        self.assertEqual(len(app.process("aix")), 2)
+
+    def test_batch(self):
+        app = info_mssante.App(self.filename)
+        results = app.process_batch(["chu-rennes\n", "\n", "aphp\n", "chu-rennes\n"])
+        self.assertEqual(list(results), ["chu-rennes", "aphp"])
+        self.assertEqual(len(results["chu-rennes"]), 2)
+
+    def test_no_extract(self):
+        config_fn = os.path.join(self.tmpdir.name, "config-mssante.json")
+        with open(config_fn, "w") as fout:
+            json.dump({"local": {"data": {"Extraction_Correspondance_MSSante": None}}}, fout)
+
+        with self.assertLogs("app", level="ERROR"), self.assertRaises(SystemExit):
+            info_mssante.App(config=config_fn).process("aphp")
+
+    def test_server(self):
+        config_fn = os.path.join(self.tmpdir.name, "config-mssante.json")
+        with open(config_fn, "w") as fout:
+            json.dump({"local": {"data": {"Extraction_Correspondance_MSSante": self.filename}}}, fout)
+
+        server = info_mssante.App(config=config_fn).make_server(0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        try:
+            with urllib.request.urlopen(f"{url}?domain=aphp") as response:
+                self.assertEqual(json.load(response), ["user2@aphp.mssante.fr"])
+
+            # new run of lookout : new extract in the configuration
+            self.filename = self.filename.replace("201807310813", "201808310813")
+            self.write_data(["aphp", "aphp", "aphp"])
+            with open(config_fn, "w") as fout:
+                json.dump({"local": {"data": {"Extraction_Correspondance_MSSante": self.filename}}}, fout)
+            os.utime(config_fn, (time.time() + 1, time.time() + 1))
+
+            request = urllib.request.Request(url, data=b"aphp\nch-aix\n")
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(
+                    json.load(response),
+                    {
+                        "aphp": ["user1@aphp.mssante.fr", "user2@aphp.mssante.fr", "user3@aphp.mssante.fr"],
+                        "ch-aix": [],
+                    },
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "domain_index"], logging.INFO)
+
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import logging
+import os.path
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import practitioner
+from easy_atom import helpers
+
+CONTENT = bytes(range(256)) * 400
+ETAG = '"rpps-201808011050"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+        Local stand-in of the extraction web site.
+        Supports Range requests, and can cut the first response in the middle
+    """
+
+    def do_HEAD(self):
+        self.server.requests.append("HEAD")
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header(
+            "Content-Disposition", "attachment; filename=PS_LibreAcces_201808011050.zip"
+        )
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get("Range"))
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT) - start))
+        self.end_headers()
+
+        if self.server.cut:
+            self.server.cut = False
+            self.wfile.write(CONTENT[start : start + len(CONTENT) // 3])
+            self.close_connection = True
+        else:
+            self.wfile.write(CONTENT[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResumeDownload(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.server.requests = []
+        self.server.cut = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        config_dict = json.dumps(
+            {
+                "URL": f"http://127.0.0.1:{self.server.server_port}/PS_LibreAcces",
+                "local": {
+                    "storage": self.tmpdir.name,
+                    "download_chunk_size": 4096,
+                },
+            }
+        )
+        self.config = json.loads(
+            config_dict,
+            object_hook=lambda d: namedtuple("JDATA", d.keys())(*d.values()),
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_download(self):
+        d = practitioner.RPPS(properties=self.config)
+        filename = d.download_zip(self.tmpdir.name, "PS_LibreAcces_201808011050.zip")
+
+        with open(filename, "rb") as fin:
+            self.assertEqual(fin.read(), CONTENT)
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume_download(self):
+        self.server.cut = True
+        d = practitioner.RPPS(properties=self.config)
+        filename = d.download_zip(self.tmpdir.name, "PS_LibreAcces_201808011050.zip")
+
+        with open(filename, "rb") as fin:
+            self.assertEqual(fin.read(), CONTENT)
+        self.assertFalse(os.path.exists(f"{filename}{practitioner.RPPS.PART_SUFFIX}"))
+        # resumed with a Range request, from what was received before the cut
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNone(self.server.requests[0])
+        offset = int(self.server.requests[1].split("=")[1].rstrip("-"))
+        self.assertTrue(0 < offset <= len(CONTENT) // 3)
+
+    def test_conditional_head(self):
+        cache_fn = os.path.join(self.tmpdir.name, "config-rpps.http.json")
+        d = practitioner.RPPS(properties=self.config, http_cache_filename=cache_fn)
+        self.assertEqual(d.find_current_data(), "PS_LibreAcces_201808011050.zip")
+        self.assertTrue(os.path.exists(cache_fn))
+
+        # next run : the cache is reloaded, the server answers 304
+        d2 = practitioner.RPPS(properties=self.config, http_cache_filename=cache_fn)
+        self.assertEqual(d2.conditional_headers(), {"If-None-Match": ETAG})
+        self.assertEqual(d2.find_current_data(), "PS_LibreAcces_201808011050.zip")
+        self.assertEqual(self.server.requests, ["HEAD", "HEAD"])
+
+        # already downloaded : no new GET
+        filename = d2.download_zip(self.tmpdir.name, "PS_LibreAcces_201808011050.zip")
+        self.assertEqual(d2.retrieve_current(), filename)
+        self.assertEqual(self.server.requests, ["HEAD", "HEAD", None, "HEAD"])
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "downloader"], logging.DEBUG)
+
+    unittest.main()
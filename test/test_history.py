@@ -0,0 +1,134 @@
+import json
+import logging
+import os.path
+import tempfile
+import unittest
+
+import history
+from easy_atom import helpers
+
+RUNS = [
+    (
+        "2018-07-31",
+        [
+            {"type": "mssante", "values": [{"key": "chu-1", "val": 10}, {"key": "chu-2", "val": 3}], "history_flag": True},
+            {"type": "top", "values": [{"key": "aphp", "val": 99}], "history_flag": False},
+        ],
+    ),
+    (
+        "2018-08-31",
+        [
+            {"type": "mssante", "values": [{"key": "chu-1", "val": 12}, {"key": "chu-3", "val": 1}], "history_flag": True},
+            {"type": "top", "values": [{"key": "aphp", "val": 101}, {"key": "aphm", "val": 7}], "history_flag": False},
+        ],
+    ),
+    # same date again : values replaced
+    (
+        "2018-08-31",
+        [
+            {"type": "mssante", "values": [{"key": "chu-1", "val": 13}], "history_flag": True},
+        ],
+    ),
+]
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def save_runs(self, backend, filename, runs):
+        for date, data_sets in runs:
+            for data in data_sets:
+                backend.save(filename, data, date)
+            backend.export(filename)
+
+    def load(self, filename):
+        with open(filename, "r") as fin:
+            return json.load(fin)
+
+    def test_sqlite_same_as_json(self):
+        json_fn = os.path.join(self.tmpdir.name, "json", "chu-mssante.json")
+        sqlite_fn = os.path.join(self.tmpdir.name, "sqlite", "chu-mssante.json")
+        os.makedirs(os.path.dirname(json_fn))
+        os.makedirs(os.path.dirname(sqlite_fn))
+
+        self.save_runs(history.JsonHistory(), json_fn, RUNS)
+        db = history.SQLiteHistory(os.path.join(self.tmpdir.name, "history.db"))
+        self.save_runs(db, sqlite_fn, RUNS)
+
+        expected = self.load(json_fn)
+        self.assertEqual(expected["mssante"]["chu-1"], [
+            {"date": "2018-07-31", "value": 10},
+            {"date": "2018-08-31", "value": 13},
+        ])
+        self.assertEqual(self.load(sqlite_fn), expected)
+        self.assertEqual(list(self.load(sqlite_fn)["top"]), ["aphp", "aphm"])
+        self.assertEqual(db.names(), ["chu-mssante.json"])
+        db.close()
+
+    def test_import_json(self):
+        filename = os.path.join(self.tmpdir.name, "chu-mssante.json")
+        self.save_runs(history.JsonHistory(), filename, RUNS[:1])
+
+        # the json file made before is imported at the first save
+        db = history.SQLiteHistory(os.path.join(self.tmpdir.name, "history.db"))
+        self.save_runs(db, filename, RUNS[1:])
+        db.close()
+
+        reference = os.path.join(self.tmpdir.name, "reference.json")
+        self.save_runs(history.JsonHistory(), reference, RUNS)
+        self.assertEqual(self.load(filename), self.load(reference))
+
+    def test_series(self):
+        points = [
+            {"date": "2018-08-31", "value": 2},
+            {"date": "2018-07-31", "value": 1},
+        ]
+        series = history.to_series(points)
+        series["2018-08-31"] = 3
+        series["2018-06-30"] = 0
+        self.assertEqual(
+            history.to_points(series),
+            [
+                {"date": "2018-06-30", "value": 0},
+                {"date": "2018-07-31", "value": 1},
+                {"date": "2018-08-31", "value": 3},
+            ],
+        )
+
+    def test_compact(self):
+        self.assertEqual(history.compact_before("2021-03-15", 24), "2019-03")
+        self.assertEqual(history.compact_before("2021-01-15", 1), "2020-12")
+
+        dates = [f"2018-{m:02d}-{d:02d}" for m in (1, 2) for d in (5, 20)] + ["2019-03-01", "2019-03-20"]
+        runs = [(date, [{"type": "mssante", "values": [{"key": "chu-1", "val": i}], "history_flag": True}])
+                for i, date in enumerate(dates)]
+
+        for backend, subdir in (
+            (history.JsonHistory(compact_months=12), "json"),
+            (history.SQLiteHistory(os.path.join(self.tmpdir.name, "history.db"), compact_months=12), "sqlite"),
+        ):
+            filename = os.path.join(self.tmpdir.name, subdir, "chu-mssante.json")
+            os.makedirs(os.path.dirname(filename))
+            self.save_runs(backend, filename, runs)
+            # one point a month before 2018-03, all the points after
+            self.assertEqual(
+                self.load(filename)["mssante"]["chu-1"],
+                [
+                    {"date": "2018-01-20", "value": 1},
+                    {"date": "2018-02-20", "value": 3},
+                    {"date": "2019-03-01", "value": 4},
+                    {"date": "2019-03-20", "value": 5},
+                ],
+            )
+            backend.close()
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "history"], logging.INFO)
+
+    unittest.main()
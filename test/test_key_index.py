@@ -0,0 +1,76 @@
+import json
+import logging
+import os.path
+import tempfile
+import unittest
+
+import info_rpps
+import key_index
+import practitioner
+from easy_atom import helpers
+
+
+class TestKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_data(self, cat, identifiants):
+        names = practitioner.RPPS.MAPPING[cat]
+        filename = os.path.join(self.tmpdir.name, f"{cat}_201807300827.txt")
+        with open(filename, "w", encoding="utf-8") as fout:
+            fout.write("|".join(names) + "|\n")
+            for i, identifiant in enumerate(identifiants):
+                values = [f"é{i}"] * len(names)
+                values[names.index("identifiant_pp")] = f'"{identifiant}"'
+                fout.write("|".join(values) + "|\n")
+        return filename
+
+    def test_lookup(self):
+        filename = self.write_data(
+            "PS_LibreAcces_Personne_activite",
+            ["10005831911", "810000000001", "10005831911", "10000000002"],
+        )
+        idx = key_index.KeyIndex.open(
+            filename, practitioner.RPPS.KEYS_PERS_ACT, "identifiant_pp"
+        )
+        lines = idx.lookup("10005831911")
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("é0|"))
+        self.assertTrue(lines[1].startswith("é2|"))
+        self.assertEqual(len(idx.lookup("810000000001")), 1)
+        self.assertEqual(idx.lookup("1000583191"), [])
+        self.assertEqual(idx.lookup("identifiant_pp"), [])
+
+    def test_info_rpps(self):
+        pers_fn = self.write_data("PS_LibreAcces_Personne_activite", ["1", "2", "1"])
+        dipl_fn = self.write_data("PS_LibreAcces_Dipl_AutExerc", ["2", "1"])
+        config_fn = os.path.join(self.tmpdir.name, "config-rpps.json")
+        with open(config_fn, "w") as fout:
+            json.dump(
+                {
+                    "local": {
+                        "data": {
+                            "PS_LibreAcces_Personne_activite": pers_fn,
+                            "PS_LibreAcces_Dipl_AutExerc": dipl_fn,
+                            # not processed yet
+                            "PS_LibreAcces_SavoirFaire": None,
+                        }
+                    }
+                },
+                fout,
+            )
+
+        result = info_rpps.App(config=config_fn).process("1")
+        self.assertEqual([len(rows) for rows in result.values()], [2, 1])
+        self.assertEqual(result[dipl_fn][0]["identifiant_pp"], "1")
+        self.assertEqual(result[dipl_fn][0]["type_identifiant_pp"], "é1")
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "key_index"], logging.INFO)
+
+    unittest.main()
@@ -0,0 +1,203 @@
+import json
+import logging
+import os.path
+import tempfile
+import unittest
+import zipfile
+
+import lookout
+import practitioner
+from easy_atom import helpers
+
+
+class TestProcess(unittest.TestCase):
+    RPPS_CATEGORIES = [
+        "PS_LibreAcces_Personne_activite",
+        "PS_LibreAcces_Dipl_AutExerc",
+        "PS_LibreAcces_SavoirFaire",
+    ]
+
+    def setUp(self):
+        self.logger = logging.getLogger("utest")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storage = os.path.join(self.tmpdir.name, "files")
+        os.makedirs(self.storage)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_config(self, **local):
+        config_fn = os.path.join(self.tmpdir.name, "config-mssante.json")
+        local.update(
+            {
+                "storage": self.storage,
+                "last_check": "201801010800",
+                "data": {"Extraction_Correspondance_MSSante": None},
+            }
+        )
+        with open(config_fn, "w") as fout:
+            json.dump(
+                {
+                    "URL": "https://service.annuaire.sante.fr/annuaire-sante-webservices/V300/services/extraction/Extraction_Correspondance_MSSante",
+                    "local": local,
+                    "pub": {
+                        "feed_base": "http://www.opikanoba.org/feeds/rpps",
+                        "url_base": "https://www.opikanoba.org/data/rpps",
+                    },
+                    "tracks": {
+                        "Extraction_Correspondance_MSSante": [
+                            {
+                                "domains": {
+                                    "title": "Domaines des CHU",
+                                    "value": ["chu-1.mssante.fr", "chu-2.mssante.fr"],
+                                },
+                                "filename": "chu-mssante.json",
+                                "name": "chu-mssante",
+                                "save_history": True,
+                            }
+                        ]
+                    },
+                },
+                fout,
+            )
+        return config_fn
+
+    @staticmethod
+    def content(users):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        lines = ["|".join(names) + "|"]
+        for i in range(users):
+            values = [f"v{i}"] * len(names)
+            values[1] = f"user{i}@chu-{i % 2 + 1}.mssante.fr"
+            lines.append("|".join(values) + "|")
+        return "\n".join(lines) + "\n"
+
+    def make_zip(self, date, users):
+        zip_fn = os.path.join(self.tmpdir.name, f"Extraction_Correspondance_MSSante_{date}.zip")
+        with zipfile.ZipFile(zip_fn, "w", zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr(f"Extraction_Correspondance_MSSante_{date}.txt", self.content(users))
+        return zip_fn
+
+    def make_rpps_config(self, name, workers):
+        storage = os.path.join(self.tmpdir.name, name)
+        os.makedirs(storage)
+        config_fn = os.path.join(storage, "config-rpps.json")
+        with open(config_fn, "w") as fout:
+            json.dump(
+                {
+                    "URL": "https://service.annuaire.sante.fr/annuaire-sante-webservices/V300/services/extraction/PS_LibreAcces",
+                    "local": {
+                        "storage": storage,
+                        "last_check": "201801010800",
+                        "workers": workers,
+                        "data": {cat: None for cat in TestProcess.RPPS_CATEGORIES},
+                    },
+                    "pub": {
+                        "feed_base": "http://www.opikanoba.org/feeds/rpps",
+                        "url_base": "https://www.opikanoba.org/data/rpps",
+                    },
+                    "tracks": {
+                        "PS_LibreAcces_Personne_activite": {
+                            "filename": "stats_rpps.json",
+                            "save_history": True,
+                        }
+                    },
+                },
+                fout,
+            )
+        return config_fn, storage
+
+    def make_rpps_zip(self, date):
+        zip_fn = os.path.join(self.tmpdir.name, f"PS_LibreAcces_{date}.zip")
+        with zipfile.ZipFile(zip_fn, "w", zipfile.ZIP_DEFLATED) as zipf:
+            for cat in TestProcess.RPPS_CATEGORIES:
+                names = practitioner.RPPS.MAPPING[cat]
+                lines = ["|".join(names) + "|"]
+                for i in range(30):
+                    values = [f"{name[:4]}{i % 7}" for name in names]
+                    if "type_identifiant_pp" in names:
+                        values[names.index("type_identifiant_pp")] = "8" if i % 3 else "0"
+                    lines.append("|".join(values) + "|")
+                zipf.writestr(f"{cat}_{date}.txt", "\n".join(lines) + "\n")
+        return zip_fn
+
+    def test_parallel_process(self):
+        zip_fn = self.make_rpps_zip("201903010800")
+        results = []
+        for name, workers in (("sequential", 1), ("parallel", 3)):
+            config_fn, storage = self.make_rpps_config(name, workers)
+            app = lookout.App(config_fn)
+            app.process(zip_fn)
+            with open(os.path.join(storage, "stats_rpps.json")) as fin:
+                tracks = json.load(fin)
+            with open(config_fn) as fin:
+                data = json.load(fin)["local"]["data"]
+            results.append(
+                (
+                    tracks,
+                    {cat: os.path.basename(fn) for cat, fn in data.items()},
+                    sorted(os.path.basename(fn) for fn in app.rpps_data.data_files),
+                )
+            )
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            results[0][1]["PS_LibreAcces_SavoirFaire"], "PS_LibreAcces_SavoirFaire_201903010800.txt"
+        )
+
+    def test_sqlite_export(self):
+        app = lookout.App(self.make_config(history_backend="sqlite"))
+        app.process(self.make_zip("201903010800", 20))
+        tracks_fn = os.path.join(self.storage, "chu-mssante.json")
+
+        # the published tracks file is exported from the database by the run
+        self.assertTrue(os.path.exists(os.path.join(self.storage, practitioner.RPPS.HISTORY_DB)))
+        self.assertIn(tracks_fn, app.data_files)
+        with open(tracks_fn) as fin:
+            self.assertIn("chu-1.mssante.fr", json.dumps(json.load(fin)))
+
+        # the export of every tracks file gives the same file
+        os.remove(tracks_fn)
+        app.export_tracks()
+        with open(tracks_fn) as fin:
+            self.assertIn("chu-1.mssante.fr", json.dumps(json.load(fin)))
+
+    def test_incremental_previous_missing(self):
+        config_fn = self.make_config(incremental_stats=True, save_diff_changes=True)
+        lookout.App(config_fn).process(self.make_zip("201903010800", 20))
+        state_fn = os.path.join(self.storage, "Extraction_Correspondance_MSSante.stats.state")
+        self.assertTrue(os.path.exists(state_fn))
+
+        # only the digest of the previous data file is left
+        os.remove(os.path.join(self.storage, "Extraction_Correspondance_MSSante_201903010800.txt"))
+        app = lookout.App(config_fn)
+        app.process(self.make_zip("201904010800", 25))
+        with open(state_fn) as fin:
+            state = json.load(fin)
+        # full count, not an update of the previous state
+        self.assertEqual(state["source"], "Extraction_Correspondance_MSSante_201904010800.txt")
+        self.assertEqual(state["runs"], 0)
+        self.assertEqual(state["rows"], 25)
+
+    def test_corrupted_zip(self):
+        zip_fn = self.make_zip("201903010800", 2000)
+        # damage the compressed data of the member
+        with open(zip_fn, "r+b") as fout:
+            fout.seek(200)
+            fout.write(b"\x00" * 64)
+
+        app = lookout.App(self.make_config(stream_unzip=True))
+        with self.assertLogs("app", level="ERROR") as logs:
+            app.process(zip_fn)
+        self.assertTrue(any("Zip ERROR" in line for line in logs.output))
+        # the partial data file is removed
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.storage, "Extraction_Correspondance_MSSante_201903010800.txt")
+            )
+        )
+
+
+if __name__ == "__main__":
+    loggers = helpers.stdout_logger(["utest", "app"], logging.INFO)
+
+    unittest.main()
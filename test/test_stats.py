@@ -1,8 +1,13 @@
 import logging
+import os.path
+import tempfile
 import unittest
 
+import differentia
+import hll
 import practitioner
 import pandas
+import stats
 
 import easy_atom.helpers as helpers
 
@@ -55,6 +60,295 @@ class TestStats(unittest.TestCase):
         self.assertEqual(116797, df["identifiant_pp"].nunique())
         self.assertEqual(136166, df["adresse_bal"].nunique())
 
+    @unittest.skipUnless(practitioner.pyarrow, "pyarrow not installed")
+    def test_cache(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            with open(filename, "w") as fout:
+                fout.write("|".join(names) + "|\n")
+                for i in range(10):
+                    values = [f"v{i}"] * len(names)
+                    values[1] = f"user{i}@chu-{i % 3}.mssante.fr"
+                    fout.write("|".join(values) + "|\n")
+
+            df = practitioner.RPPS.read_data(filename, names)
+            self.assertTrue(os.path.exists(practitioner.RPPS.cache_filename(filename)))
+
+            cached = practitioner.RPPS.read_data(filename, names, columns=["adresse_bal"])
+            self.assertEqual(list(cached.columns), ["adresse_bal"])
+            self.assertEqual(cached.adresse_bal.tolist(), df.adresse_bal.tolist())
+
+    @unittest.skipUnless(practitioner.pyarrow, "pyarrow not installed")
+    def test_cache_empty_cells(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            with open(filename, "w") as fout:
+                fout.write("|".join(names) + "|\n")
+                for i in range(10):
+                    values = [f"v{i}"] * len(names)
+                    values[0] = "" if i % 2 else "PER"
+                    values[2] = ["", "a", "b"][i % 3]
+                    fout.write("|".join(values) + "|\n")
+
+            columns = ["type_bal", names[2]]
+            for engine in (None, "pyarrow"):
+                df = practitioner.RPPS.read_data(
+                    filename, names, columns=columns, dtypes={"type_bal": "category"}, engine=engine
+                )
+                cached = practitioner.RPPS.read_data(
+                    filename, names, columns=columns, dtypes={"type_bal": "category"}
+                )
+                # empty cells are missing values, in the file and in the cache
+                for frame in (df, cached):
+                    self.assertEqual(frame[names[2]].nunique(), 2)
+                    self.assertEqual(frame[names[2]].isna().sum(), 4)
+                    self.assertEqual(frame.type_bal.nunique(), 1)
+                self.assertEqual(
+                    cached[names[2]].fillna("-").tolist(), df[names[2]].fillna("-").tolist()
+                )
+                os.remove(practitioner.RPPS.cache_filename(filename))
+
+    @unittest.skipUnless(practitioner.pyarrow, "pyarrow not installed")
+    def test_pruned_read(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            with open(filename, "w") as fout:
+                fout.write("|".join(names) + "|\n")
+                for i in range(10):
+                    values = [f"v{i}"] * len(names)
+                    values[0] = "PER" if i % 2 else "ORG"
+                    fout.write("|".join(values) + "|\n")
+
+            for engine in (None, "pyarrow"):
+                df = practitioner.RPPS.read_data(
+                    filename,
+                    names,
+                    columns=["type_bal"],
+                    dtypes={"type_bal": "category"},
+                    engine=engine,
+                )
+                self.assertEqual(list(df.columns), ["type_bal"])
+                self.assertEqual(df.type_bal.dtype, "category")
+                self.assertEqual(df.type_bal.value_counts().to_dict(), {"ORG": 5, "PER": 5})
+
+                # a column not in the cache : parsed again, with the cached ones
+                df = practitioner.RPPS.read_data(filename, names, columns=["nom_exercice"])
+                self.assertEqual(df.nom_exercice.tolist()[:2], ["v0", "v1"])
+                cached_df = practitioner.RPPS.read_data(
+                    filename, names, columns=["type_bal", "nom_exercice"]
+                )
+                self.assertEqual(len(cached_df), 10)
+                os.remove(practitioner.RPPS.cache_filename(filename))
+
+    def test_line_stats(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        spec = practitioner.RPPS.EXTRACT_STATS["Extraction_Correspondance_MSSante"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            with open(filename, "w") as fout:
+                fout.write("|".join(names) + "|\n")
+                for i in range(30):
+                    values = [f"v{i}"] * len(names)
+                    values[0] = "PER" if i % 3 else "ORG"
+                    user = i % 25
+                    values[1] = f"user{user}@chu-{user % 4}.mssante.fr" if i != 7 else ""
+                    values[14] = f"profession {i % 6}"
+                    fout.write("|".join(values) + "|\n")
+
+            frame = stats.FrameStats(
+                pandas.read_csv(
+                    filename, delimiter="|", names=names, header=0, index_col=False, dtype=str
+                )
+            )
+            line_stats = stats.LineStats(names, spec)
+            with open(filename, "rb") as fin:
+                self.assertEqual(len(list(line_stats.scan(fin))), 31)
+
+            for data in (frame, line_stats):
+                self.assertEqual(data.count(), 30)
+                self.assertEqual(data.nunique("adresse_bal"), 24)
+                self.assertEqual(data.nunique("libelle_profession"), 6)
+                self.assertEqual(data.value_counts("type_bal"), {"PER": 20, "ORG": 10})
+                self.assertEqual(data.domain_nunique("adresse_bal"), 4)
+                self.assertEqual(data.domain_count("adresse_bal", "chu-1.mssante.fr"), 6)
+                self.assertEqual(data.domain_count("adresse_bal", "unknown.mssante.fr"), 0)
+
+            # estimated distinct counts
+            approx = stats.LineStats(names, spec, precision=12)
+            with open(filename, "rb") as fin:
+                self.assertEqual(len(list(approx.scan(fin))), 31)
+            self.assertAlmostEqual(approx.nunique("adresse_bal"), 24, delta=1)
+            self.assertEqual(approx.domain_nunique("adresse_bal"), 4)
+            self.assertEqual(approx.domain_count("adresse_bal", "chu-1.mssante.fr"), 6)
+            self.assertEqual(approx.domain_count("adresse_bal", "unknown.mssante.fr"), 0)
+            self.assertEqual(
+                approx.domain_top("adresse_bal", 4), line_stats.domain_top("adresse_bal", 4)
+            )
+
+    def test_ties(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        spec = practitioner.RPPS.EXTRACT_STATS["Extraction_Correspondance_MSSante"]
+        professions = ["z", "a", "m", "a", "z", "m"]
+        rows = []
+        for i, profession in enumerate(professions):
+            values = [f"v{i}"] * len(names)
+            values[1] = f"user{i}@chu-{3 - i % 3}.mssante.fr"
+            values[14] = profession
+            rows.append(values)
+
+        frame = stats.FrameStats(
+            pandas.DataFrame(rows, columns=names).astype({"libelle_profession": "category"})
+        )
+        line_stats = stats.LineStats(names, spec)
+        for values in rows:
+            line_stats.update(values)
+
+        # equal counts ordered by value, whatever the source
+        for data in (frame, line_stats):
+            self.assertEqual(
+                list(data.value_counts("libelle_profession", top=3).items()),
+                [("a", 2), ("m", 2), ("z", 2)],
+            )
+            self.assertEqual(
+                list(data.domain_top("adresse_bal", 2)),
+                ["chu-1.mssante.fr", "chu-2.mssante.fr"],
+            )
+
+    def test_domain_counts(self):
+        frame = stats.FrameStats(
+            pandas.DataFrame(
+                {
+                    "adresse_bal": [
+                        "a@chu-1.fr",
+                        "b@chu-1.fr",
+                        "a@chu-1.fr",
+                        "c@chu-2.fr",
+                        None,
+                        "d@chu-1.fr",
+                        "e@chu-3.fr",
+                        "f@chu-2.fr",
+                    ]
+                }
+            )
+        )
+        counts = frame.domain_counts("adresse_bal")
+        # a single value_counts, shared by all the queries
+        self.assertIs(frame.domain_counts("adresse_bal"), counts)
+        self.assertEqual(counts.to_dict(), {"chu-1.fr": 3, "chu-2.fr": 2, "chu-3.fr": 1})
+        self.assertEqual(
+            list(frame.domain_top("adresse_bal", 2).items()), [("chu-1.fr", 3), ("chu-2.fr", 2)]
+        )
+        self.assertEqual(frame.domain_nunique("adresse_bal"), 3)
+        self.assertEqual(frame.domain_count("adresse_bal", "chu-2.fr"), 2)
+        self.assertEqual(frame.domain_count("adresse_bal", "chu-4.fr"), 0)
+        self.assertIs(frame.domain_counts("adresse_bal"), counts)
+
+    @staticmethod
+    def write_mssante(filename, names, users):
+        with open(filename, "w") as fout:
+            fout.write("|".join(names) + "|\n")
+            for i, user in enumerate(users):
+                values = [f"v{i}"] * len(names)
+                values[0] = "PER" if i % 3 else "ORG"
+                values[1] = f"user{user}@chu-{user % 4}.mssante.fr"
+                values[14] = f"profession {user % 6}"
+                fout.write("|".join(values) + "|\n")
+
+    def test_incremental_stats(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        spec = practitioner.RPPS.EXTRACT_STATS["Extraction_Correspondance_MSSante"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            new_fn = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201808310813.txt")
+            state_fn = os.path.join(tmpdir, "Extraction_Correspondance_MSSante.stats.state")
+            self.write_mssante(old_fn, names, list(range(40)) + [3, 3])
+            # users 0-4 removed, 40-42 added, one row of user 3 kept
+            self.write_mssante(new_fn, names, list(range(5, 43)) + [3])
+
+            old_stats = stats.LineStats(names, spec)
+            with open(old_fn, "rb") as fin:
+                for _line in old_stats.scan(fin):
+                    pass
+            old_stats.source = os.path.basename(old_fn)
+            old_stats.save(state_fn)
+
+            state = stats.LineStats.load(state_fn, names, spec)
+            self.assertEqual(state.snapshot(), old_stats.snapshot())
+            self.assertEqual(state.domain_top("adresse_bal", 4), old_stats.domain_top("adresse_bal", 4))
+
+            diff = differentia.Diff(old_fn)
+            difflist = diff.find_diff(new_fn)
+            state.apply_diff(
+                (text for _, num, text in difflist if num > 1),
+                (text for _, text in diff.removed_lines()),
+            )
+            self.assertEqual(state.runs, 1)
+
+            new_stats = stats.LineStats(names, spec)
+            with open(new_fn, "rb") as fin:
+                for _line in new_stats.scan(fin):
+                    pass
+            self.assertEqual(state.snapshot(), new_stats.snapshot())
+            self.assertEqual(state.count(), 39)
+            self.assertEqual(state.nunique("adresse_bal"), 39)
+            for domain in ("chu-0.mssante.fr", "chu-3.mssante.fr"):
+                self.assertEqual(
+                    state.domain_count("adresse_bal", domain),
+                    new_stats.domain_count("adresse_bal", domain),
+                )
+
+    def test_incremental_duplicates(self):
+        names = practitioner.RPPS.KEYS_MSSANTE
+        spec = practitioner.RPPS.EXTRACT_STATS["Extraction_Correspondance_MSSante"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            old_fn = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201807310813.txt")
+            new_fn = os.path.join(tmpdir, "Extraction_Correspondance_MSSante_201808310813.txt")
+            self.write_mssante(old_fn, names, range(10))
+            self.write_mssante(new_fn, names, range(10))
+            # the same rows, some of them more or less times
+            with open(old_fn) as fin:
+                rows = fin.readlines()
+            with open(new_fn, "w") as fout:
+                fout.writelines(rows + rows[2:4] + rows[2:3])
+            with open(old_fn, "a") as fout:
+                fout.writelines(rows[5:7])
+
+            state = stats.LineStats(names, spec)
+            with open(old_fn, "rb") as fin:
+                for _line in state.scan(fin):
+                    pass
+            diff = differentia.Diff(old_fn)
+            difflist = diff.find_diff(new_fn)
+            self.assertEqual(len(difflist), 3)
+            state.apply_diff(
+                (text for _, num, text in difflist if num > 1),
+                (text for _, text in diff.removed_lines()),
+            )
+
+            new_stats = stats.LineStats(names, spec)
+            with open(new_fn, "rb") as fin:
+                for _line in new_stats.scan(fin):
+                    pass
+            self.assertEqual(state.snapshot(), new_stats.snapshot())
+            self.assertEqual(state.count(), 13)
+
+    def test_hyperloglog(self):
+        sketch = hll.HyperLogLog(precision=12)
+        other = hll.HyperLogLog(precision=12)
+        for i in range(50000):
+            sketch.add(f"{i:011d}")
+            other.add(f"{i + 25000:011d}")
+        self.assertLess(abs(sketch.count() - 50000), 50000 * 0.05)
+
+        sketch.merge(other)
+        self.assertLess(abs(len(sketch) - 75000), 75000 * 0.05)
+
+        with self.assertRaises(ValueError):
+            hll.HyperLogLog(precision=2)
+
 
 if __name__ == "__main__":
     loggers = helpers.stdout_logger(["utest"], logging.INFO)
@@ -1,7 +1,10 @@
 import datetime
 import json
 import logging
+import os.path
+import tempfile
 import unittest
+import zipfile
 from collections import namedtuple
 
 import practitioner
@@ -47,6 +50,43 @@ class TestUnzip(unittest.TestCase):
 
         self.assertEqual(len(_files), 3)
 
+    def test_stream_member(self):
+        d = practitioner.RPPS(properties=self.config_1)
+        content = b"h|a\n1|x\n2|y\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            zip_fn = os.path.join(tmpdir, "PS_LibreAcces_201808011050.zip")
+            with zipfile.ZipFile(zip_fn, "w", zipfile.ZIP_DEFLATED) as zipf:
+                zipf.writestr("PS_LibreAcces_SavoirFaire_201808011050.txt", content)
+
+            _files = d.zip_members(zip_fn, tmpdir)
+            self.assertEqual(len(_files), 1)
+            self.assertFalse(os.path.exists(_files[0]))
+
+            lines = list(d.stream_member(zip_fn, _files[0]))
+            self.assertEqual(b"".join(lines), content)
+            with open(_files[0], "rb") as fin:
+                self.assertEqual(fin.read(), content)
+
+    def test_member_path(self):
+        d = practitioner.RPPS(properties=self.config_1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest_dir = os.path.join(tmpdir, "files")
+            os.makedirs(dest_dir)
+            zip_fn = os.path.join(tmpdir, "PS_LibreAcces_201808011050.zip")
+            with zipfile.ZipFile(zip_fn, "w") as zipf:
+                zipf.writestr("PS_LibreAcces_SavoirFaire_201808011050.txt", b"h|a\n")
+                zipf.writestr("../escaped.txt", b"h|a\n")
+                zipf.writestr("/tmp/absolute.txt", b"h|a\n")
+                zipf.writestr("sub/PS_LibreAcces_Dipl_AutExerc_201808011050.txt", b"h|a\n")
+
+            expected = [os.path.join(dest_dir, "PS_LibreAcces_SavoirFaire_201808011050.txt")]
+            self.assertEqual(d.zip_members(zip_fn, dest_dir), expected)
+            self.assertEqual(d.unzip(zip_fn, dest_dir), expected)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "escaped.txt")))
+            self.assertEqual(os.listdir(dest_dir), [os.path.basename(expected[0])])
+
 
 if __name__ == "__main__":
     loggers = helpers.stdout_logger(["utest"], logging.INFO)